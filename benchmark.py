@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+
+import argparse
+import functools
+import json
+import os
+import platform
+import random
+import statistics
+import string
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+TOKEN = "BENCHMARK"
+NAMESPACE = "bench"
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "check_drone_builds.py")
+
+# the options every execution mode adds to the command line
+MODES = {
+    "threads": [],
+    "stdlib": ["--transport", "stdlib"],
+    "asyncio": ["--engine", "asyncio"],
+    "stream": ["--stream"],
+    "stdlib-stream": ["--transport", "stdlib", "--stream"],
+    "latest": ["--latest"],
+}
+
+
+class FakeDrone:
+    # generates repos × builds on the fly, repos are failing (their newest builds failed) with failing_rate
+    def __init__(self, repos: int, builds: int, payload_size: int = 0, failing_rate: float = 0.1, seed: int = 0, now: int | None = None):
+        self.repos = repos
+        self.builds = builds
+        self.payload_size = payload_size
+        self.now = now or int(time.time())
+        rng = random.Random(seed)
+        self.failing = [rng.random() < failing_rate for _ in range(repos)]
+
+    def get_repo(self, index: int, latest: bool = False) -> dict:
+        repo = {
+            "id": index + 1,
+            "namespace": NAMESPACE,
+            "name": f"repo-{index}",
+            "slug": f"{NAMESPACE}/repo-{index}",
+            "default_branch": "main",
+            "active": True,
+            "config_path": ".drone.yml",
+            "counter": self.builds,
+            "archived": False,
+        }
+        if latest and self.builds:
+            repo["build"] = self.get_build(index, self.builds)
+        return repo
+
+    def get_build(self, index: int, number: int) -> dict:
+        # one build an hour, the newest half of the builds of a failing repo failed
+        finished = self.now - (self.builds - number) * 3600 - 60
+        failed = self.failing[index] and number > self.builds // 2
+        return {
+            "id": index * self.builds + number,
+            "repo_id": index + 1,
+            "trigger": "@hook",
+            "number": number,
+            "status": "failure" if failed else "success",
+            "event": "push",
+            "link": f"https://git.example.org/{NAMESPACE}/repo-{index}/commit/{number:040x}",
+            "message": "x" * self.payload_size,
+            "after": f"{number:040x}",
+            "ref": "refs/heads/main",
+            "target": "main",
+            "author_login": "bench",
+            "started": finished - 120,
+            "finished": finished,
+            "created": finished - 125,
+            "updated": finished,
+            "version": 3,
+        }
+
+    @functools.lru_cache(maxsize=4096)
+    def get_repos_page(self, latest: bool) -> bytes:
+        return json.dumps([self.get_repo(index, latest) for index in range(self.repos)]).encode()
+
+    @functools.lru_cache(maxsize=4096)
+    def get_builds_page(self, index: int, page: int, per_page: int) -> bytes:
+        numbers = range(self.builds - (page - 1) * per_page, max(self.builds - page * per_page, 0), -1)
+        return json.dumps([self.get_build(index, number) for number in numbers]).encode()
+
+    def get_response(self, path: string) -> tuple[int, bytes]:
+        url = urlsplit(path)
+        query = parse_qs(url.query)
+        if url.path == "/api/user/repos":
+            return 200, self.get_repos_page(query.get("latest") == ["true"])
+
+        parts = url.path.removeprefix("/api/repos/").split("/")
+        if len(parts) != 3 or parts[0] != NAMESPACE or parts[2] != "builds" or not parts[1].startswith("repo-"):
+            return 404, b'{"message": "Not Found"}'
+        index = int(parts[1].removeprefix("repo-"))
+        if index >= self.repos:
+            return 404, b'{"message": "Not Found"}'
+        return 200, self.get_builds_page(index, int(query.get("page", ["1"])[0]), int(query.get("per_page", ["25"])[0]))
+
+
+class FakeDroneHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    drone = None
+    latency = 0.0
+    jitter = 0.0
+    error_rate = 0.0
+    rng = random.Random(0)
+    lock = threading.Lock()
+    requests = 0
+
+    def do_GET(self) -> None:
+        with self.lock:
+            type(self).requests += 1
+            delay = self.latency + self.rng.uniform(0, self.jitter)
+            error = self.rng.random() < self.error_rate
+        time.sleep(delay)
+        if self.headers.get("Authorization") != f"Bearer {TOKEN}":
+            code, content = 401, b'{"message": "Unauthorized"}'
+        elif error:
+            code, content = 500, b'{"message": "Internal Server Error"}'
+        else:
+            code, content = self.drone.get_response(self.path)
+
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        if self.headers.get("Connection", "").lower() == "close":
+            self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format: string, *args) -> None:
+        pass
+
+
+class FakeDroneServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024 # many checks open a new connection per request
+
+    def handle_error(self, request, client_address) -> None:
+        # a streaming check closes the connection as soon as it has seen enough
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def start_server(drone: FakeDrone, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0, seed: int = 0) -> FakeDroneServer:
+    handler = type("Handler", (FakeDroneHandler,), {
+        "drone": drone, "latency": latency, "jitter": jitter, "error_rate": error_rate, "rng": random.Random(seed), "lock": threading.Lock(), "requests": 0,
+    })
+    server = FakeDroneServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True).start()
+    return server
+
+
+def run_check(server: FakeDroneServer, options: list) -> dict:
+    # every run is a new process, so the wall time includes the start-up and the peak RSS is of that run only
+    handler = server.RequestHandlerClass
+    handler.requests = 0
+    command = [sys.executable, SCRIPT, "--server", f"http://127.0.0.1:{server.server_port}", "--token", TOKEN, "--namespace", NAMESPACE] + options
+    started = time.perf_counter()
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    output = process.stdout.read()
+    _, status, usage = os.wait4(process.pid, 0)
+    wall_time = time.perf_counter() - started
+    process.returncode = os.waitstatus_to_exitcode(status)
+    process.stdout.close()
+    return {
+        "wall_time": round(wall_time, 4),
+        "requests": handler.requests,
+        "peak_rss": usage.ru_maxrss * (1 if sys.platform == "darwin" else 1024),
+        "exit_code": process.returncode,
+        "output": output.split(" | ")[0].strip()[:200],
+    }
+
+
+def summarize(runs: list) -> dict:
+    return {
+        "wall_time": round(statistics.median(run["wall_time"] for run in runs), 4),
+        "requests": round(statistics.median(run["requests"] for run in runs)),
+        "peak_rss": round(statistics.median(run["peak_rss"] for run in runs)),
+    }
+
+
+def run_benchmark(args: argparse.Namespace) -> dict:
+    drone = FakeDrone(args.repos, args.builds, args.payload_size, args.failing_rate, args.seed)
+    server = start_server(drone, args.latency / 1000, args.jitter / 1000, args.error_rate, args.seed)
+    results = {}
+    try:
+        for mode in args.modes:
+            options = ["--concurrency", str(args.concurrency), "--per-page", str(args.per_page), "--warning", str(args.warning), "--critical", str(args.critical)]
+            runs = [run_check(server, options + MODES[mode]) for _ in range(args.runs)]
+            results[mode] = {"options": MODES[mode], "summary": summarize(runs), "runs": runs}
+            print_result(mode, results[mode]["summary"], file=sys.stderr)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    return {
+        "created": datetime.now().astimezone().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": {name: getattr(args, name) for name in ["repos", "builds", "payload_size", "failing_rate", "latency", "jitter", "error_rate", "concurrency", "per_page", "warning", "critical", "runs", "seed"]},
+        "results": results,
+    }
+
+
+def print_result(mode: string, summary: dict, baseline: dict | None = None, file=None) -> None:
+    line = f"{mode:<14} {summary['wall_time']:>8.3f}s {summary['requests']:>7} requests {summary['peak_rss'] / 1048576:>8.1f} MB"
+    if baseline:
+        line += "  (" + ", ".join(f"{name} {summary[name] / baseline[name]:.2f}x" for name in ["wall_time", "requests", "peak_rss"] if baseline[name]) + ")"
+    print(line, file=file)
+
+
+def compare(result: dict, baseline: dict) -> None:
+    if result["parameters"] != baseline["parameters"]:
+        print("Warning: the baseline was run with other parameters", file=sys.stderr)
+    for mode, mode_result in result["results"].items():
+        print_result(mode, mode_result["summary"], baseline["results"].get(mode, {}).get("summary"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark check_drone_builds.py against a local fake Drone server")
+    parser.add_argument("--repos", type=int, help="Number of repositories", default=200)
+    parser.add_argument("--builds", type=int, help="Number of builds per repository", default=50)
+    parser.add_argument("--payload-size", type=int, help="Size in bytes of the commit message of every build", default=0)
+    parser.add_argument("--failing-rate", type=float, help="Share of repositories whose newest builds failed", default=0.1)
+    parser.add_argument("--latency", type=float, help="Latency of every response in milliseconds", default=0)
+    parser.add_argument("--jitter", type=float, help="Random extra latency of every response, up to this many milliseconds", default=0)
+    parser.add_argument("--error-rate", type=float, help="Share of responses that are HTTP 500", default=0)
+    parser.add_argument("--concurrency", type=int, help="--concurrency of the check", default=10)
+    parser.add_argument("--per-page", type=int, help="--per-page of the check", default=25)
+    parser.add_argument("--warning", type=int, help="--warning of the check", default=86400)
+    parser.add_argument("--critical", type=int, help="--critical of the check", default=172800)
+    parser.add_argument("--modes", type=str, nargs="+", choices=list(MODES), help="Execution modes to run", default=list(MODES))
+    parser.add_argument("--runs", type=int, help="Number of runs of every mode, the median is reported", default=3)
+    parser.add_argument("--seed", type=int, help="Seed for the generated repositories, jitter and errors", default=0)
+    parser.add_argument("--output", type=str, help="Write the results as JSON to this file instead of stdout")
+    parser.add_argument("--compare", type=str, help="Compare the results with those in this JSON file")
+    args = parser.parse_args()
+
+    if args.runs < 1:
+        parser.error("--runs must be at least 1")
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    result = run_benchmark(args)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+    else:
+        json.dump(result, sys.stdout, indent=2)
+        print()
+    if baseline:
+        compare(result, baseline)
+
+
+if __name__ == "__main__":
+    main()
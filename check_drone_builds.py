@@ -1,153 +1,1853 @@
 #!/usr/bin/env python3
 
+# anything heavy (requests, asyncio, http.server, ...) is imported where it is used, as it is a large part of the time a check takes
+from __future__ import annotations
+
 import argparse
+import base64
+import codecs
+import contextlib
+import fcntl
+import functools
+import hashlib
+import hmac
 import json
 import logging
+import marshal
+import math
+import os
+import re
 import string
+import socket
 import sys
+import threading
+import time
+import zlib
 from datetime import datetime
-from typing import NoReturn
+from typing import TYPE_CHECKING, AsyncIterator, Iterator, NoReturn
+from urllib.parse import quote, urlsplit
+
+if TYPE_CHECKING:
+    import asyncio
+    import http.client
+    from http.server import ThreadingHTTPServer
+
+    import requests
+
+
+EXIT_CODES = {
+    "OK" : 0,
+    "WARNING"   : 1,
+    "CRITICAL"  : 2,
+    "UNKNOWN"   : 3
+}
+SERVER_CONFIG_KEYS = {
+    "name", "server", "token", "namespace", "warning", "critical", "timeout", "concurrency", "engine", "transport", "pool_size", "keepalive",
+    "connect_timeout", "read_timeout", "latest", "state_file", "cache_dir", "cache_size", "per_page", "max_pages", "stream",
+    "repos_ttl", "deadline", "branches", "events", "shard", "rules", "metrics_file", "retries", "retry_backoff",
+}
+RULE_KEYS = {"pattern", "warning", "critical"}
+# https://github.com/harness/drone/blob/master/core/status.go
+FINISHED_STATUSES = ["success", "failure", "error", "killed", "skipped", "declined"]
+EVENTS = ["push", "pull_request", "tag", "promote", "rollback", "cron", "custom"]
+# the webhooks of Drone are a few KiB, anything larger isn't read before its signature could be checked
+WEBHOOK_MAX_BODY_SIZE = 1024 * 1024
+# all metrics are of the last sweep only, so even the counts of the check are gauges
+METRICS = {
+    "drone_repo_last_success_timestamp_seconds": "Time the last successful build of the repo finished",
+    "drone_repo_latest_build_status": "Status of the latest build of the repo, in its status label",
+    "drone_repo_builds_scanned": "Number of builds of the repo the check looked through",
+    "drone_repo_check_status": "Status of the repo: 0 OK, 1 WARNING, 2 CRITICAL, 3 UNKNOWN",
+    "drone_check_timestamp_seconds": "Time of the check",
+    "drone_check_duration_seconds": "Duration of the check",
+    "drone_check_fetch_seconds": "Summed duration of the builds requests of the check",
+    "drone_check_requests": "Number of requests the check made to the Drone API",
+    "drone_check_received_bytes": "Number of bytes the check received from the Drone API",
+    "drone_check_repos": "Number of repos the check covered, by whether their builds were fetched, skipped, not reached or failed",
+}
+METRIC_LABEL_ESCAPES = str.maketrans({"\\": "\\\\", '"': '\\"', "\n": "\\n"})
+
+
+def format_perfdata(perfdata: dict) -> string:
+    if not perfdata:
+        return ""
+    return " | " + " ".join(f"'{label}'={value}" if " " in label else f"{label}={value}" for label, value in perfdata.items())
+
+
+def format_metrics(samples: list) -> string:
+    # OpenMetrics text format, which node_exporter's textfile collector reads as well
+    metrics = {name: [] for name in METRICS}
+    for name, labels, value in samples:
+        label_values = ",".join(f'{label}="{str(label_value).translate(METRIC_LABEL_ESCAPES)}"' for label, label_value in labels.items())
+        metrics[name].append(f"{name}{{{label_values}}} {value}")
+    lines = []
+    for name, metric_lines in metrics.items():
+        if metric_lines:
+            lines += [f"# HELP {name} {METRICS[name]}.", f"# TYPE {name} gauge"] + metric_lines
+    return "\n".join(lines + ["# EOF"]) + "\n"
+
+
+def get_keepalive_socket_options(keepalive: int) -> list:
+    # TCP keepalive probes stop idle pooled connections from being dropped silently by firewalls/load balancers
+    if not keepalive:
+        return []
+    socket_options = [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+    if hasattr(socket, "TCP_KEEPIDLE"):
+        socket_options += [(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, keepalive), (socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, keepalive)]
+    return socket_options
+
+
+def parse_shard(shard: str) -> tuple[int, int]:
+    index, _, count = shard.partition("/")
+    if not (index.isdigit() and count.isdigit() and 1 <= int(index) <= int(count)):
+        raise ValueError(f"Invalid shard {shard}, expected INDEX/COUNT with 1 <= INDEX <= COUNT")
+    return int(index), int(count)
+
+
+def get_shard(slug: str, count: int) -> int:
+    # jump consistent hash (Lamping & Veach) of the slug: a repo stays in its shard when other repos are added or removed,
+    # and when a shard is added only the repos that move to it change shard
+    key = int.from_bytes(hashlib.blake2b(slug.encode(), digest_size=8).digest(), "big")
+    shard, candidate = -1, 0
+    while candidate < count:
+        shard = candidate
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        candidate = int((shard + 1) * (2 ** 31 / ((key >> 33) + 1)))
+    return shard + 1
+
+
+def write_file_atomic(path: str, content: str | bytes) -> None:
+    import tempfile
+
+    directory = os.path.dirname(os.path.abspath(path))
+    mode = "wb" if isinstance(content, bytes) else "w"
+    with tempfile.NamedTemporaryFile(mode, dir=directory, prefix=f".{os.path.basename(path)}.", delete=False) as f:
+        try:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+            os.chmod(f.name, 0o644)
+            os.replace(f.name, path)
+        except BaseException:
+            os.unlink(f.name)
+            raise
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class TransientError(Exception):
+    pass
+
+
+class MissingRecording(Exception):
+    pass
+
+
+class RepoError(Exception):
+    pass
+
+
+class NagiosExit(BaseException):
+    # raised instead of exiting when nagios_exit is called outside the main thread (e.g. from a worker),
+    # so the thread that owns the check can exit with the same status once it collects the result
+    def __init__(self, status: string, message: string):
+        super().__init__(status, message)
+        self.status = status
+        self.message = message
+
+
+class ThresholdRules:
+    # the first rule whose pattern matches the slug wins, all patterns are compiled into a single regex,
+    # so looking up a repo is one match however many rules there are
+    def __init__(self, rules: list, warning: int, critical: int):
+        import fnmatch
+
+        self.default = (warning, critical)
+        self.thresholds = [(rule.get("warning", warning), rule.get("critical", critical)) for rule in rules]
+        self.pattern = re.compile("|".join(f"(?P<rule{index}>{fnmatch.translate(rule['pattern'])})" for index, rule in enumerate(rules))) if rules else None
+        self.matches = {}
+
+    def get(self, slug: str) -> tuple[int, int]:
+        if not self.pattern:
+            return self.default
+        thresholds = self.matches.get(slug)
+        if thresholds is None:
+            # the group of the rule encloses those of its pattern, so it is the last one closed
+            match = self.pattern.fullmatch(slug)
+            thresholds = self.matches[slug] = self.thresholds[int(match.lastgroup.removeprefix("rule"))] if match else self.default
+        return thresholds
+
+
+class Record:
+    # the few fields of a repo/build the check needs, the decoded dict (and everything else that was in it) is released right away
+    __slots__ = ()
+    fields = ()
+    types = {}
+
+    def __init_subclass__(cls, **kwargs) -> None:
+        super().__init_subclass__(**kwargs)
+        Record.types[cls.__name__] = cls
+
+    def __init__(self, *values) -> None:
+        for field, value in zip(self.fields, values):
+            setattr(self, field, value)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> Record:
+        return cls(*(data.get(field) for field in cls.fields))
+
+    def get(self, field: str, default: object = None) -> object:
+        # reads like the dict it replaces
+        return getattr(self, field, default) if field in self.fields else default
+
+    @staticmethod
+    def dump(value: object) -> object:
+        # marshal (see ResponseCache) can only store builtin types
+        if isinstance(value, Record):
+            return (type(value).__name__, *(Record.dump(value.get(field)) for field in value.fields))
+        return value
+
+    @staticmethod
+    def load(value: object) -> object:
+        # decoded JSON never contains tuples
+        if isinstance(value, tuple) and value and value[0] in Record.types:
+            return Record.types[value[0]](*(Record.load(item) for item in value[1:]))
+        return value
+
+    def __eq__(self, other: object) -> bool:
+        return type(self) is type(other) and all(self.get(field) == other.get(field) for field in self.fields)
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({', '.join(f'{field}={self.get(field)!r}' for field in self.fields)})"
+
+
+class Build(Record):
+    __slots__ = fields = ("number", "status", "finished", "created", "event", "ref", "target")
+
+    @classmethod
+    def decode(cls, data: dict) -> Build | dict:
+        # object_hook of json.loads, so every build is projected as soon as it is decoded
+        return cls.from_dict(data) if "number" in data else data
+
+
+class Repo(Record):
+    __slots__ = fields = ("namespace", "name", "slug", "active", "build")
+
+    @classmethod
+    def from_dict(cls, data: dict) -> Repo:
+        repo = super().from_dict(data)
+        if isinstance(repo.build, dict):
+            repo.build = Build.from_dict(repo.build) # the latest build, with ?latest=true
+        return repo
+
+    @classmethod
+    def decode(cls, data: dict) -> Repo | Build | dict:
+        # object_hook of json.loads, the latest build of a repo is decoded before the repo itself
+        return cls.from_dict(data) if "slug" in data else Build.decode(data)
+
+
+class BuildStream:
+    # decodes a list of builds while it is being downloaded, keeps only the fields the check needs
+    # and tells the caller to stop downloading once the rest of the list can't change the result
+    def __init__(self, high_water_mark: int = 0, relevant: callable | None = None):
+        self.high_water_mark = high_water_mark
+        self.relevant = relevant
+        self.builds = []
+        self.error = None
+        self.stopped = False
+        self.complete = False
+        self.decoder = json.JSONDecoder()
+        self.text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = ""
+        self.expect = "["
+        self.size = 0
+
+    def feed(self, data: bytes, final: bool = False) -> bool:
+        self.size += len(data)
+        try:
+            self.decode(self.text_decoder.decode(data, final), final)
+        except ValueError as e:
+            self.error = e
+            self.stopped = True
+        return self.stopped
+
+    def decode(self, text: str, final: bool) -> None:
+        buffer = self.buffer + text
+        position = 0
+        while not self.stopped and not self.complete:
+            while position < len(buffer) and buffer[position] in " \t\r\n":
+                position += 1
+            if position == len(buffer):
+                break
+            char = buffer[position]
+            if self.expect == "[":
+                if char != "[":
+                    raise ValueError("Returned json does not contain a list")
+                self.expect = "first"
+                position += 1
+            elif char == "]" and self.expect in ("first", "next"):
+                self.complete = True
+                position += 1
+            elif char == "," and self.expect == "next":
+                self.expect = "value"
+                position += 1
+            elif self.expect in ("first", "value"):
+                try:
+                    build, end = self.decoder.raw_decode(buffer, position)
+                except json.JSONDecodeError:
+                    if final:
+                        raise
+                    break # the rest of it is still on its way
+                if end == len(buffer) and not final and not isinstance(build, (dict, list, str)):
+                    break # a number could continue in the next chunk
+                position = end
+                self.expect = "next"
+                self.add(build)
+            else:
+                raise ValueError(f"Unexpected {char!r} in list of builds")
+        self.buffer = buffer[position:]
+        if final and not self.complete and not self.stopped:
+            raise ValueError("Returned json list is incomplete")
+
+    def add(self, build: object) -> None:
+        if not isinstance(build, dict):
+            self.builds.append(build) # fails in the same way as without streaming
+            return
+        build = Build.from_dict(build)
+        if not self.builds and self.high_water_mark and (build.number or 0) < self.high_water_mark:
+            self.high_water_mark = 0 # renumbered, see CheckDroneBuilds.check_renumbered
+        self.builds.append(build)
+        # same reasoning as CheckDroneBuilds.is_last_page, but per build instead of per page
+        if (build.status == "success" and (not self.relevant or self.relevant(build))) or (self.high_water_mark and (build.number or 0) <= self.high_water_mark):
+            self.stopped = True
+
+
+class ResponseCache:
+    # responses are stored already decoded (with marshal, which loads a lot faster than json),
+    # so a 304 Not Modified costs neither the download nor the decoding of the body
+    version = ("check_drone_builds", 5, marshal.version)
+
+    def __init__(self, directory: str, max_size: int, token: str):
+        self.directory = directory
+        self.max_size = max_size
+        # the token is part of the key, as what the API returns depends on who is asking
+        self.token = token
+        try:
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+        except OSError as e:
+            # the cache only saves requests, the check works without it
+            logging.getLogger(__name__).exception(str(e))
+
+    @staticmethod
+    def get_conditional_headers(cached: tuple[dict, object] | None) -> dict:
+        if not cached:
+            return {}
+        validators, _ = cached
+        headers = {}
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
+        return headers
+
+    def get_path(self, url: str) -> str:
+        return os.path.join(self.directory, hashlib.sha256(f"{self.token}\n{url}".encode()).hexdigest())
+
+    def get(self, url: str) -> tuple[dict, object] | None:
+        path = self.get_path(url)
+        try:
+            with open(path, "rb") as f:
+                version, cached_url, validators, data = marshal.load(f)
+            os.utime(path) # the modification time is what the least recently used entries are evicted by
+        except FileNotFoundError:
+            return None
+        except Exception:
+            return None # e.g. written by another version, it will be overwritten
+        if version != self.version or cached_url != url:
+            return None
+        return validators, [Record.load(item) for item in data] if isinstance(data, list) else data
+
+    def store(self, url: str, etag: str | None, last_modified: str | None, data: object, fetched: int | None = None) -> None:
+        if not etag and not last_modified and fetched is None:
+            return # no way to revalidate it, nor to tell how old it is
+        validators = {"etag": etag, "last_modified": last_modified}
+        if fetched is not None:
+            validators["fetched"] = fetched
+        if isinstance(data, list):
+            data = [Record.dump(item) for item in data]
+        write_file_atomic(self.get_path(url), marshal.dumps((self.version, url, validators, data)))
+
+    @contextlib.contextmanager
+    def lock(self, url: str) -> Iterator[None]:
+        # hidden, so it is neither evicted nor purged
+        directory, name = os.path.split(self.get_path(url))
+        try:
+            f = open(os.path.join(directory, f".{name}.lock"), "w")
+        except OSError:
+            f = None # e.g. the directory couldn't be created, every check then refreshes it on its own
+        if not f:
+            yield
+            return
+        with f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    def get_entries(self) -> list:
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.startswith("."):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def evict(self) -> None:
+        entries = self.get_entries()
+        size = sum(entry_size for _, entry_size, _ in entries)
+        for _, entry_size, path in sorted(entries):
+            if size <= self.max_size:
+                break
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(path)
+            size -= entry_size
+
+    def purge(self) -> None:
+        for _, _, path in self.get_entries():
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(path)
+
+
+class Recording:
+    # the responses of the Drone API, one gzipped JSON file per URL, keyed by path so they can be replayed against any --server
+    def __init__(self, directory: str, replay: bool = False):
+        self.directory = directory
+        self.replay = replay
+        self.time = None
+        if replay:
+            with contextlib.suppress(FileNotFoundError), open(os.path.join(directory, "recording.json")) as f:
+                self.time = json.load(f).get("time")
+        else:
+            os.makedirs(directory, exist_ok=True)
+
+    def start(self, now: int, server: str) -> None:
+        # a replay evaluates the builds at the time they were recorded
+        write_file_atomic(os.path.join(self.directory, "recording.json"), json.dumps({"time": now, "server": server}))
+
+    def get_path(self, path: str) -> str:
+        return os.path.join(self.directory, f"{hashlib.sha256(path.encode()).hexdigest()}.json.gz")
+
+    def store(self, path: str, request_headers: dict, status_code: int, headers: dict, content: bytes, started: float, elapsed: float) -> None:
+        import gzip
+
+        # the body is stored decoded, so its encoding headers don't apply anymore
+        headers = {key: value for key, value in headers.items() if key.lower() not in ["content-encoding", "content-length", "transfer-encoding"]}
+        write_file_atomic(self.get_path(path), gzip.compress(json.dumps({
+            "method": "GET",
+            "path": path,
+            "request_headers": {key: value for key, value in request_headers.items() if key.lower() != "authorization"},
+            "status_code": status_code,
+            "headers": headers,
+            "started": round(started, 3),
+            "elapsed": round(elapsed, 6),
+            "body": content.decode("utf-8", "surrogateescape"),
+        }, separators=(",", ":")).encode()))
+
+    def load(self, path: str) -> tuple[int, dict, bytes]:
+        import gzip
+
+        try:
+            with gzip.open(self.get_path(path)) as f:
+                response = json.load(f)
+        except FileNotFoundError:
+            raise MissingRecording(f"No recorded response for {path}") from None
+        return response["status_code"], response["headers"], response["body"].encode("utf-8", "surrogateescape")
+
+
+class RecordedResponse:
+    # the part of requests.Response the check uses, for a response that was read completely
+    def __init__(self, status_code: int, headers: dict, content: bytes):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self) -> str:
+        return self.content.decode("utf-8", "replace")
+
+    def json(self) -> object:
+        return json.loads(self.content)
+
+    def iter_content(self, chunk_size: int) -> Iterator[bytes]:
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+
+    def close(self) -> None:
+        pass
+
+
+class RecordingSession:
+    # records every response of the session, or replays the recorded ones without a session (and network) at all
+    def __init__(self, recording: Recording, base_url: str, session: requests.Session | StdlibSession | None):
+        self.recording = recording
+        self.base_url = base_url
+        self.session = session
+
+    def get(self, url: str, headers: dict | None = None, timeout: tuple = (10, 30), stream: bool = False) -> RecordedResponse:
+        path = url.removeprefix(self.base_url)
+        if self.recording.replay:
+            return RecordedResponse(*self.recording.load(path))
+
+        # never streamed, as the whole response is recorded
+        started = time.time()
+        response = self.session.get(url, headers=headers, timeout=timeout)
+        content = response.content
+        self.recording.store(path, headers or {}, int(response.status_code), dict(response.headers), content, started, time.time() - started)
+        return RecordedResponse(int(response.status_code), dict(response.headers), content)
+
+    def get_connection_stats(self) -> tuple[int, int]:
+        if self.session is None:
+            return 0, 0
+        if isinstance(self.session, StdlibSession):
+            return self.session.get_connection_stats()
+        stats = [adapter.get_connection_stats() for adapter in set(self.session.adapters.values())]
+        return sum(opened for opened, _ in stats), sum(reused for _, reused in stats)
+
+
+def get_webhook_handler_class() -> type:
+    from http.server import BaseHTTPRequestHandler
+
+    class WebhookHandler(BaseHTTPRequestHandler):
+        # receives the events Drone posts to its webhook endpoints (DRONE_WEBHOOK_ENDPOINT), signed with DRONE_WEBHOOK_SECRET
+        check = None
+        secret = b""
+
+        def do_POST(self) -> None:
+            length = int(self.headers.get("Content-Length", 0))
+            if length > WEBHOOK_MAX_BODY_SIZE:
+                self.send_error(413)
+                return
+            body = self.rfile.read(length)
+            if not self.verify_signature(body):
+                self.send_error(401)
+                return
+            try:
+                self.check.record_webhook_event(json.loads(body))
+            except Exception as e:
+                self.check.log.exception(str(e))
+                self.send_error(400)
+                return
+            self.send_response(204)
+            self.end_headers()
+
+        def verify_signature(self, body: bytes) -> bool:
+            # Drone signs with HTTP signatures (draft-cavage-http-signatures), the body is covered through the signed digest
+            params = dict(re.findall(r'(\w+)="([^"]*)"', self.headers.get("Signature", "")))
+            names = params.get("headers", "date").lower().split()
+            if params.get("algorithm", "hmac-sha256") != "hmac-sha256" or "digest" not in names:
+                return False
+            lines = []
+            for name in names:
+                if name == "(request-target)":
+                    lines.append(f"{name}: {self.command.lower()} {self.path}")
+                elif name in self.headers:
+                    lines.append(f"{name}: {self.headers[name]}")
+                else:
+                    return False
+            signature = base64.b64encode(hmac.new(self.secret, "\n".join(lines).encode(), hashlib.sha256).digest()).decode()
+            digest = f"SHA-256={base64.b64encode(hashlib.sha256(body).digest()).decode()}"
+            return hmac.compare_digest(signature, params.get("signature", "")) and hmac.compare_digest(digest, self.headers.get("Digest", ""))
+
+        def log_message(self, format: string, *args) -> None:
+            self.check.log.debug(format % args)
+
+    return WebhookHandler
+
+
+@functools.cache
+def get_drone_http_adapter_class() -> type:
+    import weakref
+
+    from requests.adapters import HTTPAdapter
+    from urllib3.connection import HTTPConnection
+
+    class DroneHTTPAdapter(HTTPAdapter):
+        def __init__(self, keepalive: int, **kwargs):
+            self.keepalive = keepalive
+            self.lock = threading.Lock()
+            self.sockets = weakref.WeakSet()
+            self.connections_opened = 0
+            self.requests_sent = 0
+            super().__init__(**kwargs)
 
-import requests
+        def init_poolmanager(self, *args, **kwargs) -> None:
+            if self.keepalive:
+                kwargs["socket_options"] = list(HTTPConnection.default_socket_options) + get_keepalive_socket_options(self.keepalive)
+            super().init_poolmanager(*args, **kwargs)
+
+        def build_response(self, req, resp) -> requests.Response:
+            # a socket that has not been seen before means a new connection was opened for this request,
+            # no socket means the server closed it right after responding, which is mostly when keepalive is disabled
+            sock = getattr(resp.connection, "sock", None)
+            with self.lock:
+                self.requests_sent += 1
+                if sock is None or sock not in self.sockets:
+                    if sock is not None:
+                        self.sockets.add(sock)
+                    self.connections_opened += 1
+            return super().build_response(req, resp)
+
+        def get_connection_stats(self) -> tuple[int, int]:
+            with self.lock:
+                return self.connections_opened, self.requests_sent - self.connections_opened
+
+    return DroneHTTPAdapter
+
+
+class StdlibResponse:
+    # the part of requests.Response the check uses
+    def __init__(self, response: http.client.HTTPResponse, release: callable):
+        self.raw = response
+        self.status_code = response.status
+        self.headers = response.headers
+        self.release = release
+        self.decompressor = zlib.decompressobj(wbits=31) if response.headers.get("Content-Encoding", "").lower() == "gzip" else None
+        self._content = None
+
+    @property
+    def content(self) -> bytes:
+        if self._content is None:
+            self._content = b"".join(self.iter_content(65536))
+        return self._content
+
+    @property
+    def text(self) -> str:
+        return self.content.decode("utf-8", "replace")
+
+    def json(self) -> object:
+        return json.loads(self.content)
+
+    def iter_content(self, chunk_size: int) -> Iterator[bytes]:
+        try:
+            while chunk := self.raw.read1(chunk_size):
+                yield self.decompressor.decompress(chunk) if self.decompressor else chunk
+            self.raw.read() # read1() leaves a response with a Content-Length open at its end, this closes it so the connection can be reused
+        except BaseException:
+            self.release(False)
+            raise
+        if self.decompressor:
+            yield self.decompressor.flush()
+        self.release(True)
+
+    def close(self) -> None:
+        self.release(False)
+
+
+class StdlibSession:
+    # the part of requests.Session the check uses, on http.client, which imports a lot faster
+    def __init__(self, headers: dict, pool_size: int, keepalive: int):
+        self.headers = {"Accept-Encoding": "gzip"} | headers
+        self.keepalive = keepalive
+        self.semaphore = threading.BoundedSemaphore(pool_size)
+        self.lock = threading.Lock()
+        self.idle_connections = {}
+        self.ssl_context = None
+        self.connections_opened = 0
+        self.requests_sent = 0
+
+    def get(self, url: str, headers: dict | None = None, timeout: tuple = (10, 30), stream: bool = False) -> StdlibResponse:
+        import http.client
+
+        parts = urlsplit(url)
+        target = f"{parts.path or '/'}{'?' if parts.query else ''}{parts.query}"
+        self.semaphore.acquire() # blocks like pool_block does for requests
+        try:
+            while True:
+                connection, reused = self.get_connection(parts, *timeout)
+                try:
+                    connection.request("GET", target, headers=self.headers | (headers or {}))
+                    response = connection.getresponse()
+                    break
+                except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                    connection.close()
+                    if not reused:
+                        raise
+                    # the server closed the idle connection in the meantime, try again on a new one
+                except BaseException:
+                    connection.close()
+                    raise
+        except BaseException:
+            self.semaphore.release()
+            raise
+
+        with self.lock:
+            self.requests_sent += 1
+        released = []
+
+        def release(reusable: bool) -> None:
+            if released:
+                return
+            released.append(True)
+            # http.client already let go of the socket when the server is going to close it
+            if reusable and self.keepalive and connection.sock is not None:
+                with self.lock:
+                    self.idle_connections.setdefault((parts.scheme, parts.netloc), []).append(connection)
+            else:
+                connection.close()
+            self.semaphore.release()
+
+        response = StdlibResponse(response, release)
+        if not stream:
+            response.content
+        return response
+
+    def get_connection(self, parts, connect_timeout: float, read_timeout: float) -> tuple[http.client.HTTPConnection, bool]:
+        import http.client
+
+        with self.lock:
+            idle = self.idle_connections.get((parts.scheme, parts.netloc))
+            connection = idle.pop() if idle else None
+        if connection:
+            # the timeouts of this request, e.g. the time that is left before the deadline, not those it was opened with
+            connection.timeout = connect_timeout
+            if connection.sock:
+                connection.sock.settimeout(read_timeout)
+            return connection, True
+
+        if parts.scheme == "https":
+            if self.ssl_context is None:
+                import ssl
+                self.ssl_context = ssl.create_default_context()
+            connection = http.client.HTTPSConnection(parts.hostname, parts.port, timeout=connect_timeout, context=self.ssl_context)
+        else:
+            connection = http.client.HTTPConnection(parts.hostname, parts.port, timeout=connect_timeout)
+        connection.connect()
+        connection.sock.settimeout(read_timeout)
+        for option in [(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)] + get_keepalive_socket_options(self.keepalive):
+            connection.sock.setsockopt(*option)
+        with self.lock:
+            self.connections_opened += 1
+        return connection, False
+
+    def get_connection_stats(self) -> tuple[int, int]:
+        with self.lock:
+            return self.connections_opened, self.requests_sent - self.connections_opened
 
 
 class CheckDroneBuilds:
-    def __init__(self, server: str, token: str, namespace: str, warning: int, critical: int, verbose: bool = False):
+    def __init__(self, server: str, token: str, namespace: str, warning: int, critical: int, verbose: bool = False,
+                 concurrency: int = 1, engine: str = "threads", transport: str = "requests", pool_size: int | None = None, keepalive: int = 60,
+                 connect_timeout: float = 10, read_timeout: float = 30, latest: bool = False, state_file: str | None = None,
+                 cache_dir: str | None = None, cache_size: int = 100, cache_purge: bool = False, per_page: int = 25,
+                 max_pages: int = 10, stream: bool = False, perfdata_ages: bool = False, webhooks: bool = False,
+                 max_age: int = 300, repos_ttl: int = 0, deadline: float = 0, branches: list | None = None, events: list | None = None,
+                 shard: str | None = None, rules: list | None = None, metrics_file: str | None = None, record_dir: str | None = None,
+                 replay_dir: str | None = None, retries: int = 2, retry_backoff: float = 1):
         self.server = server
+        # the scheme can be given explicitly, e.g. to run against a plain http server when testing
+        self.base_url = server if "://" in server else f"https://{server}"
         self.token = token
         self.namespace = namespace
         self.critical = critical
         self.warning = warning
+        self.rules = ThresholdRules(rules or [], warning, critical)
+        self.concurrency = max(1, concurrency)
+        self.engine = engine
+        self.transport = transport
+        self.keepalive = keepalive
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.latest = latest
+        self.per_page = min(max(1, per_page), 100)
+        self.max_pages = max(1, max_pages)
+        self.repos_ttl = repos_ttl
+        self.deadline = deadline
+        self.branches = branches or []
+        self.branch_refs = {f"refs/heads/{branch}" for branch in self.branches}
+        self.events = events or []
+        self.shard = parse_shard(shard) if shard else None
+        self.deadline_time = None
+        self.unreached = set()
+        self.retries = max(0, retries)
+        self.retry_backoff = retry_backoff
+        self.failed = {}
+        self.repo_errors = set()
+        self.retried = 0
+        self.stream = stream
+        self.perfdata_ages = perfdata_ages
+        self.collecting = False
+        self.perfdata = {}
+        self.start_time = None
+        self.metrics_lock = threading.Lock()
+        self.request_count = 0
+        self.bytes_received = 0
+        self.build_latencies = []
+        self.state_file = state_file
+        self.state = {}
+        # the last successful build depends on the builds that count, so a filtered check keeps its own part of the state
+        filters = "".join(f" {name}={','.join(sorted(values))}" for name, values in [("branch", self.branches), ("event", self.events)] if values)
+        self.state_section = f"repos{filters}"
+        self.listener_key = f"listener{filters}"
+        self.other_sections = {}
+        self.listener_time = 0
+        self.webhooks = webhooks
+        self.max_age = max_age
+        self.webhook_builds = {}
+        self.webhook_lock = threading.Lock()
+        self.build_numbers = {}
+        self.renumbered = set()
+        self.metrics_file = metrics_file
+        self.latest_statuses = {}
+        self.builds_scanned = {}
+        self.recording = Recording(replay_dir, replay=True) if replay_dir else Recording(record_dir) if record_dir else None
+        self.pool_size = pool_size or max(10, self.concurrency)
+        self.idle_connections = []
+        self.async_connections_opened = 0
+        self.async_connections_reused = 0
+        self.ssl_context = None
 
         log = logging.getLogger(__name__)
-        stream = logging.StreamHandler()
         level = logging.DEBUG if verbose else logging.CRITICAL
         log.setLevel(level)
-        stream.setLevel(level)
-        log.addHandler(stream)
+        if not log.handlers: # there is one instance per server when checking several
+            stream = logging.StreamHandler()
+            log.addHandler(stream)
+        for handler in log.handlers:
+            handler.setLevel(level)
         
         self.log = log
 
+        self.cache = ResponseCache(cache_dir, cache_size * 1024 * 1024, token) if cache_dir else None
+        if self.cache and cache_purge:
+            try:
+                self.cache.purge()
+            except Exception as e:
+                self.log.exception(str(e))
+
     def check_builds(self) -> None:
+        self.report_builds(*self.collect_builds())
+
+    def collect_builds(self) -> tuple[list, dict]:
+        self.start_time = time.perf_counter()
+        self.deadline_time = self.start_time + self.deadline if self.deadline else None
+        self.unreached = set()
+        self.failed = {}
+        self.repo_errors = set()
+        self.retried = 0
+        self.latest_statuses = {}
+        self.builds_scanned = {}
+        self.renumbered = set()
+        if self.recording and not self.recording.replay:
+            self.recording.start(self.get_current_time(), self.server)
+        with self.metrics_lock:
+            self.request_count = 0
+            self.bytes_received = 0
+            self.build_latencies = []
         try:
             repos = self.get_all_repos()
         except Exception as e:
             self.log.exception(str(e))
             self.nagios_exit("CRITICAL", f"Error retrieving repos: {str(e)}")
+        finally:
+            self.perfdata["repos_time"] = f"{time.perf_counter() - self.start_time:.3f}s"
 
-        successful = []
-        warning = []
-        critical = []
-        unknown = []
+        if self.state_file:
+            self.state = self.read_state()
+        # the webhook listener hears about every new success, so as long as it is running, what it stored is the last success
+        listening = self.webhooks and self.listener_time >= self.get_current_time() - self.max_age
+        if self.webhooks and not listening:
+            self.log.warning("The webhook listener has not updated the state file recently, polling all repos")
 
+        active_repos = []
+        last_successful_builds = {}
+        priorities = {}
         for repo in repos:
             try:
                 owner = repo.get("namespace")
                 name = repo.get("name")
                 slug = repo.get("slug")
                 active = repo.get("active")
+                latest_build = repo.get("build") if self.latest else None
                 if self.namespace and owner != self.namespace:
                     continue
                 if not active:
                     continue # these repos are not setup to run any builds
+                if not self.in_shard(slug):
+                    continue
             except Exception as e:
                 self.log.exception(str(e))
-                self.log.debug(json.dumps(repo))
+                self.log.debug(repr(repo))
                 self.nagios_exit("CRITICAL", f"Repo API response missing expected data: {str(e)}")
+            active_repos.append((owner, name, slug))
+            if isinstance(latest_build, (dict, Build)) and self.is_relevant_build(latest_build):
+                self.latest_statuses[slug] = latest_build.get("status")
 
-            last_successful_build = 0
+            # when the latest build succeeded recently enough, the last successful build can only be the same or newer,
+            # so the repo is OK and there is no need to fetch its builds
+            if isinstance(latest_build, (dict, Build)) and latest_build.get("status") == "success" and self.is_relevant_build(latest_build):
+                finished = latest_build.get("finished")
+                if isinstance(finished, int) and self.get_build_status(finished, slug) == "OK":
+                    last_successful_builds[slug] = finished
 
-            try:
-                builds = self.get_builds_for_repo(owner, name)
-                if not builds:
-                    unknown.append(slug)
-                    self.log.debug(f"No builds found for {slug}, adding to unknown list")
-                    continue
-                for build in builds:
-                    if build.get("status") == "success":
-                        if build.get("finished") > last_successful_build:
-                            last_successful_build = build.get("finished")
+            # same goes for the last successful build we stored before, it can only have moved forward since
+            self.check_renumbered(slug, [latest_build])
+            stored = self.get_state(slug, "last_successful_build")
+            if slug not in last_successful_builds and stored and (listening or self.get_build_status(stored, slug) == "OK"):
+                last_successful_builds[slug] = stored
 
+            # repos whose latest build failed, and then those that succeeded longest ago (or never), are the most likely to be failing
+            latest_failed = isinstance(latest_build, (dict, Build)) and latest_build.get("status") in ["failure", "error", "killed"] and self.is_relevant_build(latest_build)
+            priorities[slug] = (not latest_failed, stored or 0)
+
+        repos_to_fetch = [repo for repo in active_repos if repo[2] not in last_successful_builds]
+        if self.deadline:
+            # what isn't fetched before the deadline is UNKNOWN, so those that are probably failing go first
+            repos_to_fetch.sort(key=lambda repo: priorities[repo[2]])
+        self.log.debug(f"Fetching builds for {len(repos_to_fetch)} of {len(active_repos)} repos")
+        last_successful_builds.update(zip([slug for _, _, slug in repos_to_fetch], self.get_last_successful_builds(repos_to_fetch)))
+        self.retry_failed_repos(repos_to_fetch, last_successful_builds)
+        self.add_perfdata(active_repos, repos_to_fetch)
+
+        if self.state_file:
+            try:
+                self.write_state(last_successful_builds)
             except Exception as e:
                 self.log.exception(str(e))
+        if self.metrics_file:
+            try:
+                write_file_atomic(self.metrics_file, format_metrics(self.get_metrics(active_repos, last_successful_builds)))
+            except Exception as e:
+                self.log.exception(str(e))
+        if self.cache:
+            try:
+                self.cache.evict()
+            except Exception as e:
+                self.log.exception(str(e))
+
+        opened, reused = self.get_connection_stats()
+        self.log.debug(f"Connections opened: {opened}, reused: {reused}")
+        return active_repos, last_successful_builds
+
+    def report_builds(self, active_repos: list, last_successful_builds: dict) -> NoReturn:
+        self.nagios_exit(*self.get_verdict(active_repos, last_successful_builds))
+
+    def get_verdict(self, active_repos: list, last_successful_builds: dict) -> tuple[string, string]:
+        status, message = self.get_builds_verdict(active_repos, last_successful_builds)
+        return status, self.label_shard(message)
+
+    def get_builds_verdict(self, active_repos: list, last_successful_builds: dict) -> tuple[string, string]:
+        if self.perfdata_ages:
+            for _, _, slug in active_repos:
+                self.perfdata[f"{slug} age"] = self.get_age_perfdata(last_successful_builds[slug], slug)
+
+        successful = []
+        warning = []
+        critical = []
+        unknown = []
+        unreached = []
+        failed = []
+        statuses = {"OK": successful, "WARNING": warning, "CRITICAL": critical}
+
+        for owner, name, slug in active_repos:
+            last_successful_build = last_successful_builds[slug]
+            if slug in self.unreached:
+                unreached.append(slug)
+                continue
+            if slug in self.failed:
+                failed.append(f"{slug} ({self.failed[slug]})")
+                continue
+            if last_successful_build is None:
                 unknown.append(slug)
                 continue
 
-            last_successful_build_string = f"{slug} - last succeeded: {self.time_ago(last_successful_build)}"
-            warning_threshold = self.get_current_time() - self.warning
-            critical_threshold = self.get_current_time() - self.critical
-            self.log.debug(f"{slug} - Warning: {warning_threshold} - Critical: {critical_threshold} - Actual: {last_successful_build}")
-            if warning_threshold <= last_successful_build != 0 and critical_threshold <= last_successful_build:
-                successful.append(last_successful_build_string)
-            elif critical_threshold > last_successful_build or last_successful_build == 0:
-                critical.append(last_successful_build_string)
-            elif warning_threshold > last_successful_build:
-                warning.append(last_successful_build_string)
+            warning_time, critical_time = self.rules.get(slug)
+            self.log.debug(f"{slug} - Warning: {self.get_current_time() - warning_time} - Critical: {self.get_current_time() - critical_time} - Actual: {last_successful_build}")
+            statuses[self.get_build_status(last_successful_build, slug)].append(f"{slug} - last succeeded: {self.time_ago(last_successful_build)}")
 
+        # the verdicts that were found are still reported, the repos that weren't reached or kept failing are listed after them
+        notes = []
+        if unreached:
+            notes.append(f"Not checked before the deadline: {', '.join(unreached)}")
+        if failed:
+            notes.append(f"Error fetching builds: {', '.join(failed)}")
+        suffix = "".join(f"; {note}" for note in notes)
         if critical:
-            self.nagios_exit("CRITICAL", f"Failing build(s): {', '.join(critical)}")
+            return "CRITICAL", f"Failing build(s): {', '.join(critical)}{suffix}"
         elif warning:
-            self.nagios_exit("WARNING", f"Failing build(s): {', '.join(warning)}")
+            return "WARNING", f"Failing build(s): {', '.join(warning)}{suffix}"
         elif unknown:
-            self.nagios_exit("UNKNOWN", f"Unknown build status: {', '.join(unknown)}")
+            return "UNKNOWN", f"Unknown build status: {', '.join(unknown)}{suffix}"
+        elif notes:
+            return "UNKNOWN", "; ".join(notes)
         elif successful:
-            self.nagios_exit("OK", ', '.join(successful))
+            return "OK", ', '.join(successful)
         else:
-            self.nagios_exit("UNKNOWN", "No repos/builds found")
+            return "UNKNOWN", "No repos/builds found"
 
-    def get_all_repos(self) -> list:
+    def get_server_verdict(self) -> tuple[string, string]:
+        # runs on its own thread when checking several servers, so nagios_exit raises NagiosExit instead of exiting
+        try:
+            return self.get_verdict(*self.collect_builds())
+        except NagiosExit as e:
+            return e.status, e.message
+        except Exception as e:
+            self.log.exception(str(e))
+            return "UNKNOWN", f"Error checking builds: {str(e)}"
+        finally:
+            # the runtime of this server, not of all of them
+            self.perfdata = self.get_perfdata_values()
+            self.start_time = None
+
+    def check_builds_passive(self, host: string, service: string, icinga_api: str | None = None, icinga_user: str | None = None,
+                             icinga_password: str | None = None, icinga_ca: str | None = None, command_file: str | None = None) -> NoReturn:
+        # one sweep, submitted as a passive check result per repo, this check itself only reports whether that worked
+        active_repos, last_successful_builds = self.collect_builds()
+        results = []
+        for owner, name, slug in active_repos:
+            last_successful_build = last_successful_builds[slug]
+            if slug in self.unreached:
+                status, output = "UNKNOWN", f"{slug} - Not checked before the deadline"
+            elif slug in self.failed:
+                status, output = "UNKNOWN", f"{slug} - Error fetching builds: {self.failed[slug]}"
+            elif last_successful_build is None:
+                status, output = "UNKNOWN", f"{slug} - Unknown build status"
+            else:
+                status, output = self.get_build_status(last_successful_build, slug), f"{slug} - last succeeded: {self.time_ago(last_successful_build)}"
+            results.append((service.format(namespace=owner, name=name, slug=slug), status, output, f"age={self.get_age_perfdata(last_successful_build, slug)}"))
+        if not results:
+            self.nagios_exit("UNKNOWN", self.label_shard("No repos/builds found"))
+
+        try:
+            if icinga_api:
+                errors = self.submit_icinga_api(results, host, icinga_api, (icinga_user, icinga_password), icinga_ca or True)
+            else:
+                errors = self.submit_command_file(results, host, command_file)
+        except Exception as e:
+            self.log.exception(str(e))
+            self.nagios_exit("UNKNOWN", f"Error submitting passive check results: {str(e)}")
+        if errors:
+            self.nagios_exit("UNKNOWN", f"Error submitting {len(errors)} of {len(results)} passive check results: {', '.join(errors)}")
+
+        counts = ", ".join(f"{sum(result[1] == status for result in results)} {status}" for status in EXIT_CODES)
+        self.nagios_exit("OK", self.label_shard(f"Submitted {len(results)} passive check results: {counts}"))
+
+    def submit_icinga_api(self, results: list, host: string, url: string, auth: tuple, verify: bool | str) -> list:
+        # the API takes one result per request, they share the connections of one session
+        from concurrent.futures import ThreadPoolExecutor
+
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        session = requests.Session()
+        session.auth = auth
+        session.verify = verify
+        session.headers["Accept"] = "application/json"
+        adapter = HTTPAdapter(pool_maxsize=self.concurrency, pool_block=True)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+
+        def submit(result: tuple) -> str | None:
+            service, status, output, perfdata = result
+            response = session.post(f"{url.rstrip('/')}/v1/actions/process-check-result", json={
+                "type": "Service",
+                "service": f"{host}!{service}",
+                "exit_status": EXIT_CODES[status],
+                "plugin_output": output,
+                "performance_data": [perfdata],
+            }, timeout=(self.connect_timeout, self.read_timeout))
+            if response.status_code != 200:
+                self.log.debug(response.text)
+                return f"{service} (HTTP {response.status_code})"
+            return None
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            return [error for error in executor.map(submit, results) if error]
+
+    def submit_command_file(self, results: list, host: string, command_file: string) -> list:
+        # the pipe only writes up to PIPE_BUF bytes at once, so the lines are written in chunks of whole lines below that,
+        # and the results of other writers can't end up in the middle of a line
+        import select
+
+        pipe_buf = getattr(select, "PIPE_BUF", 512)
+        now = self.get_current_time()
+        chunks = [b""]
+        for service, status, output, perfdata in results:
+            line = f"[{now}] PROCESS_SERVICE_CHECK_RESULT;{host};{service};{EXIT_CODES[status]};{output}|{perfdata}\n".encode()
+            if chunks[-1] and len(chunks[-1]) + len(line) > pipe_buf:
+                chunks.append(b"")
+            chunks[-1] += line
+        with open(command_file, "ab", buffering=0) as f:
+            for chunk in chunks:
+                written = 0
+                while written < len(chunk):
+                    written += f.write(chunk[written:])
+        return []
+
+    def get_age_perfdata(self, last_successful_build: int | None, slug: str | None = None) -> string:
+        age = f"{self.get_current_time() - last_successful_build}s" if last_successful_build else "U"
+        warning, critical = self.rules.get(slug) if slug else (self.warning, self.critical)
+        return f"{age};{warning};{critical};0"
+
+    def record_request(self, seconds: float | None, size: int) -> None:
+        # seconds is only given for the builds requests, their latency is reported separately
+        with self.metrics_lock:
+            self.request_count += 1
+            self.bytes_received += size
+            if seconds is not None:
+                self.build_latencies.append(seconds)
+
+    def add_perfdata(self, active_repos: list, repos_to_fetch: list) -> None:
+        with self.metrics_lock:
+            latencies = sorted(self.build_latencies)
+            self.perfdata["fetch_time"] = f"{sum(latencies):.3f}s"
+            self.perfdata["fetch_p95"] = f"{latencies[math.ceil(len(latencies) * 0.95) - 1] if latencies else 0:.3f}s"
+            self.perfdata["requests"] = str(self.request_count)
+            self.perfdata["bytes"] = f"{self.bytes_received}B"
+        self.perfdata["repos_checked"] = str(len(active_repos))
+        self.perfdata["repos_skipped"] = str(len(active_repos) - len(repos_to_fetch))
+        if self.deadline:
+            self.perfdata["repos_unreached"] = str(len(self.unreached))
+        if self.retried:
+            self.perfdata["repos_retried"] = str(self.retried)
+            self.perfdata["repos_failed"] = str(len(self.failed))
+
+    def get_metrics(self, active_repos: list, last_successful_builds: dict) -> list:
+        samples = []
+        for owner, name, slug in active_repos:
+            labels = {"server": self.server, "namespace": owner, "name": name, "slug": slug}
+            last_successful_build = last_successful_builds[slug]
+            if slug in self.unreached or slug in self.failed or last_successful_build is None:
+                status = "UNKNOWN"
+            else:
+                status = self.get_build_status(last_successful_build, slug)
+            if last_successful_build:
+                samples.append(("drone_repo_last_success_timestamp_seconds", labels, last_successful_build))
+            if self.latest_statuses.get(slug):
+                samples.append(("drone_repo_latest_build_status", labels | {"status": self.latest_statuses[slug]}, 1))
+            samples.append(("drone_repo_builds_scanned", labels, self.builds_scanned.get(slug, 0)))
+            samples.append(("drone_repo_check_status", labels, EXIT_CODES[status]))
+
+        labels = {"server": self.server}
+        with self.metrics_lock:
+            samples += [
+                ("drone_check_timestamp_seconds", labels, self.get_current_time()),
+                ("drone_check_duration_seconds", labels, round(time.perf_counter() - self.start_time, 6)),
+                ("drone_check_fetch_seconds", labels, round(sum(self.build_latencies), 6)),
+                ("drone_check_requests", labels, self.request_count),
+                ("drone_check_received_bytes", labels, self.bytes_received),
+            ]
+        skipped = int(self.perfdata["repos_skipped"])
+        fetched = len(active_repos) - skipped - len(self.unreached) - len(self.failed)
+        for state, count in [("fetched", fetched), ("skipped", skipped), ("unreached", len(self.unreached)), ("failed", len(self.failed))]:
+            samples.append(("drone_check_repos", labels | {"state": state}, count))
+        return samples
+
+    def get_perfdata(self) -> string:
+        return format_perfdata(self.get_perfdata_values())
+
+    def get_perfdata_values(self) -> dict:
+        if self.start_time is None:
+            return dict(self.perfdata)
+        return {"time": f"{time.perf_counter() - self.start_time:.3f}s"} | self.perfdata
+
+    def run_collector(self, snapshot_file: string, interval: int) -> NoReturn:
+        # keeps the same session (and its connections), state and cache between sweeps
+        while True:
+            started = time.monotonic()
+            self.write_snapshot(snapshot_file)
+            time.sleep(max(0.0, interval - (time.monotonic() - started)))
+
+    def write_snapshot(self, snapshot_file: string) -> None:
+        # a failed sweep is stored as well, so the checks reading the snapshot report it instead of the collector exiting
+        self.collecting = True
+        try:
+            active_repos, last_successful_builds = self.collect_builds()
+            snapshot = {"time": self.get_current_time(), "repos": {slug: last_successful_builds[slug] for _, _, slug in active_repos}}
+        except NagiosExit as e:
+            self.log.error(f"{e.status} - {e.message}")
+            snapshot = {"time": self.get_current_time(), "status": e.status, "message": e.message}
+        except Exception as e:
+            self.log.exception(str(e))
+            snapshot = {"time": self.get_current_time(), "status": "UNKNOWN", "message": f"Error collecting builds: {str(e)}"}
+        finally:
+            self.collecting = False
+
+        try:
+            write_file_atomic(snapshot_file, json.dumps(snapshot, separators=(",", ":")))
+        except Exception as e:
+            self.log.exception(str(e))
+
+    def check_snapshot(self, snapshot_file: string, max_age: int) -> NoReturn:
+        self.start_time = time.perf_counter()
+        try:
+            with open(snapshot_file) as f:
+                snapshot = json.load(f)
+            collected = snapshot["time"]
+            repos = snapshot.get("repos", {})
+            assert isinstance(collected, int) and isinstance(repos, dict), "Snapshot is missing expected data"
+        except Exception as e:
+            self.log.exception(str(e))
+            self.nagios_exit("UNKNOWN", f"Error reading snapshot {snapshot_file}: {str(e)}")
+
+        age = self.get_current_time() - collected
+        self.perfdata["snapshot_age"] = f"{age}s;;{max_age};0"
+        if age > max_age:
+            self.nagios_exit("UNKNOWN", f"Snapshot {snapshot_file} is too old, last collected {self.time_ago(collected)}")
+        if snapshot.get("status") in ["OK", "WARNING", "CRITICAL", "UNKNOWN"]:
+            self.nagios_exit(snapshot["status"], snapshot.get("message", ""))
+
+        active_repos = []
+        for slug in repos:
+            owner, _, name = slug.partition("/")
+            if (not self.namespace or owner == self.namespace) and self.in_shard(slug):
+                active_repos.append((owner, name, slug))
+        self.report_builds(active_repos, repos)
+
+    def create_listener(self, address: string, secret: string) -> ThreadingHTTPServer:
+        from http.server import ThreadingHTTPServer
+
+        host, _, port = address.rpartition(":")
+        handler = type("Handler", (get_webhook_handler_class(),), {"check": self, "secret": secret.encode()})
+        return ThreadingHTTPServer((host, int(port)), handler)
+
+    def run_listener(self, address: string, secret: string, flush_interval: int) -> NoReturn:
+        # events are handled on the server's threads, the state file is written from here
+        server = self.create_listener(address, secret)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.log.debug(f"Listening for webhooks on {server.server_address[0]}:{server.server_address[1]}")
+        while True:
+            self.flush_webhook_builds()
+            time.sleep(flush_interval)
+
+    def record_webhook_event(self, event: dict) -> None:
+        if event.get("event") != "build":
+            return
+        slug = event["repo"]["slug"]
+        build = event["build"]
+        self.log.debug(f"{slug} - build #{build.get('number')} {build.get('status')}")
+        if build.get("status") == "success" and isinstance(build.get("finished"), int) and build["finished"] and self.is_relevant_build(build):
+            with self.webhook_lock:
+                self.webhook_builds[slug] = max(build["finished"], self.webhook_builds.get(slug, 0))
+
+    def flush_webhook_builds(self) -> None:
+        # also written when nothing happened, so the checks know the listener is still running
+        with self.webhook_lock:
+            webhook_builds = dict(self.webhook_builds)
+        try:
+            self.write_state(webhook_builds, self.get_current_time())
+        except Exception as e:
+            self.log.exception(str(e))
+
+    def get_build_status(self, last_successful_build: int, slug: str | None = None) -> string:
+        # without a slug, the thresholds of the command line
+        warning, critical = self.rules.get(slug) if slug else (self.warning, self.critical)
+        warning_threshold = self.get_current_time() - warning
+        critical_threshold = self.get_current_time() - critical
+        if warning_threshold <= last_successful_build != 0 and critical_threshold <= last_successful_build:
+            return "OK"
+        elif critical_threshold > last_successful_build or last_successful_build == 0:
+            return "CRITICAL"
+        return "WARNING"
+
+    def get_last_successful_builds(self, repos: list) -> list:
+        # results are returned in the same order as the given repos, regardless of the order they complete in
+        if self.engine == "asyncio":
+            return self.get_last_successful_builds_async(repos)
+        if self.concurrency == 1 or len(repos) <= 1:
+            return [self.get_last_successful_build(owner, name, slug) for owner, name, slug in repos]
+
+        from concurrent.futures import ThreadPoolExecutor, wait
+
+        executor = ThreadPoolExecutor(max_workers=min(self.concurrency, len(repos)))
+        try:
+            futures = [executor.submit(self.get_last_successful_build, *repo) for repo in repos]
+            if self.deadline:
+                # the requests of the workers time out at the deadline as well, but there is no need to wait for that
+                wait(futures, timeout=max(0.0, self.get_time_left()))
+            results = []
+            for (owner, name, slug), future in zip(repos, futures):
+                if self.deadline and not future.done():
+                    self.unreached.add(slug)
+                    results.append(None)
+                else:
+                    results.append(future.result())
+            return results
+        except NagiosExit as e:
+            self.nagios_exit(e.status, e.message)
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def get_last_successful_builds_async(self, repos: list) -> list:
+        # the event loop gets its own thread, so nagios_exit raises NagiosExit inside the coroutines
+        # instead of exiting halfway through the sweep, the first one (in repo order) is handled here
+        import asyncio
+        from concurrent.futures import ThreadPoolExecutor
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            results = executor.submit(asyncio.run, self.gather_last_successful_builds(repos)).result()
+
+        for result in results:
+            if isinstance(result, NagiosExit):
+                self.nagios_exit(result.status, result.message)
+        return results
+
+    async def gather_last_successful_builds(self, repos: list) -> list:
+        import asyncio
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+        # connections are kept open between requests, like the requests session does for the threaded engine
+        self.idle_connections = []
+        try:
+            tasks = [asyncio.ensure_future(self.get_last_successful_build_async(owner, name, slug, semaphore)) for owner, name, slug in repos]
+            if not self.deadline or not tasks:
+                return await asyncio.gather(*tasks, return_exceptions=True)
+
+            done, pending = await asyncio.wait(tasks, timeout=max(0.0, self.get_time_left()))
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            results = []
+            for (owner, name, slug), task in zip(repos, tasks):
+                if task in pending:
+                    self.unreached.add(slug)
+                    results.append(None)
+                else:
+                    results.append(task.exception() or task.result())
+            return results
+        finally:
+            for reader, writer in self.idle_connections:
+                writer.close()
+            self.idle_connections = []
+
+    async def get_last_successful_build_async(self, owner: string, name: string, slug: string, semaphore: asyncio.Semaphore) -> int | None:
+        builds = []
+        try:
+            page = 1
+            while True:
+                async with semaphore:
+                    page_builds = await self.get_builds_for_repo_async(owner, name, page)
+                builds += page_builds
+                if self.is_last_page(slug, page, page_builds):
+                    break
+                page += 1
+        except Exception as e:
+            return self.handle_fetch_error(slug, e)
+
+        return self.find_last_successful_build(slug, builds)
+
+    async def get_builds_for_repo_async(self, owner: string, repo: string, page: int = 1) -> list | None:
+        url = self.get_builds_url(owner, repo, page)
+        cached = self.cache.get(url) if self.cache else None
+        stream = BuildStream(self.get_state(f"{owner}/{repo}", "build_number"), self.is_relevant_build) if self.stream else None
+        started = time.perf_counter()
+        status_code, content, headers = await self.http_get_async(url.removeprefix(self.base_url), ResponseCache.get_conditional_headers(cached), stream)
+        self.record_request(time.perf_counter() - started, len(content) + (stream.size if stream else 0))
+        if status_code == 304 and cached:
+            return cached[1]
+
+        if stream and status_code == 200:
+            builds = self.get_streamed_builds(owner, repo, stream)
+        else:
+            builds = self.parse_builds(owner, repo, status_code, content)
+        # a stream stopped early only has the newest builds, while the validators are those of all of them
+        if self.cache and (not stream or stream.complete):
+            self.store_response(url, headers.get("etag"), headers.get("last-modified"), builds)
+        return builds
+
+    async def http_get_async(self, path: string, headers: dict | None = None, stream: BuildStream | None = None) -> tuple[int, bytes, dict]:
+        if not self.recording:
+            return await self.request_async(path, headers, stream)
+
+        # same as RecordingSession, the whole response is recorded, a stream is fed from it afterwards
+        if self.recording.replay:
+            status_code, response_headers, content = self.recording.load(path)
+        else:
+            started = time.time()
+            status_code, content, response_headers = await self.request_async(path, headers)
+            self.recording.store(path, headers or {}, status_code, response_headers, content, started, time.time() - started)
+        if stream and status_code == 200:
+            stream.feed(content, final=True)
+            return status_code, b"", response_headers
+        return status_code, content, response_headers
+
+    async def request_async(self, path: string, headers: dict | None = None, stream: BuildStream | None = None) -> tuple[int, bytes, dict]:
+        import asyncio
+
+        url = urlsplit(self.base_url)
+        while True:
+            reused = bool(self.idle_connections)
+            connect_timeout, read_timeout = self.get_request_timeouts()
+            if reused:
+                reader, writer = self.idle_connections.pop()
+            else:
+                reader, writer = await asyncio.wait_for(self.open_connection_async(url), connect_timeout)
+                self.async_connections_opened += 1
+
+            try:
+                response = await asyncio.wait_for(self.send_request_async(url, path, headers or {}, stream, reader, writer), read_timeout)
+            except BaseException:
+                writer.close()
+                raise
+
+            if response is None:
+                writer.close()
+                if reused:
+                    continue # the server closed the idle connection in the meantime, try again on a new one
+                raise ConnectionError(f"Drone API closed the connection without responding to {path}")
+
+            status_code, content, response_headers, keep_alive = response
+            if reused:
+                self.async_connections_reused += 1
+            if keep_alive:
+                self.idle_connections.append((reader, writer))
+            else:
+                writer.close()
+            return status_code, content, response_headers
+
+    async def open_connection_async(self, url) -> tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        import asyncio
+
+        if url.scheme == "https":
+            if self.ssl_context is None:
+                import ssl
+                self.ssl_context = ssl.create_default_context()
+            return await asyncio.open_connection(url.hostname, url.port or 443, ssl=self.ssl_context)
+        return await asyncio.open_connection(url.hostname, url.port or 80)
+
+    async def send_request_async(self, url, path: string, request_headers: dict, stream: BuildStream | None, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> tuple[int, bytes, dict, bool] | None:
+        writer.write((
+            f"GET {url.path.rstrip('/')}{path} HTTP/1.1\r\n"
+            f"Host: {url.netloc}\r\n"
+            f"Authorization: Bearer {self.token}\r\n"
+            "Accept: application/json\r\n"
+            + "".join(f"{key}: {value}\r\n" for key, value in request_headers.items())
+            + f"Connection: {'keep-alive' if self.keepalive else 'close'}\r\n\r\n"
+        ).encode())
+        await writer.drain()
+
+        status_line = await reader.readline()
+        if not status_line:
+            return None
+        status_code = int(status_line.split()[1])
+        headers = {}
+        while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+            key, _, value = line.decode("latin-1").partition(":")
+            headers[key.strip().lower()] = value.strip()
+
+        keep_alive = bool(self.keepalive) and status_line.startswith(b"HTTP/1.1") and headers.get("connection", "").lower() != "close"
+        if headers.get("transfer-encoding", "").lower() != "chunked" and "content-length" not in headers:
+            keep_alive = False # the body ends when the connection does
+
+        content = bytearray()
+        body = self.iter_body_async(reader, status_code, headers)
+        async for chunk in body:
+            if stream and status_code == 200:
+                if stream.feed(chunk):
+                    keep_alive = False # the rest of the body is not read, so the connection can't be used again
+                    await body.aclose()
+                    break
+            else:
+                content += chunk
+        else:
+            if stream and status_code == 200:
+                stream.feed(b"", final=True)
+
+        return status_code, bytes(content), headers, keep_alive
+
+    async def iter_body_async(self, reader: asyncio.StreamReader, status_code: int, headers: dict) -> AsyncIterator[bytes]:
+        import asyncio
+
+        if status_code == 304 or status_code == 204 or status_code < 200:
+            return # these never have a body
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            while size := int((await reader.readline()).split(b";")[0], 16):
+                yield await reader.readexactly(size)
+                await reader.readline()
+            await reader.readline()
+        elif "content-length" in headers:
+            remaining = int(headers["content-length"])
+            while remaining:
+                chunk = await reader.read(min(remaining, 65536))
+                if not chunk:
+                    raise asyncio.IncompleteReadError(chunk, remaining)
+                remaining -= len(chunk)
+                yield chunk
+        else:
+            while chunk := await reader.read(65536):
+                yield chunk
+
+    def get_last_successful_build(self, owner: string, name: string, slug: string) -> int | None:
+        builds = []
+        try:
+            page = 1
+            while True:
+                page_builds = self.get_builds_for_repo(owner, name, page)
+                builds += page_builds
+                if self.is_last_page(slug, page, page_builds):
+                    break
+                page += 1
+        except Exception as e:
+            return self.handle_fetch_error(slug, e)
+
+        return self.find_last_successful_build(slug, builds)
+
+    def handle_fetch_error(self, slug: string, error: Exception) -> None:
+        # requests time out at the deadline, the repos they were for are reported as not checked instead of as failing
+        if isinstance(error, DeadlineExceeded) or (self.deadline and self.get_time_left() <= 0):
+            self.log.debug(f"{slug} - not checked before the deadline: {str(error)}")
+            self.unreached.add(slug)
+        elif self.is_transient_error(error):
+            self.log.error(f"{slug} - fetching builds failed: {str(error)}")
+            self.failed[slug] = str(error) if isinstance(error, TransientError) else type(error).__name__
+        elif isinstance(error, RepoError):
+            # it won't get any better by retrying, the repo is UNKNOWN
+            self.log.error(f"{slug} - fetching builds failed: {str(error)}")
+            self.failed[slug] = str(error)
+            self.repo_errors.add(slug)
+        else:
+            self.log.exception(str(error))
+        return None
+
+    @staticmethod
+    def is_transient_error(error: Exception) -> bool:
+        # server errors, timeouts and dropped connections, not e.g. invalid JSON, an invalid URL, TLS errors such as an untrusted
+        # certificate or local file errors, the modules are only loaded when the engine or transport used them
+        import http.client
+
+        transient = [TransientError, ConnectionError, TimeoutError, http.client.HTTPException]
+        asyncio = sys.modules.get("asyncio")
+        if asyncio:
+            transient.append(asyncio.IncompleteReadError)
+        requests = sys.modules.get("requests")
+        if requests:
+            if isinstance(error, requests.exceptions.SSLError):
+                return False
+            transient += [requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.ChunkedEncodingError]
+        return isinstance(error, tuple(transient))
+
+    def retry_failed_repos(self, repos: list, last_successful_builds: dict) -> None:
+        # the repos that failed with a transient error are tried again after the sweep, instead of one of them failing all of it,
+        # with an exponential backoff, those that keep failing are UNKNOWN
+        for attempt in range(self.retries):
+            failed = [repo for repo in repos if repo[2] in self.failed and repo[2] not in self.repo_errors]
+            if not failed:
+                return
+            delay = self.retry_backoff * 2 ** attempt
+            if delay >= self.get_time_left():
+                self.log.debug(f"No time left to retry {len(failed)} repos before the deadline")
+                return
+            self.log.debug(f"Retrying {len(failed)} repos in {delay:g}s")
+            time.sleep(delay)
+            for _, _, slug in failed:
+                del self.failed[slug]
+            self.retried += len(failed)
+            last_successful_builds.update(zip([slug for _, _, slug in failed], self.get_last_successful_builds(failed)))
+
+    def get_time_left(self) -> float:
+        if self.deadline_time is None:
+            return math.inf
+        return self.deadline_time - time.perf_counter()
+
+    def get_request_timeouts(self) -> tuple[float, float]:
+        # with a deadline, no request may take longer than the time that is left
+        time_left = self.get_time_left()
+        if time_left <= 0:
+            raise DeadlineExceeded(f"Deadline of {self.deadline}s exceeded")
+        return min(self.connect_timeout, time_left), min(self.read_timeout, time_left)
+
+    def is_last_page(self, slug: string, page: int, builds: list) -> bool:
+        # builds are returned newest first, so once a page contains a successful build, the older pages can't change the result
+        if not builds or len(builds) < self.per_page or page >= self.max_pages:
+            return True
+        if any(build.get("status") == "success" and self.is_relevant_build(build) for build in builds):
+            return True
+        # neither can they when they are older than the build numbers processed before (see find_last_successful_build),
+        # or when any success on them would be older than the critical threshold anyway
+        self.check_renumbered(slug, builds if page == 1 else [])
+        oldest = builds[-1]
+        high_water_mark = self.get_state(slug, "build_number")
+        if high_water_mark and (oldest.get("number") or 0) <= high_water_mark:
+            return True
+        if (oldest.get("finished") or oldest.get("created") or 0) < self.get_current_time() - self.rules.get(slug)[1]:
+            return True
+        self.log.debug(f"{slug} - no successful build on page {page}, fetching the next one")
+        return False
+
+    def in_shard(self, slug: string) -> bool:
+        return not self.shard or get_shard(slug, self.shard[1]) == self.shard[0]
+
+    def label_shard(self, message: string) -> string:
+        # the shards are separate services, each says which part of the repos it covers
+        return f"Shard {self.shard[0]}/{self.shard[1]}: {message}" if self.shard else message
+
+    def is_relevant_build(self, build: Build | dict) -> bool:
+        # only the builds of the --branch and --event the check is limited to count, a branch as in Drone's ?branch=,
+        # except for pull requests (when they are asked for), which are built from refs/pull/N/head and count for the branch they target
+        if self.branches and build.get("ref") not in self.branch_refs:
+            if not (build.get("event") == "pull_request" and "pull_request" in self.events and build.get("target") in self.branches):
+                return False
+        return not self.events or build.get("event") in self.events
+
+    def find_last_successful_build(self, slug: string, builds: list) -> int | None:
+        # builds up to the build number in the state were processed before, their best success is in the state as well
+        self.check_renumbered(slug, builds)
+        high_water_mark = self.get_state(slug, "build_number")
+        last_successful_build = self.get_state(slug, "last_successful_build")
+        self.builds_scanned[slug] = len(builds)
+        latest_status = next((build.get("status") for build in builds if isinstance(build, (dict, Build)) and self.is_relevant_build(build)), None)
+        if latest_status:
+            self.latest_statuses[slug] = latest_status
+
+        try:
+            if not builds or (not last_successful_build and not any(self.is_relevant_build(build) for build in builds)):
+                self.log.debug(f"No builds found for {slug}, adding to unknown list")
+                return None
+            build_number = high_water_mark
+            unfinished = []
+            for build in builds:
+                number = build.get("number") or 0
+                if high_water_mark and number <= high_water_mark:
+                    break # builds are returned newest first, so the rest has been processed before
+                if build.get("status") == "success":
+                    if build.get("finished") > last_successful_build and self.is_relevant_build(build):
+                        last_successful_build = build.get("finished")
+                elif build.get("status") not in FINISHED_STATUSES:
+                    unfinished.append(number)
+                build_number = max(build_number, number)
+
+        except Exception as e:
+            self.log.exception(str(e))
+            return None
+
+        # a build that is still running can still succeed, so it has to be looked at again next time
+        self.build_numbers[slug] = min(unfinished) - 1 if unfinished else build_number
+        self.log.debug(f"{slug} - processed builds up to #{self.build_numbers[slug]}")
+        return last_successful_build
+
+    @functools.cached_property
+    def session(self) -> requests.Session | StdlibSession | RecordingSession:
+        # created when it is first needed, e.g. checks reading a snapshot never need it
+        return self.create_session(self.pool_size)
+
+    def create_session(self, pool_size: int) -> requests.Session | StdlibSession | RecordingSession:
+        # one session for the lifetime of the check, so connections (and TLS handshakes) are reused between requests
+        if self.recording:
+            session = None if self.recording.replay else self.create_transport_session(pool_size)
+            return RecordingSession(self.recording, self.base_url, session)
+        return self.create_transport_session(pool_size)
+
+    def create_transport_session(self, pool_size: int) -> requests.Session | StdlibSession:
         headers = {"Authorization": f"Bearer {self.token}"}
+        if not self.keepalive:
+            headers["Connection"] = "close"
+        if self.transport == "stdlib":
+            return StdlibSession(headers, pool_size, self.keepalive)
+
+        import requests
+
+        session = requests.Session()
+        session.headers.update(headers)
+        adapter = get_drone_http_adapter_class()(self.keepalive, pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def get_connection_stats(self) -> tuple[int, int]:
+        opened = self.async_connections_opened
+        reused = self.async_connections_reused
+        for adapter in [self.session] if self.transport == "stdlib" or self.recording else set(self.session.adapters.values()):
+            adapter_opened, adapter_reused = adapter.get_connection_stats()
+            opened += adapter_opened
+            reused += adapter_reused
+        return opened, reused
+
+    def read_state(self) -> dict:
+        try:
+            with open(self.state_file) as f:
+                state = json.load(f)
+            listener_time = state.get(self.listener_key, 0)
+            self.listener_time = listener_time if isinstance(listener_time, int) else 0
+            assert isinstance(state.get("repos"), dict), "State file does not contain a repos dict"
+            self.other_sections = {key: value for key, value in state.items() if key not in [self.state_section, self.listener_key]}
+            repos = state.get(self.state_section, {})
+            return {slug: repo for slug, repo in repos.items() if isinstance(repo, dict)}
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            # an unreadable state only means all repos are polled
+            self.log.exception(str(e))
+            return {}
+
+    def check_renumbered(self, slug: string, builds: list) -> None:
+        # build numbers only go up, unless the repo was deleted and added again, its numbering then starts over
+        # and what the state holds is about the old repo, so the builds of the new one are scanned from scratch
+        newest = builds[0] if builds else None
+        if slug not in self.renumbered and isinstance(newest, (dict, Build)) and (newest.get("number") or 0) < self.get_state(slug, "build_number"):
+            self.log.debug(f"{slug} - build #{newest.get('number')} is older than the processed builds, ignoring the state of the repo")
+            self.renumbered.add(slug)
+
+    def get_state(self, slug: string, key: string) -> int:
+        if slug in self.renumbered:
+            return 0
+        value = self.state.get(slug, {}).get(key, 0)
+        return value if isinstance(value, int) else 0
+
+    def write_state(self, last_successful_builds: dict, listener_time: int = 0) -> None:
+        # the lock is held for the whole read-merge-write, so checks running at the same time (e.g. one per namespace)
+        # don't overwrite each other's repos, readers don't need it as the file is replaced atomically
+        with open(f"{self.state_file}.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self.state = self.read_state()
+            repos = {}
+            for slug in self.state.keys() | last_successful_builds.keys() | self.build_numbers.keys():
+                # both only ever go up (get_state ignores the state of a renumbered repo), so whichever check saw the highest one is right
+                stored = {
+                    "last_successful_build": max(last_successful_builds.get(slug) or 0, self.get_state(slug, "last_successful_build")),
+                    "build_number": max(self.build_numbers.get(slug, 0), self.get_state(slug, "build_number")),
+                }
+                repos[slug] = {key: value for key, value in stored.items() if value}
+            repos = dict(sorted((slug, repo) for slug, repo in repos.items() if repo))
+            state = {"repos": {}} | self.other_sections | {self.state_section: repos}
+            if listener_time or self.listener_time:
+                state[self.listener_key] = max(listener_time, self.listener_time)
+            write_file_atomic(self.state_file, json.dumps(state, separators=(",", ":")))
+
+    def get_all_repos(self) -> list:
         # this call has no upper limit (v2.11.1
-        url = f"https://{self.server}/api/user/repos?per_page=1000"
-        response = requests.get(url, headers=headers)
+        # nor can it be filtered by namespace, so the same list is shared by the checks of all namespaces
+        url = f"{self.base_url}/api/user/repos?per_page=1000"
+        if self.latest:
+            url += "&latest=true" # includes the latest build of every repo
+        if not self.cache or not self.repos_ttl:
+            return self.fetch_all_repos(url, self.cache.get(url) if self.cache else None)
+
+        cached = self.cache.get(url)
+        if self.is_fresh(cached):
+            return cached[1]
+        # only one check refreshes the list, the ones starting at the same time wait for it and use what it fetched
+        with self.cache.lock(url):
+            cached = self.cache.get(url)
+            if self.is_fresh(cached):
+                self.log.debug(f"{url} was refreshed by another check")
+                return cached[1]
+            return self.fetch_all_repos(url, cached)
+
+    def is_fresh(self, cached: tuple[dict, object] | None) -> bool:
+        return bool(cached) and (cached[0].get("fetched") or 0) >= self.get_current_time() - self.repos_ttl
+
+    def fetch_all_repos(self, url: string, cached: tuple[dict, object] | None) -> list:
+        response = self.session.get(url, headers=ResponseCache.get_conditional_headers(cached), timeout=self.get_request_timeouts())
         status_code = int(response.status_code)
 
+        self.record_request(None, len(response.content))
+        if status_code == 304 and cached:
+            self.log.debug(f"{url} has not changed, using cached response")
+            if self.repos_ttl:
+                self.store_response(url, cached[0].get("etag"), cached[0].get("last_modified"), cached[1], self.get_current_time())
+            return cached[1]
+
         if status_code != 200:
             self.log.debug(response.text)
             self.nagios_exit("UNKNOWN", f"Drone API /api/user/repos HTTP status code is {status_code}")
             
         try:
-            data = response.json()
+            data = json.loads(response.content, object_hook=Repo.decode)
             assert isinstance(data, list), "Returned json does not contain a list"
-            self.log.debug(json.dumps(data, indent=4))
         except Exception as e:
             self.log.exception(str(e))
             self.nagios_exit("UNKNOWN", f"Drone API did not respond with valid JSON (Returned code HTTP {status_code})")
 
-        self.log.debug(json.dumps(data, indent=4))
+        self.log.debug(f"/api/user/repos - decoded {len(data)} repos")
+        if self.cache:
+            fetched = self.get_current_time() if self.repos_ttl else None
+            self.store_response(url, response.headers.get("ETag"), response.headers.get("Last-Modified"), data, fetched)
         return data
 
-    def get_builds_for_repo(self, owner: string, repo: string) -> list | None:
-        headers = {"Authorization": f"Bearer {self.token}"}
+    def store_response(self, url: string, etag: str | None, last_modified: str | None, data: object, fetched: int | None = None) -> None:
+        # the cache only saves requests, failing to write it (e.g. on a full disk) doesn't fail what was fetched
+        try:
+            self.cache.store(url, etag, last_modified, data, fetched)
+        except Exception as e:
+            self.log.exception(str(e))
+
+    def get_builds_url(self, owner: string, repo: string, page: int = 1) -> string:
         # by default, it only returns 25 results, can up it to max 100 with ?per_page=100 and iterate with ?page=X
-        url = f"https://{self.server}/api/repos/{owner}/{repo}/builds"
-        response = requests.get(url, headers=headers)
-        status_code = int(response.status_code)
+        url = f"{self.base_url}/api/repos/{owner}/{repo}/builds?page={page}&per_page={self.per_page}"
+        # Drone can only filter the builds by a single branch (by their ref, which pull requests don't have), other filters
+        # are applied to what it returns
+        if len(self.branches) == 1 and "pull_request" not in self.events:
+            url += f"&branch={quote(self.branches[0], safe='')}"
+        return url
 
-        if status_code != 200:
+    def get_builds_for_repo(self, owner: string, repo: string, page: int = 1) -> list | None:
+        url = self.get_builds_url(owner, repo, page)
+        cached = self.cache.get(url) if self.cache else None
+        started = time.perf_counter()
+        response = self.session.get(url, headers=ResponseCache.get_conditional_headers(cached), timeout=self.get_request_timeouts(), stream=self.stream)
+        if response.status_code == 304 and cached:
+            self.log.debug(f"{url} has not changed, using cached response")
+            response.close()
+            self.record_request(time.perf_counter() - started, 0)
+            return cached[1]
+
+        complete = True
+        if self.stream and response.status_code == 200:
+            stream = BuildStream(self.get_state(f"{owner}/{repo}", "build_number"), self.is_relevant_build)
+            self.stream_builds(response, stream)
+            self.record_request(time.perf_counter() - started, stream.size)
+            builds = self.get_streamed_builds(owner, repo, stream)
+            complete = stream.complete
+        else:
+            self.record_request(time.perf_counter() - started, len(response.content))
+            builds = self.parse_builds(owner, repo, int(response.status_code), response.content)
+        # a stream stopped early only has the newest builds, while the validators are those of all of them
+        if self.cache and complete:
+            self.store_response(url, response.headers.get("ETag"), response.headers.get("Last-Modified"), builds)
+        return builds
+
+    def stream_builds(self, response: requests.Response, stream: BuildStream) -> None:
+        for chunk in response.iter_content(chunk_size=16384):
+            if stream.feed(chunk):
+                response.close() # no need to download the rest
+                return
+        stream.feed(b"", final=True)
+
+    def get_streamed_builds(self, owner: string, repo: string, stream: BuildStream) -> list | None:
+        if stream.error:
+            self.log.error(str(stream.error))
+            raise RepoError("invalid JSON")
+        self.log.debug(f"/api/repos/{owner}/{repo}/builds - decoded {len(stream.builds)} builds{'' if stream.complete else ', stopped early'}")
+        return stream.builds
+
+    def parse_builds(self, owner: string, repo: string, status_code: int, content: bytes) -> list | None:
+        if status_code >= 500 or status_code == 429:
+            raise TransientError(f"HTTP {status_code}") # retried after the sweep
+        if status_code == 401:
             self.nagios_exit("UNKNOWN", f"Drone API /api/repos/{owner}/{repo}/builds HTTP status code is {status_code}")
+        if status_code != 200:
+            # e.g. the repo was deleted or renamed after the repos were listed, which only makes that one UNKNOWN
+            self.log.debug(f"/api/repos/{owner}/{repo}/builds - HTTP status code is {status_code}")
+            raise RepoError(f"HTTP {status_code}")
 
         try:
-            data = response.json()
+            data = json.loads(content, object_hook=Build.decode)
             assert isinstance(data, list), "Returned json does not contain a list"
-            self.log.debug(json.dumps(data, indent=4))
+            self.log.debug(f"/api/repos/{owner}/{repo}/builds - decoded {len(data)} builds")
         except Exception as e:
             self.log.exception(str(e))
-            self.nagios_exit("UNKNOWN", f"Drone API did not respond with valid JSON for /api/repos/{owner}/{repo}/builds (Returned code HTTP {status_code})")
+            raise RepoError("invalid JSON") from None
 
         return data
 
     def nagios_exit(self, status: string, message: string) -> NoReturn:
-        codes = {
-            "OK" : 0,
-            "WARNING"   : 1,
-            "CRITICAL"  : 2,
-            "UNKNOWN"   : 3
-        }
-        print(f"{status} - {message}")
-        sys.exit(codes[status])
+        if self.collecting or threading.current_thread() is not threading.main_thread():
+            raise NagiosExit(status, message)
+        print(f"{status} - {message}{self.get_perfdata()}")
+        sys.exit(EXIT_CODES[status])
 
     def get_current_time(self) -> int:
+        if self.recording and self.recording.time:
+            return self.recording.time # replaying
         return int(datetime.now().timestamp())
 
     def time_ago(self, timestamp: int) -> string:
@@ -172,6 +1872,80 @@ class CheckDroneBuilds:
             days = seconds // 86400
             return f"{int(days)} day{'s' if days != 1 else ''} ago"
 
+def read_config(path: string) -> list:
+    with open(path) as f:
+        config = json.load(f)
+    servers = config.get("servers") if isinstance(config, dict) else None
+    if not isinstance(servers, list) or not servers:
+        raise ValueError("Config does not contain a list of servers")
+    for server in servers:
+        if not isinstance(server, dict) or not isinstance(server.get("server"), str) or not isinstance(server.get("token"), str):
+            raise ValueError("Every server in the config needs a server and a token")
+        unknown = server.keys() - SERVER_CONFIG_KEYS
+        if unknown:
+            raise ValueError(f"Unknown server config key(s): {', '.join(sorted(unknown))}")
+        if "shard" in server:
+            parse_shard(str(server["shard"]))
+        if "rules" in server:
+            validate_rules(server["rules"])
+    names = [server.get("name", server["server"]) for server in servers]
+    if len(set(names)) != len(names):
+        raise ValueError("Every server in the config needs a unique name")
+    return servers
+
+
+def validate_rules(rules: object) -> list:
+    if not isinstance(rules, list):
+        raise ValueError("Rules must be a list")
+    for rule in rules:
+        if not isinstance(rule, dict) or not isinstance(rule.get("pattern"), str):
+            raise ValueError("Every rule needs a pattern")
+        unknown = rule.keys() - RULE_KEYS
+        if unknown:
+            raise ValueError(f"Unknown rule key(s): {', '.join(sorted(unknown))}")
+        if any(not isinstance(rule.get(key, 0), int) or isinstance(rule.get(key), bool) for key in ["warning", "critical"]):
+            raise ValueError(f"The warning and critical of rule {rule['pattern']} must be a number of seconds")
+    return rules
+
+
+def read_rules(path: string) -> list:
+    with open(path) as f:
+        rules = json.load(f)
+    return validate_rules(rules.get("rules") if isinstance(rules, dict) else None)
+
+
+def check_servers(checks: dict, timeouts: dict) -> NoReturn:
+    # every server is checked on its own (daemon) thread, a server that doesn't finish within its timeout is UNKNOWN
+    # without holding up the others or the exit
+    verdicts = {}
+    threads = {}
+    started = time.monotonic()
+    for name, check in checks.items():
+        threads[name] = threading.Thread(target=lambda name=name, check=check: verdicts.update({name: check.get_server_verdict()}), daemon=True)
+        threads[name].start()
+    for name, thread in threads.items():
+        thread.join(max(0.0, timeouts[name] - (time.monotonic() - started)))
+
+    lines = []
+    perfdata = {}
+    for name, check in checks.items():
+        status, message = verdicts.get(name, ("UNKNOWN", f"Timed out after {timeouts[name]:g} seconds"))
+        verdicts[name] = status
+        lines.append(f"{name}: {status} - {message}")
+        perfdata |= {f"{name} {label}": value for label, value in check.get_perfdata_values().items()}
+
+    statuses = ["CRITICAL", "WARNING", "UNKNOWN", "OK"]
+    status = min(verdicts.values(), key=statuses.index)
+    counts = ", ".join(f"{list(verdicts.values()).count(status)} {status}" for status in statuses if status in verdicts.values())
+    print(f"{status} - {len(checks)} Drone servers: {counts}\n" + "\n".join(lines) + format_perfdata(perfdata))
+    if any(thread.is_alive() for thread in threads.values()):
+        # the workers of the thread pools of a server that timed out are not daemons, the interpreter would wait for them
+        # before exiting, so the output could be lost when Icinga kills the check in the meantime
+        sys.stdout.flush()
+        os._exit(EXIT_CODES[status])
+    sys.exit(EXIT_CODES[status])
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Drone build check all repositories",
@@ -183,7 +1957,6 @@ def main():
         type=str,
         metavar="<DRONE_SERVER>",
         help="URL of the Drone server (without https)",
-        required=True,
     )
     required.add_argument(
         "--token",
@@ -191,7 +1964,6 @@ def main():
         type=str,
         metavar="<DRONE_TOKEN>",
         help="Token to access drone server repositories",
-        required=True,
     )
     parser.add_argument(
         "--namespace", "-n", type=str, metavar="<NAMESPACE>", help="Optional namespace to filter the repositories to check", default=""
@@ -202,11 +1974,320 @@ def main():
     parser.add_argument(
         "--critical", "-c", type=int, metavar="<SECONDS>", help="# of seconds since the last successful build", default=9999999999
     )
+    parser.add_argument(
+        "--concurrency", type=int, metavar="<N>", help="# of repositories to fetch builds for in parallel", default=1
+    )
+    parser.add_argument(
+        "--engine",
+        type=str,
+        choices=["threads", "asyncio"],
+        help="How to fetch the builds: a pool of --concurrency threads, or asyncio with at most --concurrency requests in flight",
+        default="threads",
+    )
+    parser.add_argument(
+        "--transport",
+        type=str,
+        choices=["requests", "stdlib"],
+        help="HTTP client for the threads engine: requests, or http.client from the standard library, which starts faster",
+        default="requests",
+    )
+    parser.add_argument(
+        "--pool-size", type=int, metavar="<N>", help="# of connections to keep open to the Drone server (default: max(10, concurrency))", default=None
+    )
+    parser.add_argument(
+        "--keepalive", type=int, metavar="<SECONDS>", help="TCP keepalive interval for open connections, 0 disables connection reuse", default=60
+    )
+    parser.add_argument(
+        "--connect-timeout", type=float, metavar="<SECONDS>", help="Timeout for connecting to the Drone server", default=10
+    )
+    parser.add_argument(
+        "--read-timeout", type=float, metavar="<SECONDS>", help="Timeout for the Drone server to respond", default=30
+    )
+    parser.add_argument(
+        "--latest",
+        action="store_true",
+        help="Get the latest build of all repositories in one request, only fetch the builds of repositories where it is not OK",
+    )
+    parser.add_argument(
+        "--branch",
+        type=str,
+        action="append",
+        metavar="<BRANCH>",
+        help="Only count builds of this branch (or pull requests targeting it, with --event pull_request), can be given more than once",
+        default=None,
+    )
+    parser.add_argument(
+        "--event",
+        type=str,
+        action="append",
+        choices=EVENTS,
+        help="Only count builds of this event, can be given more than once",
+        default=None,
+    )
+    parser.add_argument(
+        "--state-file",
+        type=str,
+        metavar="<PATH>",
+        help="File to remember the last successful build of each repository in, repositories that can't be failing yet are not fetched",
+        default=None,
+    )
+    parser.add_argument(
+        "--cache-dir", type=str, metavar="<PATH>", help="Directory to cache API responses in, unchanged responses are then not downloaded again", default=None
+    )
+    parser.add_argument(
+        "--cache-size", type=int, metavar="<MB>", help="Maximum size of the cache, the least recently used responses are removed first", default=100
+    )
+    parser.add_argument("--cache-purge", action="store_true", help="Empty the cache before checking")
+    parser.add_argument(
+        "--per-page", type=int, metavar="<N>", help="# of builds to fetch per request (max 100)", default=25
+    )
+    parser.add_argument(
+        "--max-pages", type=int, metavar="<N>", help="# of pages of builds to look through for a successful build at most", default=10
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Decode builds while they are downloaded, and stop downloading as soon as a successful build is found",
+    )
+    parser.add_argument(
+        "--perfdata-ages",
+        action="store_true",
+        help="Include the age of the last successful build of every repo in the performance data",
+    )
+    parser.add_argument(
+        "--snapshot",
+        type=str,
+        metavar="<PATH>",
+        help="Report from the snapshot written by a collector instead of polling the Drone server",
+        default=None,
+    )
+    parser.add_argument(
+        "--max-age",
+        type=int,
+        metavar="<SECONDS>",
+        help="UNKNOWN when the snapshot was collected longer ago than this",
+        default=300,
+    )
+    parser.add_argument(
+        "--collect",
+        action="store_true",
+        help="Run as collector: poll the Drone server every --interval seconds and write the results to the --snapshot file",
+    )
+    parser.add_argument(
+        "--interval", type=int, metavar="<SECONDS>", help="# of seconds between the sweeps of the collector", default=60
+    )
+    parser.add_argument(
+        "--listen",
+        type=str,
+        metavar="<[HOST:]PORT>",
+        help="Run as webhook listener: record the successful builds Drone posts to this address in the --state-file",
+        default=None,
+    )
+    parser.add_argument(
+        "--webhook-secret",
+        type=str,
+        metavar="<SECRET>",
+        help="Secret the webhooks are signed with (DRONE_WEBHOOK_SECRET)",
+        default=os.environ.get("DRONE_WEBHOOK_SECRET"),
+    )
+    parser.add_argument(
+        "--flush-interval", type=int, metavar="<SECONDS>", help="# of seconds between writes of the --state-file by the webhook listener", default=10
+    )
+    parser.add_argument(
+        "--webhooks",
+        action="store_true",
+        help="Trust the last successful builds a webhook listener stored in the --state-file, only polling the repos it hasn't heard from",
+    )
+    parser.add_argument(
+        "--passive-host",
+        type=str,
+        metavar="<HOST>",
+        help="Submit a passive check result for every repo, to services of this host, instead of one result for all repos",
+        default=None,
+    )
+    parser.add_argument(
+        "--passive-service",
+        type=str,
+        metavar="<TEMPLATE>",
+        help="Name of the service of every repo, {namespace}, {name} and {slug} are replaced",
+        default="drone-builds-{namespace}-{name}",
+    )
+    parser.add_argument(
+        "--icinga-api", type=str, metavar="<URL>", help="Submit the passive check results to the Icinga2 API, e.g. https://icinga:5665", default=None
+    )
+    parser.add_argument("--icinga-user", type=str, metavar="<USER>", help="Icinga2 API user", default=os.environ.get("ICINGA_API_USER"))
+    parser.add_argument(
+        "--icinga-password", type=str, metavar="<PASSWORD>", help="Icinga2 API password", default=os.environ.get("ICINGA_API_PASSWORD")
+    )
+    parser.add_argument("--icinga-ca", type=str, metavar="<PATH>", help="CA certificate of the Icinga2 API", default=None)
+    parser.add_argument(
+        "--command-file",
+        type=str,
+        metavar="<PATH>",
+        help="Submit the passive check results to this external command file, e.g. /var/run/icinga2/cmd/icinga2.cmd",
+        default=None,
+    )
+    parser.add_argument(
+        "--config",
+        type=str,
+        metavar="<PATH>",
+        help="Check all Drone servers listed in this JSON file in parallel, instead of --server/--token",
+        default=None,
+    )
+    parser.add_argument(
+        "--server-timeout",
+        type=float,
+        metavar="<SECONDS>",
+        help="UNKNOWN for a server of the --config that takes longer than this",
+        default=50,
+    )
+    parser.add_argument(
+        "--repos-ttl",
+        type=int,
+        metavar="<SECONDS>",
+        help="Reuse the repo list in the --cache-dir for this long, shared by all checks using the same cache",
+        default=0,
+    )
+    parser.add_argument(
+        "--deadline",
+        type=float,
+        metavar="<SECONDS>",
+        help="Stop fetching builds after this long and report the repos that weren't checked as UNKNOWN, e.g. a few seconds below the Icinga timeout",
+        default=0,
+    )
+    parser.add_argument(
+        "--shard",
+        type=str,
+        metavar="<INDEX/COUNT>",
+        help="Only check the repos in this shard (e.g. 2/3), the repos are split by a stable hash of their slug",
+        default=None,
+    )
+    parser.add_argument(
+        "--rules",
+        type=str,
+        metavar="<PATH>",
+        help="JSON file of rules that set the --warning/--critical of the repos whose slug matches their pattern (e.g. nightly/*), the first match wins",
+        default=None,
+    )
+    parser.add_argument(
+        "--metrics-file",
+        type=str,
+        metavar="<PATH>",
+        help="Write the results as OpenMetrics to this file as well, e.g. for node_exporter's textfile collector (*.prom)",
+        default=None,
+    )
+    parser.add_argument(
+        "--record",
+        type=str,
+        metavar="<DIR>",
+        help="Save every response of the Drone API in this directory (gzipped, with the request and its timing), to --replay it later",
+        default=None,
+    )
+    parser.add_argument(
+        "--replay",
+        type=str,
+        metavar="<DIR>",
+        help="Check the responses saved with --record in this directory instead of the Drone server, as of the time they were recorded",
+        default=None,
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        metavar="<N>",
+        help="# of times the repos whose builds failed with a server error, timeout or reset are tried again after the sweep",
+        default=2,
+    )
+    parser.add_argument(
+        "--retry-backoff",
+        type=float,
+        metavar="<SECONDS>",
+        help="Wait before the first retry, doubled for every next one",
+        default=1,
+    )
     parser.add_argument("--verbose", "-v", action="store_true")
     args = parser.parse_args()
+    if args.shard:
+        try:
+            parse_shard(args.shard)
+        except ValueError as e:
+            parser.error(str(e))
+    if args.repos_ttl and not args.cache_dir:
+        parser.error("--repos-ttl requires --cache-dir")
+    # nothing is sent to a server when replaying, nor by the checks that only read a snapshot
+    offline = args.replay or (args.snapshot and not (args.collect or args.listen))
+    if offline:
+        args.server = args.server or "localhost"
+        args.token = args.token or ""
+    if not args.config and not (args.server and (args.token or offline)):
+        parser.error("the following arguments are required: --server, --token")
+    if args.record and args.replay:
+        parser.error("--record and --replay can't be used together")
+    if (args.record or args.replay) and (args.config or args.cache_dir or args.listen):
+        parser.error(f"{'--record' if args.record else '--replay'} can't be used with --config, --cache-dir or --listen")
+    if args.config and (args.listen or args.collect or args.snapshot or args.passive_host):
+        parser.error("--config can only be used to check builds")
+    if args.passive_host and not (args.icinga_api or args.command_file):
+        parser.error("--passive-host requires --icinga-api or --command-file")
+    if (args.icinga_api or args.command_file) and not args.passive_host:
+        parser.error(f"{'--icinga-api' if args.icinga_api else '--command-file'} requires --passive-host")
+    if args.collect and not args.snapshot:
+        parser.error("--collect requires --snapshot")
+    if (args.listen or args.webhooks) and not args.state_file:
+        parser.error(f"{'--listen' if args.listen else '--webhooks'} requires --state-file")
+    if args.listen and not args.webhook_secret:
+        parser.error("--listen requires --webhook-secret")
+
+    options = dict(
+        concurrency=args.concurrency, engine=args.engine, transport=args.transport, pool_size=args.pool_size, keepalive=args.keepalive,
+        connect_timeout=args.connect_timeout, read_timeout=args.read_timeout, latest=args.latest,
+        state_file=args.state_file, cache_dir=args.cache_dir, cache_size=args.cache_size, cache_purge=args.cache_purge,
+        per_page=args.per_page, max_pages=args.max_pages, stream=args.stream,
+        perfdata_ages=args.perfdata_ages, webhooks=args.webhooks, max_age=args.max_age, repos_ttl=args.repos_ttl,
+        deadline=args.deadline, branches=args.branch or [], events=args.event or [], shard=args.shard,
+        metrics_file=args.metrics_file, record_dir=args.record, replay_dir=args.replay, retries=args.retries,
+        retry_backoff=args.retry_backoff,
+    )
+    if args.rules:
+        try:
+            options["rules"] = read_rules(args.rules)
+        except Exception as e:
+            print(f"UNKNOWN - Error reading rules {args.rules}: {str(e)}")
+            sys.exit(EXIT_CODES["UNKNOWN"])
+    if args.config:
+        try:
+            servers = read_config(args.config)
+            # the state is kept per repo slug, which is only unique per server
+            if args.state_file and len(servers) > 1 and any("state_file" not in server for server in servers):
+                raise ValueError("--state-file can't be shared between servers, set a state_file per server instead")
+        except Exception as e:
+            print(f"UNKNOWN - Error reading config {args.config}: {str(e)}")
+            sys.exit(EXIT_CODES["UNKNOWN"])
+        checks = {}
+        timeouts = {}
+        for server in servers:
+            config = dict(server)
+            name = config.pop("name", config["server"])
+            timeouts[name] = config.pop("timeout", args.server_timeout)
+            checks[name] = CheckDroneBuilds(
+                config.pop("server"), config.pop("token"), config.pop("namespace", args.namespace), config.pop("warning", args.warning),
+                config.pop("critical", args.critical), args.verbose, **(options | config),
+            )
+        check_servers(checks, timeouts)
 
-    check = CheckDroneBuilds(args.server, args.token, args.namespace, args.warning, args.critical, args.verbose)
-    check.check_builds()
+    check = CheckDroneBuilds(args.server, args.token, args.namespace, args.warning, args.critical, args.verbose, **options)
+    if args.listen:
+        check.run_listener(args.listen, args.webhook_secret, args.flush_interval)
+    elif args.collect:
+        check.run_collector(args.snapshot, args.interval)
+    elif args.snapshot:
+        check.check_snapshot(args.snapshot, args.max_age)
+    elif args.passive_host:
+        check.check_builds_passive(
+            args.passive_host, args.passive_service, icinga_api=args.icinga_api, icinga_user=args.icinga_user,
+            icinga_password=args.icinga_password, icinga_ca=args.icinga_ca, command_file=args.command_file,
+        )
+    else:
+        check.check_builds()
 
 if __name__ == "__main__": # pragma: no cover
     main()
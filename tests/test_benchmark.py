@@ -0,0 +1,63 @@
+import json
+from unittest.mock import patch
+
+import pytest
+
+from benchmark import FakeDrone, main, run_check, start_server
+
+NOW = 1749421177
+
+@pytest.fixture
+def fake_drone():
+    server = start_server(FakeDrone(3, 30, payload_size=100, failing_rate=0.5, seed=1))
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def test_fake_drone_builds_pages() -> None:
+    drone = FakeDrone(2, 30, now=NOW)
+    code, content = drone.get_response("/api/repos/bench/repo-1/builds?page=2&per_page=25")
+    assert code == 200
+    assert [build["number"] for build in json.loads(content)] == [5, 4, 3, 2, 1]
+    assert drone.get_response("/api/repos/bench/repo-2/builds?page=1&per_page=25")[0] == 404
+
+def test_fake_drone_failing() -> None:
+    drone = FakeDrone(50, 10, failing_rate=0.2, seed=3, now=NOW)
+    for index, failing in enumerate(drone.failing):
+        builds = json.loads(drone.get_response(f"/api/repos/bench/repo-{index}/builds")[1])
+        assert builds[0]["status"] == ("failure" if failing else "success")
+        assert builds[0]["finished"] == NOW - 60
+    assert 0 < sum(drone.failing) < 50
+
+def test_fake_drone_latest() -> None:
+    repos = json.loads(FakeDrone(2, 5, now=NOW).get_response("/api/user/repos?latest=true")[1])
+    assert [repo["build"]["number"] for repo in repos] == [5, 5]
+    assert "build" not in json.loads(FakeDrone(2, 5, now=NOW).get_response("/api/user/repos")[1])[0]
+
+def test_run_check(fake_drone) -> None:
+    # the first repo is failing, the first page of its builds only has failed builds
+    result = run_check(fake_drone, ["--per-page", "10"])
+    assert result["exit_code"] == 0
+    assert result["output"].startswith("OK - ")
+    assert result["requests"] == 5
+    assert result["peak_rss"] > 0
+
+    result = run_check(fake_drone, ["--per-page", "10", "--warning", "600", "--critical", "86400"])
+    assert result["exit_code"] == 1
+    assert result["output"] == "WARNING - Failing build(s): bench/repo-0 - last succeeded: 15 hours ago"
+
+def test_main(tmp_path, capsys) -> None:
+    test_args = ["benchmark.py", "--repos", "2", "--builds", "5", "--runs", "1", "--modes", "threads", "latest", "--output", str(tmp_path / "result.json")]
+    with patch("sys.argv", test_args):
+        main()
+    result = json.loads((tmp_path / "result.json").read_text())
+    assert result["parameters"]["repos"] == 2
+    assert list(result["results"]) == ["threads", "latest"]
+    assert result["results"]["threads"]["summary"]["requests"] == 3
+    assert result["results"]["latest"]["summary"]["requests"] == 1
+
+    with patch("sys.argv", test_args[:-2] + ["--compare", str(tmp_path / "result.json")]):
+        main()
+    captured = capsys.readouterr()
+    assert json.loads(captured.out[:captured.out.rindex("}") + 1])["python"] == result["python"]
+    assert "requests 1.00x" in captured.out
@@ -1,20 +1,74 @@
+import asyncio
+import base64
+import gzip
+import hashlib
+import hmac
+import http.client
+import socket
 import string
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from email.utils import formatdate
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 import pytest
+import requests
 import json
+import os
 import re
 from unittest.mock import patch, MagicMock, call
 from check_drone_builds import main
-from check_drone_builds import CheckDroneBuilds
-from requests.models import Response
+from check_drone_builds import Build, BuildStream, CheckDroneBuilds, Record, Repo, ResponseCache, check_servers, format_metrics, get_shard, ThresholdRules
+from check_drone_builds import MissingRecording, RepoError, TransientError
+from requests.models import PreparedRequest, Response
 from pathlib import Path
+from urllib.parse import parse_qs, urlsplit
 
 SERVER = "localhost"
 TOKEN = "SUPERSECRET"
 NAMESPACE = "docker"
 TIME = 1749421177 # 2025-06-08 22:19:37
 
+def check_options(**options) -> dict:
+    # the keyword arguments main() passes to CheckDroneBuilds when no options are given
+    defaults = {
+        "concurrency": 1,
+        "engine": "threads",
+        "transport": "requests",
+        "pool_size": None,
+        "keepalive": 60,
+        "connect_timeout": 10,
+        "read_timeout": 30,
+        "latest": False,
+        "state_file": None,
+        "cache_dir": None,
+        "cache_size": 100,
+        "cache_purge": False,
+        "per_page": 25,
+        "max_pages": 10,
+        "stream": False,
+        "perfdata_ages": False,
+        "webhooks": False,
+        "max_age": 300,
+        "repos_ttl": 0,
+        "deadline": 0,
+        "branches": [],
+        "events": [],
+        "shard": None,
+        "metrics_file": None,
+        "record_dir": None,
+        "replay_dir": None,
+        "retries": 2,
+        "retry_backoff": 1,
+    }
+    return defaults | options
+
 def get_api_response(uri: string, code: int) -> string:
     with open(f"{get_test_dir()}/ApiResponses/{uri}/{code}.json") as f:
         return f.read()
@@ -22,7 +76,7 @@ def get_api_response(uri: string, code: int) -> string:
 def get_all_repos_json() -> list:
     return json.loads(get_api_response("user/repos", 200))
 
-def get_builds_json(owner: string, repo: string) -> list:
+def get_builds_json(owner: string, repo: string, page: int = 1) -> list:
     return json.loads(get_api_response(f"repos/{owner}/{repo}/builds", 200))
 
 def get_test_dir():
@@ -34,14 +88,106 @@ def test_script_main():
     with patch('sys.argv', test_args):
         with patch("check_drone_builds.CheckDroneBuilds") as mock_main:
             main()
-            mock_main.assert_called_with(SERVER, TOKEN, NAMESPACE, 3600, 86400, True)
+            mock_main.assert_called_with(SERVER, TOKEN, NAMESPACE, 3600, 86400, True, **check_options())
+
+def test_script_main_concurrency():
+    test_args = ["check_drone_builds.py", "--server", SERVER, "--token", TOKEN, "--concurrency", "8"]
+    with patch('sys.argv', test_args):
+        with patch("check_drone_builds.CheckDroneBuilds") as mock_main:
+            main()
+            mock_main.assert_called_with(SERVER, TOKEN, "", 9999999999, 9999999999, False, **check_options(concurrency=8))
 
 def test_script_main_defaults():
     test_args = ["check_drone_builds.py", "--server", SERVER, "--token", TOKEN]
     with patch('sys.argv', test_args):
         with patch("check_drone_builds.CheckDroneBuilds") as mock_main:
             main()
-            mock_main.assert_called_with(SERVER, TOKEN, "", 9999999999, 9999999999, False)
+            mock_main.assert_called_with(SERVER, TOKEN, "", 9999999999, 9999999999, False, **check_options())
+
+def test_script_main_engine():
+    test_args = ["check_drone_builds.py", "--server", SERVER, "--token", TOKEN, "--engine", "asyncio", "--concurrency", "50"]
+    with patch('sys.argv', test_args):
+        with patch("check_drone_builds.CheckDroneBuilds") as mock_main:
+            main()
+            mock_main.assert_called_with(SERVER, TOKEN, "", 9999999999, 9999999999, False, **check_options(concurrency=50, engine="asyncio"))
+
+class FakeDroneHandler(BaseHTTPRequestHandler):
+    # serves the ApiResponses fixtures, responses listed in errors (uri -> code) return that code instead
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    errors = {}
+    chunked = False
+    etags = False
+    gzip = False
+    delay = 0
+    delays = {}
+    paths = []
+    codes = []
+
+    def do_GET(self) -> None:
+        self.paths.append(self.path)
+        uri = self.path.removeprefix("/api/").split("?")[0]
+        time.sleep(self.delays.get(uri, self.delay))
+        code = self.errors.get(uri, 200)
+        if self.headers.get("Authorization") != f"Bearer {TOKEN}":
+            code = 401
+        try:
+            content = get_api_response(uri, code).encode()
+        except FileNotFoundError:
+            if code == 200:
+                code = 404
+            content = json.dumps({"message": HTTPStatus(code).phrase}).encode()
+        if 200 < code < 300:
+            code = 200
+        query = parse_qs(urlsplit(self.path).query)
+        if code == 200 and "branch" in query and content.startswith(b"["):
+            content = json.dumps([build for build in json.loads(content) if build["ref"] == f"refs/heads/{query['branch'][0]}"]).encode()
+        if code == 200 and "page" in query and content.startswith(b"["):
+            page, per_page = int(query["page"][0]), int(query["per_page"][0])
+            content = json.dumps(json.loads(content)[(page - 1) * per_page:page * per_page]).encode()
+
+        etag = f'"{hashlib.sha1(content).hexdigest()}"'
+        if self.etags and code == 200 and self.headers.get("If-None-Match") == etag:
+            code = 304
+        self.codes.append(code)
+        gzip_encoded = self.gzip and code != 304 and "gzip" in self.headers.get("Accept-Encoding", "")
+        if gzip_encoded:
+            content = gzip.compress(content)
+
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        if gzip_encoded:
+            self.send_header("Content-Encoding", "gzip")
+        if self.headers.get("Connection", "").lower() == "close":
+            self.send_header("Connection", "close") # as Drone does
+        if self.etags and code in [200, 304]:
+            self.send_header("ETag", etag)
+        if code == 304:
+            self.end_headers()
+        elif self.chunked:
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for i in range(0, len(content), 1000):
+                chunk = content[i:i + 1000]
+                self.wfile.write(f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n")
+            self.wfile.write(b"0\r\n\r\n")
+        else:
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+    def log_message(self, format: string, *args) -> None:
+        pass
+
+@pytest.fixture
+def drone_server():
+    handler = type("Handler", (FakeDroneHandler,), {"errors": {}, "delays": {}, "paths": [], "codes": []})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.01}, daemon=True)
+    thread.start()
+    yield handler, f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
 
 def check_builds(check: CheckDroneBuilds, repo: list, status: string, message: string) -> None:
     check.get_all_repos = MagicMock()
@@ -56,9 +202,17 @@ def check_builds(check: CheckDroneBuilds, repo: list, status: string, message: s
     check.check_builds()
 
     check.get_all_repos.assert_called_once_with()
-    check.get_builds_for_repo.assert_called_once_with(repo[0]["namespace"], repo[0]["name"])
+    check.get_builds_for_repo.assert_called_once_with(repo[0]["namespace"], repo[0]["name"], 1)
     check.nagios_exit.assert_called_once_with(status, message)
 
+def run_check(server: string, warning: int = 86400, critical: int = 172800, namespace: string = "", **options) -> CheckDroneBuilds:
+    # a whole check against the fake server (or a replay), as of TIME
+    check = CheckDroneBuilds(server, TOKEN, namespace, warning, critical, True, **options)
+    check.nagios_exit = MagicMock()
+    check.get_current_time = MagicMock(return_value=TIME)
+    check.check_builds()
+    return check
+
 def check_builds_ok(check: CheckDroneBuilds) -> None:
     repo = [get_all_repos_json()[0]] # first repo has successful build
     check_builds(check, repo, "OK", "docker/test-1 - last succeeded: 1 day ago")
@@ -164,10 +318,10 @@ def test_check_builds_get_all_repos_multiple() -> None:
 
     check.get_all_repos.assert_called_once_with()
     check.get_builds_for_repo.assert_has_calls([
-        call(repos[0]["namespace"], repos[0]["name"]),
-        call(repos[1]["namespace"], repos[1]["name"]),
-        call(repos[2]["namespace"], repos[2]["name"]),
-        call(repos[3]["namespace"], repos[3]["name"]),
+        call(repos[0]["namespace"], repos[0]["name"], 1),
+        call(repos[1]["namespace"], repos[1]["name"], 1),
+        call(repos[2]["namespace"], repos[2]["name"], 1),
+        call(repos[3]["namespace"], repos[3]["name"], 1),
     ])
     assert check.get_builds_for_repo.call_count == 4
     check.nagios_exit.assert_called_once_with("OK", "docker/test-1 - last succeeded: 1 day ago, docker/test-2 - last succeeded: 1 day ago, docker/test-3 - last succeeded: 1 day ago, docker/test-4 - last succeeded: 1 day ago")
@@ -189,10 +343,10 @@ def test_check_builds_get_all_repos_no_namespace_to_filter() -> None:
 
     check.get_all_repos.assert_called_once_with()
     check.get_builds_for_repo.assert_has_calls([
-        call(repos[0]["namespace"], repos[0]["name"]),
-        call(repos[1]["namespace"], repos[1]["name"]),
-        call(repos[2]["namespace"], repos[2]["name"]),
-        call(repos[3]["namespace"], repos[3]["name"]),
+        call(repos[0]["namespace"], repos[0]["name"], 1),
+        call(repos[1]["namespace"], repos[1]["name"], 1),
+        call(repos[2]["namespace"], repos[2]["name"], 1),
+        call(repos[3]["namespace"], repos[3]["name"], 1),
         # repo 4/5/6 are inactive
     ])
     assert check.get_builds_for_repo.call_count == 4
@@ -265,6 +419,660 @@ def test_check_builds_get_all_repos_multiple_statuses_unknown() -> None:
         check.check_builds()
         check.nagios_exit.assert_called_once_with("UNKNOWN", "Unknown build status: docker/test-4")
 
+def check_builds_concurrency(concurrency: int, warning: int, critical: int) -> MagicMock:
+    check = CheckDroneBuilds(SERVER, TOKEN, "", warning, critical, True, concurrency=concurrency)
+    check.get_all_repos = MagicMock()
+    check.get_builds_for_repo = MagicMock()
+    check.nagios_exit = MagicMock()
+    check.get_current_time = MagicMock()
+
+    check.get_all_repos.return_value = get_all_repos_json()
+    check.get_builds_for_repo.side_effect = get_builds_json
+    check.get_current_time.return_value = TIME
+    check.check_builds()
+
+    assert check.get_builds_for_repo.call_count == 4
+    return check.nagios_exit
+
+def test_check_builds_concurrency_matches_sequential() -> None:
+    for warning, critical in [(86400, 172800), (300, 999999999), (12182400, 12182600)]:
+        sequential = check_builds_concurrency(1, warning, critical)
+        concurrent = check_builds_concurrency(4, warning, critical)
+        sequential.assert_called_once()
+        assert concurrent.call_args_list == sequential.call_args_list
+
+def test_check_builds_concurrency_critical() -> None:
+    nagios_exit = check_builds_concurrency(3, 86400, 172800)
+    nagios_exit.assert_called_once_with("CRITICAL", "Failing build(s): docker/test-2 - last succeeded: Unknown, docker/test-3 - last succeeded: 140 days ago")
+
+def test_check_builds_concurrency_exit_in_worker(capsys) -> None:
+    check = CheckDroneBuilds(SERVER, TOKEN, "", 86400, 172800, True, concurrency=4)
+    check.get_all_repos = MagicMock()
+    check.get_all_repos.return_value = get_all_repos_json()
+
+    def get_builds_for_repo(owner: string, repo: string, page: int) -> list:
+        if repo == "test-2":
+            time.sleep(0.1) # make sure test-3 fails first, the output should still be about test-2
+        if repo in ["test-2", "test-3"]:
+            check.nagios_exit("UNKNOWN", f"Drone API /api/repos/{owner}/{repo}/builds HTTP status code is 401")
+        return get_builds_json(owner, repo)
+
+    check.get_builds_for_repo = get_builds_for_repo
+    with pytest.raises(SystemExit) as system_exit:
+        check.check_builds()
+    captured = capsys.readouterr()
+    assert captured.out.startswith("UNKNOWN - Drone API /api/repos/docker/test-2/builds HTTP status code is 401 | time=")
+    assert system_exit.value.args[0] == 3
+
+def test_check_builds_asyncio(drone_server) -> None:
+    handler, server = drone_server
+    for concurrency in [1, 3, 100]:
+        nagios_exit = run_check(server, concurrency=concurrency, engine="asyncio").nagios_exit
+        nagios_exit.assert_called_once_with("CRITICAL", "Failing build(s): docker/test-2 - last succeeded: Unknown, docker/test-3 - last succeeded: 140 days ago")
+
+def test_check_builds_asyncio_chunked(drone_server) -> None:
+    handler, server = drone_server
+    handler.chunked = True
+    nagios_exit = run_check(server, concurrency=4, engine="asyncio").nagios_exit
+    nagios_exit.assert_called_once_with("CRITICAL", "Failing build(s): docker/test-2 - last succeeded: Unknown, docker/test-3 - last succeeded: 140 days ago")
+
+def test_check_builds_asyncio_matches_threads(drone_server) -> None:
+    handler, server = drone_server
+    asyncio = run_check(server, 300, 999999999, concurrency=4, engine="asyncio")
+    threads = run_check(server, 300, 999999999, concurrency=4)
+    assert asyncio.nagios_exit.call_args_list == threads.nagios_exit.call_args_list
+
+def test_check_builds_asyncio_malformed_builds(drone_server, capsys) -> None:
+    handler, server = drone_server
+    handler.errors = {"repos/docker/test-1/builds": 202}
+    check = CheckDroneBuilds(server, TOKEN, "", 86400, 172800, True, concurrency=4, engine="asyncio")
+    with pytest.raises(SystemExit) as system_exit:
+        check.check_builds()
+    captured = capsys.readouterr()
+    # only that repo is UNKNOWN
+    assert captured.out.startswith("CRITICAL - Failing build(s): docker/test-2 - last succeeded: Unknown, docker/test-3 - last succeeded: ")
+    assert "; Error fetching builds: docker/test-1 (invalid JSON) | time=" in captured.out
+    assert system_exit.value.args[0] == 2
+
+def test_check_builds_asyncio_error(drone_server, capsys) -> None:
+    handler, server = drone_server
+    handler.errors = {"repos/docker/test-2/builds": 401, "repos/docker/test-3/builds": 401}
+    check = CheckDroneBuilds(server, TOKEN, "", 86400, 172800, True, concurrency=4, engine="asyncio")
+    with pytest.raises(SystemExit) as system_exit:
+        check.check_builds()
+    captured = capsys.readouterr()
+    assert captured.out.startswith("UNKNOWN - Drone API /api/repos/docker/test-2/builds HTTP status code is 401 | time=")
+    assert system_exit.value.args[0] == 3
+
+def test_script_main_latest():
+    test_args = ["check_drone_builds.py", "--server", SERVER, "--token", TOKEN, "--latest"]
+    with patch('sys.argv', test_args):
+        with patch("check_drone_builds.CheckDroneBuilds") as mock_main:
+            main()
+            mock_main.assert_called_with(SERVER, TOKEN, "", 9999999999, 9999999999, False, **check_options(latest=True))
+
+def get_all_repos_latest_json() -> list:
+    repos = get_all_repos_json()
+    repos[0]["build"] = {"number": 186, "status": "success", "finished": TIME - 100}
+    repos[1]["build"] = {"number": 183, "status": "failure", "finished": TIME - 100}
+    repos[2]["build"] = get_builds_json("docker", "test-3")[-1] # succeeded, but too long ago
+    repos[4]["build"] = {"number": 3, "status": "success", "finished": TIME - 100} # inactive
+    return repos
+
+def test_check_builds_latest() -> None:
+    for latest in [True, False]:
+        check = CheckDroneBuilds(SERVER, TOKEN, "", 86400, 172800, True, latest=latest)
+        check.get_all_repos = MagicMock()
+        check.get_builds_for_repo = MagicMock()
+        check.nagios_exit = MagicMock()
+        check.get_current_time = MagicMock()
+
+        check.get_all_repos.return_value = get_all_repos_latest_json()
+        check.get_builds_for_repo.side_effect = lambda owner, repo, page: [{"status": "success", "finished": TIME - 100}] if repo == "test-1" else get_builds_json(owner, repo)
+        check.get_current_time.return_value = TIME
+        check.check_builds()
+
+        check.nagios_exit.assert_called_once_with("CRITICAL", "Failing build(s): docker/test-2 - last succeeded: Unknown, docker/test-3 - last succeeded: 140 days ago")
+        if latest:
+            assert check.get_builds_for_repo.call_args_list == [call("docker", "test-2", 1), call("docker", "test-3", 1), call("docker", "test-4", 1)]
+        else:
+            assert check.get_builds_for_repo.call_count == 4
+
+def test_check_builds_latest_all_ok() -> None:
+    check = CheckDroneBuilds(SERVER, TOKEN, NAMESPACE, 86400, 172800, True, latest=True)
+    check.get_all_repos = MagicMock()
+    check.get_builds_for_repo = MagicMock()
+    check.nagios_exit = MagicMock()
+    check.get_current_time = MagicMock()
+
+    repos = get_all_repos_latest_json()
+    check.get_all_repos.return_value = [repos[0]]
+    check.get_current_time.return_value = TIME
+    check.check_builds()
+
+    check.get_builds_for_repo.assert_not_called()
+    check.nagios_exit.assert_called_once_with("OK", "docker/test-1 - last succeeded: 1 minute ago")
+
+def test_get_all_repos_latest(drone_server) -> None:
+    handler, server = drone_server
+    check = CheckDroneBuilds(server, TOKEN, NAMESPACE, 0, 0, latest=True)
+    assert check.get_all_repos() == [Repo.from_dict(repo) for repo in get_all_repos_json()]
+    assert handler.paths == ["/api/user/repos?per_page=1000&latest=true"]
+
+def test_script_main_filters():
+    test_args = ["check_drone_builds.py", "--server", SERVER, "--token", TOKEN, "--branch", "main", "--branch", "release/1.0", "--event", "push"]
+    with patch('sys.argv', test_args):
+        with patch("check_drone_builds.CheckDroneBuilds") as mock_main:
+            main()
+            mock_main.assert_called_with(SERVER, TOKEN, "", 9999999999, 9999999999, False, **check_options(branches=["main", "release/1.0"], events=["push"]))
+
+    with patch('sys.argv', test_args[:5] + ["--event", "merge"]):
+        with pytest.raises(SystemExit) as system_exit:
+            main()
+    assert system_exit.value.args[0] == 2
+
+def test_get_builds_url_branch() -> None:
+    # Drone filters by a single branch, several are filtered here
+    check = CheckDroneBuilds(SERVER, TOKEN, NAMESPACE, 0, 0, branches=["release/1.0"], events=["push"])
+    assert check.get_builds_url("docker", "test-1") == f"https://{SERVER}/api/repos/docker/test-1/builds?page=1&per_page=25&branch=release%2F1.0"
+    check = CheckDroneBuilds(SERVER, TOKEN, NAMESPACE, 0, 0, branches=["main", "master"])
+    assert check.get_builds_url("docker", "test-1") == f"https://{SERVER}/api/repos/docker/test-1/builds?page=1&per_page=25"
+    # it matches the ref of the builds, pull requests are built from refs/pull/N/head
+    check = CheckDroneBuilds(SERVER, TOKEN, NAMESPACE, 0, 0, branches=["main"], events=["push", "pull_request"])
+    assert check.get_builds_url("docker", "test-1") == f"https://{SERVER}/api/repos/docker/test-1/builds?page=1&per_page=25"
+
+def test_check_builds_filters(drone_server) -> None:
+    handler, server = drone_server
+    # the newest builds of docker/test-1 are cron builds, its last successful push was 11 days ago
+    for engine in ["threads", "asyncio"]:
+        for stream in [False, True]:
+            nagios_exit = run_check(server, engine=engine, stream=stream, events=["push"]).nagios_exit
+            nagios_exit.assert_called_once_with("CRITICAL", "Failing build(s): docker/test-1 - last succeeded: 11 days ago")
+    nagios_exit = run_check(server, events=["push", "cron"], branches=["master", "main"]).nagios_exit
+    nagios_exit.assert_called_once_with("CRITICAL", "Failing build(s): docker/test-2 - last succeeded: Unknown, docker/test-3 - last succeeded: 140 days ago")
+
+    # repos without any builds of the branch are unknown, rather than failing
+    handler.paths.clear()
+    nagios_exit = run_check(server, branches=["develop"]).nagios_exit
+    nagios_exit.assert_called_once_with("UNKNOWN", "Unknown build status: docker/test-1, docker/test-2, docker/test-3, docker/test-4")
+    assert all(path.endswith("&branch=develop") for path in handler.paths[1:])
+
+def test_check_builds_filters_pull_requests() -> None:
+    builds = [
+        {"number": 4, "status": "success", "finished": TIME - 60, "event": "pull_request", "ref": "refs/pull/3/head", "target": "develop"},
+        {"number": 3, "status": "success", "finished": TIME - 600, "event": "pull_request", "ref": "refs/pull/2/head", "target": "main"},
+        {"number": 2, "status": "failure", "finished": TIME - 900, "event": "push", "ref": "refs/heads/main", "target": "main"},
+        {"number": 1, "status": "success", "finished": TIME - 86400 * 3, "event": "push", "ref": "refs/heads/main", "target": "main"},
+    ]
+    for events, expected in [
+        (["pull_request"], ("OK", "docker/test-1 - last succeeded: 10 minutes ago")),
+        (["push"], ("CRITICAL", "Failing build(s): docker/test-1 - last succeeded: 3 days ago")),
+        # the pull requests only count when they are asked for
+        ([], ("CRITICAL", "Failing build(s): docker/test-1 - last succeeded: 3 days ago")),
+    ]:
+        check = CheckDroneBuilds(SERVER, TOKEN, "", 86400, 172800, branches=["main"], events=events)
+        check.get_all_repos = MagicMock(return_value=get_all_repos_json()[:1])
+        check.get_builds_for_repo = MagicMock(return_value=[Build.from_dict(build) for build in builds])
+        check.nagios_exit = MagicMock()
+        check.get_current_time = MagicMock(return_value=TIME)
+        check.check_builds()
+        check.nagios_exit.assert_called_once_with(*expected)
+
+def test_check_builds_filters_latest() -> None:
+    check = CheckDroneBuilds(SERVER, TOKEN, "", 86400, 172800, True, latest=True, branches=["main"])
+    check.get_all_repos = MagicMock()
+    check.get_builds_for_repo = MagicMock()
+    check.nagios_exit = MagicMock()
+    check.get_current_time = MagicMock()
+    repos = get_all_repos_latest_json()
+    repos[0]["build"] |= {"event": "push", "ref": "refs/heads/feature"}
+    check.get_all_repos.return_value = repos
+    check.get_builds_for_repo.side_effect = get_builds_json
+    check.get_current_time.return_value = TIME
+    check.check_builds()
+    # the latest build of docker/test-1 succeeded, but not on the main branch
+    assert call("docker", "test-1", 1) in check.get_builds_for_repo.call_args_list
+
+def test_check_builds_filters_state_file(drone_server, tmp_path) -> None:
+    _, server = drone_server
+    state_file = tmp_path / "state.json"
+    run_check(server, state_file=str(state_file))
+    run_check(server, state_file=str(state_file), events=["push"])
+    state = json.loads(state_file.read_text())
+    # both checks keep their own last successful builds
+    assert state["repos"]["docker/test-1"]["last_successful_build"] == 1749334777
+    assert state["repos event=push"]["docker/test-1"]["last_successful_build"] == 1748440134
+    assert "docker/test-2" not in state["repos event=push"]
+
+def test_script_main_state_file():
+    test_args = ["check_drone_builds.py", "--server", SERVER, "--token", TOKEN, "--state-file", "/var/tmp/drone.json"]
+    with patch('sys.argv', test_args):
+        with patch("check_drone_builds.CheckDroneBuilds") as mock_main:
+            main()
+            mock_main.assert_called_with(SERVER, TOKEN, "", 9999999999, 9999999999, False, **check_options(state_file="/var/tmp/drone.json"))
+
+def check_builds_state_file(state_file: Path, warning: int, critical: int) -> CheckDroneBuilds:
+    check = CheckDroneBuilds(SERVER, TOKEN, "", warning, critical, True, state_file=str(state_file))
+    check.get_all_repos = MagicMock()
+    check.get_builds_for_repo = MagicMock()
+    check.nagios_exit = MagicMock()
+    check.get_current_time = MagicMock()
+
+    check.get_all_repos.return_value = get_all_repos_json()
+    check.get_builds_for_repo.side_effect = get_builds_json
+    check.get_current_time.return_value = TIME
+    check.check_builds()
+    return check
+
+def test_check_builds_state_file(tmp_path) -> None:
+    state_file = tmp_path / "state.json"
+    check = check_builds_state_file(state_file, 86400, 172800)
+    assert check.get_builds_for_repo.call_count == 4
+    check.nagios_exit.assert_called_once_with("CRITICAL", "Failing build(s): docker/test-2 - last succeeded: Unknown, docker/test-3 - last succeeded: 140 days ago")
+    assert json.loads(state_file.read_text()) == {"repos": {
+        "docker/test-1": {"last_successful_build": 1749334777, "build_number": 185},
+        "docker/test-2": {"build_number": 182},
+        "docker/test-3": {"last_successful_build": 1737246555, "build_number": 182},
+    }}
+    assert sorted(tmp_path.iterdir()) == [state_file, tmp_path / "state.json.lock"] # no temporary files left behind
+
+    # docker/test-1 succeeded 1 day ago, it can't be failing before the warning/critical window of 2 days ends
+    check = check_builds_state_file(state_file, 172800, 172800)
+    assert check.get_builds_for_repo.call_args_list == [call("docker", "test-2", 1), call("docker", "test-3", 1), call("docker", "test-4", 1)]
+    check.nagios_exit.assert_called_once_with("CRITICAL", "Failing build(s): docker/test-2 - last succeeded: Unknown, docker/test-3 - last succeeded: 140 days ago")
+
+    # but with a smaller window it could be, so it is polled again
+    check = check_builds_state_file(state_file, 3600, 172800)
+    assert check.get_builds_for_repo.call_count == 4
+    check.nagios_exit.assert_called_once_with("CRITICAL", "Failing build(s): docker/test-2 - last succeeded: Unknown, docker/test-3 - last succeeded: 140 days ago")
+
+def test_check_builds_state_file_merges(tmp_path) -> None:
+    state_file = tmp_path / "state.json"
+    state_file.write_text(json.dumps({"repos": {
+        "docker/test-1": {"last_successful_build": TIME}, # newer than what the API returns, as can happen when another check wrote it
+        "random/test-666": {"last_successful_build": 1},
+    }}))
+    check = check_builds_state_file(state_file, 3600, 172800)
+    assert check.get_builds_for_repo.call_args_list == [call("docker", "test-2", 1), call("docker", "test-3", 1), call("docker", "test-4", 1)]
+    assert json.loads(state_file.read_text()) == {"repos": {
+        "docker/test-1": {"last_successful_build": TIME},
+        "docker/test-2": {"build_number": 182},
+        "docker/test-3": {"last_successful_build": 1737246555, "build_number": 182},
+        "random/test-666": {"last_successful_build": 1},
+    }}
+
+def test_check_builds_state_file_incremental(tmp_path) -> None:
+    state_file = tmp_path / "state.json"
+    state_file.write_text(json.dumps({"repos": {
+        "docker/test-1": {"last_successful_build": 1, "build_number": 183},
+        # all builds of docker/test-2 have been processed before, only the stored success counts
+        "docker/test-2": {"last_successful_build": TIME - 7200, "build_number": 182},
+        # the successful builds of docker/test-3 are before this one, and were apparently too old to remember
+        "docker/test-3": {"build_number": 170},
+    }}))
+    check = check_builds_state_file(state_file, 3600, 172800)
+    assert check.get_builds_for_repo.call_count == 4
+    check.nagios_exit.assert_called_once_with("CRITICAL", "Failing build(s): docker/test-3 - last succeeded: Unknown")
+    assert json.loads(state_file.read_text()) == {"repos": {
+        "docker/test-1": {"last_successful_build": 1749334777, "build_number": 185},
+        "docker/test-2": {"last_successful_build": TIME - 7200, "build_number": 182},
+        "docker/test-3": {"build_number": 182},
+    }}
+
+def test_check_builds_state_file_renumbered(tmp_path) -> None:
+    # docker/test-1 was deleted and added again, its builds are numbered from 1 again
+    state_file = tmp_path / "state.json"
+    state_file.write_text(json.dumps({"repos": {"docker/test-1": {"last_successful_build": TIME - 86400 * 10, "build_number": 500}}}))
+    check = check_builds_state_file(state_file, 172800, 172800)
+    check.nagios_exit.assert_called_once_with("CRITICAL", "Failing build(s): docker/test-2 - last succeeded: Unknown, docker/test-3 - last succeeded: 140 days ago")
+    assert json.loads(state_file.read_text())["repos"]["docker/test-1"] == {"last_successful_build": 1749334777, "build_number": 185}
+
+    # once the builds of the new repo are in the state, it is incremental again
+    check = check_builds_state_file(state_file, 3600, 172800)
+    assert check.renumbered == set()
+    assert check.build_numbers["docker/test-1"] == 185
+
+def test_find_last_successful_build_unfinished() -> None:
+    check = CheckDroneBuilds(SERVER, TOKEN, NAMESPACE, 0, 0)
+    check.state = {"docker/test-1": {"last_successful_build": 1, "build_number": 8}}
+    builds = [
+        {"number": 12, "status": "running", "finished": 0},
+        {"number": 11, "status": "success", "finished": 300},
+        {"number": 10, "status": "pending", "finished": 0},
+        {"number": 9, "status": "failure", "finished": 100},
+        {"number": 8, "status": "success", "finished": 50},
+    ]
+    assert check.find_last_successful_build("docker/test-1", builds) == 300
+    # builds 10 and 12 can still succeed, so the next run has to start from there
+    assert check.build_numbers == {"docker/test-1": 9}
+
+def test_check_builds_state_file_invalid(tmp_path) -> None:
+    state_file = tmp_path / "state.json"
+    for content in ["Lassie", json.dumps({"repos": []}), json.dumps({"repos": {"docker/test-1": "Lassie", "docker/test-2": {"last_successful_build": "Lassie"}}})]:
+        state_file.write_text(content)
+        check = check_builds_state_file(state_file, 172800, 172800)
+        assert check.get_builds_for_repo.call_count == 4
+        check.nagios_exit.assert_called_once_with("CRITICAL", "Failing build(s): docker/test-2 - last succeeded: Unknown, docker/test-3 - last succeeded: 140 days ago")
+
+def test_check_builds_state_file_unwritable(tmp_path) -> None:
+    check = check_builds_state_file(tmp_path / "missing" / "state.json", 86400, 172800)
+    check.nagios_exit.assert_called_once_with("CRITICAL", "Failing build(s): docker/test-2 - last succeeded: Unknown, docker/test-3 - last succeeded: 140 days ago")
+
+def test_script_main_cache():
+    test_args = ["check_drone_builds.py", "--server", SERVER, "--token", TOKEN, "--cache-dir", "/var/cache/drone", "--cache-size", "5", "--cache-purge"]
+    with patch('sys.argv', test_args):
+        with patch("check_drone_builds.CheckDroneBuilds") as mock_main:
+            main()
+            mock_main.assert_called_with(SERVER, TOKEN, "", 9999999999, 9999999999, False, **check_options(cache_dir="/var/cache/drone", cache_size=5, cache_purge=True))
+
+def check_builds_cache(server: string, cache_dir: Path, engine: string = "threads", **options) -> CheckDroneBuilds:
+    check = run_check(server, engine=engine, cache_dir=str(cache_dir), **options)
+    check.nagios_exit.assert_called_once_with("CRITICAL", "Failing build(s): docker/test-2 - last succeeded: Unknown, docker/test-3 - last succeeded: 140 days ago")
+    return check
+
+def test_check_builds_cache(drone_server, tmp_path) -> None:
+    handler, server = drone_server
+    handler.etags = True
+    for engine in ["threads", "asyncio"]:
+        cache_dir = tmp_path / engine
+        handler.codes.clear()
+        check_builds_cache(server, cache_dir, engine)
+        assert handler.codes == [200] * 5
+        assert len(list(cache_dir.iterdir())) == 5
+
+        handler.codes.clear()
+        with patch("requests.models.Response.json") as mock_json, patch("check_drone_builds.CheckDroneBuilds.parse_builds") as mock_parse_builds:
+            check_builds_cache(server, cache_dir, engine)
+            mock_json.assert_not_called()
+            mock_parse_builds.assert_not_called()
+        assert handler.codes == [304] * 5
+
+def test_check_builds_cache_stream(drone_server, tmp_path) -> None:
+    # a stream that stopped at the first success is not cached, as a check with other filters needs the older builds
+    handler, server = drone_server
+    handler.etags = True
+    for engine in ["threads", "asyncio"]:
+        cache_dir = tmp_path / engine
+        check_builds_cache(server, cache_dir, engine, stream=True)
+        check = CheckDroneBuilds(server, TOKEN, "", 86400, 172800, engine=engine, cache_dir=str(cache_dir), stream=True, events=["push"])
+        check.nagios_exit = MagicMock()
+        check.get_current_time = MagicMock(return_value=TIME)
+        check.check_builds()
+        check.nagios_exit.assert_called_once_with("CRITICAL", "Failing build(s): docker/test-1 - last succeeded: 11 days ago")
+
+def test_check_builds_cache_without_validators(drone_server, tmp_path) -> None:
+    handler, server = drone_server
+    check_builds_cache(server, tmp_path)
+    check_builds_cache(server, tmp_path)
+    assert handler.codes == [200] * 10
+    assert list(tmp_path.iterdir()) == []
+
+def test_check_builds_cache_unwritable(drone_server, tmp_path) -> None:
+    # the cache is only an optimisation, the check neither fails nor retries anything when it can't be written
+    handler, server = drone_server
+    handler.etags = True
+    with patch("check_drone_builds.write_file_atomic", side_effect=OSError(28, "No space left on device")):
+        for options in [{}, {"engine": "asyncio"}, {"repos_ttl": 300}]:
+            check = check_builds_cache(server, tmp_path / "cache", **options)
+            assert check.failed == {} and check.retried == 0
+    (tmp_path / "file").write_text("Lassie")
+    check = check_builds_cache(server, tmp_path / "file" / "cache", repos_ttl=300, cache_purge=True)
+    assert check.failed == {}
+
+def test_check_builds_cache_other_token(drone_server, tmp_path) -> None:
+    handler, server = drone_server
+    handler.etags = True
+    check_builds_cache(server, tmp_path)
+    cache = ResponseCache(str(tmp_path), 1024, "OTHERSECRET")
+    assert cache.get(f"{server}/api/user/repos?per_page=1000") is None
+    cache = ResponseCache(str(tmp_path), 1024, TOKEN)
+    assert cache.get(f"{server}/api/user/repos?per_page=1000")[1] == [Repo.from_dict(repo) for repo in get_all_repos_json()]
+
+def test_check_builds_cache_invalid(drone_server, tmp_path) -> None:
+    handler, server = drone_server
+    handler.etags = True
+    check_builds_cache(server, tmp_path)
+    for path in tmp_path.iterdir():
+        path.write_text("Lassie")
+    handler.codes.clear()
+    check_builds_cache(server, tmp_path)
+    assert handler.codes == [200] * 5
+
+def test_check_builds_cache_evict(drone_server, tmp_path) -> None:
+    handler, server = drone_server
+    handler.etags = True
+    check_builds_cache(server, tmp_path, cache_size=0)
+    assert list(tmp_path.iterdir()) == []
+
+    cache = ResponseCache(str(tmp_path), 2000, TOKEN)
+    for i, data in enumerate([["a" * 900], ["b" * 900], ["c" * 900]]):
+        cache.store(f"https://{SERVER}/{i}", f'"{i}"', None, data)
+        os.utime(cache.get_path(f"https://{SERVER}/{i}"), (TIME + i, TIME + i))
+    cache.get(f"https://{SERVER}/0") # now the most recently used
+    cache.evict()
+    assert cache.get(f"https://{SERVER}/0") is not None
+    assert cache.get(f"https://{SERVER}/1") is None
+    assert cache.get(f"https://{SERVER}/2") is not None
+
+def test_check_builds_cache_purge(drone_server, tmp_path) -> None:
+    handler, server = drone_server
+    handler.etags = True
+    check_builds_cache(server, tmp_path)
+    handler.codes.clear()
+    check_builds_cache(server, tmp_path, cache_purge=True)
+    assert handler.codes == [200] * 5
+    assert len(list(tmp_path.iterdir())) == 5
+
+def test_script_main_repos_ttl():
+    test_args = ["check_drone_builds.py", "--server", SERVER, "--token", TOKEN, "--cache-dir", "/tmp/cache", "--repos-ttl", "60"]
+    with patch('sys.argv', test_args):
+        with patch("check_drone_builds.CheckDroneBuilds") as mock_main:
+            main()
+            mock_main.assert_called_with(SERVER, TOKEN, "", 9999999999, 9999999999, False, **check_options(cache_dir="/tmp/cache", repos_ttl=60))
+
+    with patch('sys.argv', test_args[:5] + test_args[7:]):
+        with pytest.raises(SystemExit) as system_exit:
+            main()
+    assert system_exit.value.args[0] == 2
+
+def get_repos_requests(paths: list) -> int:
+    return sum(path.startswith("/api/user/repos") for path in paths)
+
+def test_check_builds_repos_ttl(drone_server, tmp_path) -> None:
+    handler, server = drone_server
+    handler.etags = True
+    check_builds_cache(server, tmp_path, repos_ttl=60)
+    check_builds_cache(server, tmp_path, repos_ttl=60)
+    assert get_repos_requests(handler.paths) == 1
+
+    # once it expired, it is revalidated and fresh again for another 60 seconds
+    check = CheckDroneBuilds(server, TOKEN, "", 86400, 172800, cache_dir=str(tmp_path), repos_ttl=60)
+    check.get_current_time = MagicMock()
+    for now in [TIME + 61, TIME + 120]:
+        check.get_current_time.return_value = now
+        assert len(check.get_all_repos()) == 7
+    assert get_repos_requests(handler.paths) == 2
+    assert handler.codes[-1] == 304
+
+def test_check_builds_repos_ttl_single_flight(drone_server, tmp_path) -> None:
+    handler, server = drone_server
+    handler.delay = 0.2
+    checks = [CheckDroneBuilds(server, TOKEN, namespace, 86400, 172800, cache_dir=str(tmp_path), repos_ttl=60) for namespace in ["docker", "random"] * 3]
+    with ThreadPoolExecutor(max_workers=len(checks)) as executor:
+        results = list(executor.map(lambda check: check.get_all_repos(), checks))
+    assert get_repos_requests(handler.paths) == 1
+    assert all(len(result) == 7 for result in results)
+
+def test_script_main_pages():
+    test_args = ["check_drone_builds.py", "--server", SERVER, "--token", TOKEN, "--per-page", "100", "--max-pages", "3"]
+    with patch('sys.argv', test_args):
+        with patch("check_drone_builds.CheckDroneBuilds") as mock_main:
+            main()
+            mock_main.assert_called_with(SERVER, TOKEN, "", 9999999999, 9999999999, False, **check_options(per_page=100, max_pages=3))
+
+def get_pages(paths: list, repo: string) -> list:
+    return [int(parse_qs(urlsplit(path).query)["page"][0]) for path in paths if f"/{repo}/" in path]
+
+def test_check_builds_pages(drone_server) -> None:
+    handler, server = drone_server
+    for engine in ["threads", "asyncio"]:
+        handler.paths.clear()
+        nagios_exit = run_check(server, 86400, 12182600, engine=engine, per_page=10).nagios_exit
+        nagios_exit.assert_called_once_with("CRITICAL", "Failing build(s): docker/test-2 - last succeeded: Unknown")
+        assert get_pages(handler.paths, "test-1") == [1]
+        assert get_pages(handler.paths, "test-2") == [1, 2]
+        assert get_pages(handler.paths, "test-3") == [1, 2]
+        assert get_pages(handler.paths, "test-4") == [1]
+
+def test_check_builds_pages_success_beyond_first_page() -> None:
+    check = CheckDroneBuilds(SERVER, TOKEN, NAMESPACE, 86400, 9999999999, True)
+    check.get_all_repos = MagicMock()
+    check.get_builds_for_repo = MagicMock()
+    check.nagios_exit = MagicMock()
+    check.get_current_time = MagicMock()
+
+    builds = get_builds_json("docker", "test-1")
+    check.get_all_repos.return_value = [get_all_repos_json()[0]]
+    check.get_builds_for_repo.side_effect = [builds[3:21] + builds[3:10], builds[:3]] # 25 failed builds, then the successful ones
+    check.get_current_time.return_value = TIME
+    check.check_builds()
+
+    assert check.get_builds_for_repo.call_args_list == [call("docker", "test-1", 1), call("docker", "test-1", 2)]
+    check.nagios_exit.assert_called_once_with("OK", "docker/test-1 - last succeeded: 1 day ago")
+
+def test_check_builds_pages_max_pages(drone_server) -> None:
+    handler, server = drone_server
+    nagios_exit = run_check(server, 86400, 9999999999, per_page=5).nagios_exit
+    nagios_exit.assert_called_once_with("CRITICAL", "Failing build(s): docker/test-2 - last succeeded: Unknown")
+    assert get_pages(handler.paths, "test-2") == [1, 2, 3, 4]
+    assert get_pages(handler.paths, "test-3") == [1, 2, 3, 4]
+
+    handler.paths.clear()
+    nagios_exit = run_check(server, 86400, 9999999999, per_page=5, max_pages=2).nagios_exit
+    nagios_exit.assert_called_once_with("CRITICAL", "Failing build(s): docker/test-2 - last succeeded: Unknown, docker/test-3 - last succeeded: Unknown")
+    assert get_pages(handler.paths, "test-3") == [1, 2]
+
+def test_check_builds_pages_older_than_critical(drone_server) -> None:
+    handler, server = drone_server
+    # the second page of docker/test-2 ends with a build older than 60 days, anything before that is CRITICAL anyway
+    nagios_exit = run_check(server, 86400, 86400 * 60, engine="asyncio", per_page=5).nagios_exit
+    nagios_exit.assert_called_once_with("CRITICAL", "Failing build(s): docker/test-2 - last succeeded: Unknown, docker/test-3 - last succeeded: Unknown")
+    assert get_pages(handler.paths, "test-2") == [1, 2]
+    assert get_pages(handler.paths, "test-3") == [1, 2]
+
+def test_check_builds_pages_high_water_mark(drone_server, tmp_path) -> None:
+    handler, server = drone_server
+    state_file = tmp_path / "state.json"
+    state_file.write_text(json.dumps({"repos": {"docker/test-2": {"build_number": 175}}}))
+    run_check(server, 86400, 9999999999, per_page=5, state_file=str(state_file))
+    assert get_pages(handler.paths, "test-2") == [1, 2]
+
+    # unless the repo was renumbered, then all of its pages are new
+    handler.paths.clear()
+    state_file.write_text(json.dumps({"repos": {"docker/test-2": {"build_number": 500}}}))
+    run_check(server, 86400, 9999999999, per_page=5, state_file=str(state_file))
+    assert get_pages(handler.paths, "test-2") == [1, 2, 3, 4]
+
+def test_script_main_stream():
+    test_args = ["check_drone_builds.py", "--server", SERVER, "--token", TOKEN, "--stream"]
+    with patch('sys.argv', test_args):
+        with patch("check_drone_builds.CheckDroneBuilds") as mock_main:
+            main()
+            mock_main.assert_called_with(SERVER, TOKEN, "", 9999999999, 9999999999, False, **check_options(stream=True))
+
+def test_build_stream() -> None:
+    content = json.dumps([{"number": 3, "status": "failure", "message": "caf\u00e9 \u2603"}, {"number": 2, "status": "success"}, {"number": 1}], ensure_ascii=False).encode()
+    for size in [1, 2, 7, len(content)]:
+        stream = BuildStream()
+        stopped = [stream.feed(content[i:i + size]) for i in range(0, len(content), size)]
+        assert stopped[-1] and not stream.complete and stream.error is None
+        assert stream.builds == [Build(3, "failure", None, None), Build(2, "success", None, None)]
+
+def test_records() -> None:
+    repos = json.loads(get_api_response("user/repos", 200), object_hook=Repo.decode)
+    assert repos[0] == Repo("docker", "test-1", "docker/test-1", True, None)
+    assert not hasattr(repos[0], "__dict__")
+    assert repos[0].get("slug") == "docker/test-1" and repos[0].get("git_http_url", "") == ""
+
+    repo = Repo.decode({"id": 1, "namespace": "docker", "name": "test", "slug": "docker/test", "active": True, "build": get_builds_json("docker", "test-1")[0]})
+    assert repo.build == Build(185, "success", 1749334777, 1749334673, "cron", "refs/heads/master", "master")
+    assert Record.load(Record.dump(repo)) == repo
+    assert Record.load(Record.dump({"number": 1})) == {"number": 1}
+
+def test_records_memory() -> None:
+    # memory stays flat as the number of repos grows, as only the projected records are kept
+    repo = get_all_repos_json()[0]
+    content = json.dumps([repo | {"id": i, "name": f"test-{i}", "slug": f"docker/test-{i}"} for i in range(2000)]).encode()
+    usage = []
+    for object_hook in [None, Repo.decode]:
+        tracemalloc.start()
+        data = json.loads(content, object_hook=object_hook)
+        usage.append(tracemalloc.get_traced_memory()) # (kept, peak)
+        tracemalloc.stop()
+        del data
+    assert usage[1][0] < usage[0][0] / 3
+    assert usage[1][1] < usage[0][1] * 0.6 # most of it is the decoded text of the response
+
+def test_build_stream_high_water_mark() -> None:
+    stream = BuildStream(high_water_mark=4)
+    assert not stream.feed(b'[{"number": 6, "status": "failure"}, {"number": 5, "status": "running"}, 4')
+    assert stream.feed(b'0, {"number": 4}]')
+    assert [build if isinstance(build, int) else build.number for build in stream.builds] == [6, 5, 40, 4]
+
+def test_build_stream_renumbered() -> None:
+    # the newest build is older than the high water mark, all of them are new
+    stream = BuildStream(high_water_mark=500)
+    assert not stream.feed(b'[{"number": 3, "status": "failure"}, {"number": 2, "status": "running"}, ')
+    assert stream.feed(b'{"number": 1, "status": "success"}]')
+    assert [build.number for build in stream.builds] == [3, 2, 1]
+
+def test_build_stream_complete() -> None:
+    stream = BuildStream()
+    assert not stream.feed(b' [ {"number": 2, "status": "failure"} , {"number": 1, "status": "error"} ] ')
+    assert not stream.feed(b"", final=True)
+    assert stream.complete and len(stream.builds) == 2
+
+    stream = BuildStream()
+    assert not stream.feed(b"[]", final=True)
+    assert stream.complete and stream.builds == []
+
+def test_build_stream_invalid() -> None:
+    for content in [b'{"number": 1}', b'[{"number": 1}', b'[{"number": 1},]', b'[{"number": 1} {"number": 2}]', b'[\xff]', b""]:
+        stream = BuildStream()
+        assert stream.feed(content, final=True)
+        assert isinstance(stream.error, ValueError)
+
+def test_check_builds_stream(drone_server) -> None:
+    handler, server = drone_server
+    for chunked in [False, True]:
+        handler.chunked = chunked
+        for engine in ["threads", "asyncio"]:
+            for critical in [172800, 9999999999]:
+                expected = run_check(server, 86400, critical, engine=engine).nagios_exit
+                assert run_check(server, 86400, critical, engine=engine, stream=True).nagios_exit.call_args_list == expected.call_args_list
+
+def test_get_builds_for_repo_stream(drone_server) -> None:
+    handler, server = drone_server
+    for chunked in [False, True]:
+        handler.chunked = chunked
+        check = CheckDroneBuilds(server, TOKEN, NAMESPACE, 0, 0, stream=True)
+        # the newest build of docker/test-1 succeeded, nothing after it is kept
+        assert [build.number for build in check.get_builds_for_repo("docker", "test-1")] == [185]
+        assert [build.number for build in asyncio.run(check.get_builds_for_repo_async("docker", "test-1"))] == [185]
+        assert len(check.get_builds_for_repo("docker", "test-2")) == 18
+        assert len(asyncio.run(check.get_builds_for_repo_async("docker", "test-2"))) == 18
+
+def test_get_builds_for_repo_stream_error_malformed(drone_server) -> None:
+    handler, server = drone_server
+    for code in [201, 202]:
+        handler.errors["repos/docker/test-1/builds"] = code
+        check = CheckDroneBuilds(server, TOKEN, NAMESPACE, 0, 0, stream=True)
+        for get_builds in [check.get_builds_for_repo, lambda owner, repo: asyncio.run(check.get_builds_for_repo_async(owner, repo))]:
+            check.nagios_exit = MagicMock()
+            with pytest.raises(RepoError, match="invalid JSON"):
+                get_builds("docker", "test-1")
+            check.nagios_exit.assert_not_called()
+
 def test_check_builds_get_all_repos_no_repos() -> None:
     check = CheckDroneBuilds(SERVER, TOKEN, "", 86400, 172800, True)
     check.get_all_repos = MagicMock()
@@ -338,10 +1146,11 @@ def test_check_builds_get_builds_for_repo_incomplete_data() -> None:
         pass
     check.nagios_exit.assert_called_once_with("UNKNOWN", "Unknown build status: docker/test-1")
 
-def mocked_requests_get(*args, **kwargs) -> Response | None:
-    request_url = args[0]
-    auth_header = kwargs['headers']['Authorization']
+def mocked_adapter_send(request: PreparedRequest, **kwargs) -> Response | None:
+    request_url = request.url
+    auth_header = request.headers['Authorization']
     assert auth_header == f"Bearer {TOKEN}"
+    assert kwargs['timeout'] == (10, 30)
 
     match  = re.search(f"^https:\\/\\/{SERVER}:(?P<response_code>\\d+)\\/api/(?P<uri>\\S+)$", request_url)
 
@@ -363,13 +1172,13 @@ def mocked_requests_get(*args, **kwargs) -> Response | None:
         pytest.fail(f"URL[={request_url}] not parsable")
         return None
 
-@patch("requests.get", side_effect=mocked_requests_get)
+@patch("requests.adapters.HTTPAdapter.send", side_effect=mocked_adapter_send)
 def test_get_all_repos(mock_get, capsys) -> None:
     check = CheckDroneBuilds(f"{SERVER}:200", TOKEN, NAMESPACE, 0, 0)
     repos = check.get_all_repos()
-    assert repos == get_all_repos_json()
+    assert repos == [Repo.from_dict(repo) for repo in get_all_repos_json()]
 
-@patch("requests.get", side_effect=mocked_requests_get)
+@patch("requests.adapters.HTTPAdapter.send", side_effect=mocked_adapter_send)
 def test_get_all_repos_error(mock_get, capsys) -> None:
     check = CheckDroneBuilds(f"{SERVER}:401", TOKEN, NAMESPACE, 0, 0)
     check.nagios_exit = MagicMock()
@@ -380,7 +1189,7 @@ def test_get_all_repos_error(mock_get, capsys) -> None:
         pass
     check.nagios_exit.assert_called_once_with("UNKNOWN", "Drone API /api/user/repos HTTP status code is 401")
 
-@patch("requests.get", side_effect=mocked_requests_get)
+@patch("requests.adapters.HTTPAdapter.send", side_effect=mocked_adapter_send)
 def test_get_all_repos_error_malformed(mock_get) -> None:
     check = CheckDroneBuilds(f"{SERVER}:201", TOKEN, NAMESPACE, 0, 0)
     check.nagios_exit = MagicMock()
@@ -391,7 +1200,7 @@ def test_get_all_repos_error_malformed(mock_get) -> None:
         pass
     check.nagios_exit.assert_called_once_with("UNKNOWN", "Drone API did not respond with valid JSON (Returned code HTTP 200)")
 
-@patch("requests.get", side_effect=mocked_requests_get)
+@patch("requests.adapters.HTTPAdapter.send", side_effect=mocked_adapter_send)
 def test_get_all_repos_error_weird_json(mock_get) -> None:
     check = CheckDroneBuilds(f"{SERVER}:202", TOKEN, NAMESPACE, 0, 0)
     check.nagios_exit = MagicMock()
@@ -402,13 +1211,13 @@ def test_get_all_repos_error_weird_json(mock_get) -> None:
         pass
     check.nagios_exit.assert_called_once_with("UNKNOWN", "Drone API did not respond with valid JSON (Returned code HTTP 200)")
 
-@patch("requests.get", side_effect=mocked_requests_get)
+@patch("requests.adapters.HTTPAdapter.send", side_effect=mocked_adapter_send)
 def test_get_builds_for_repo(mock_get) -> None:
     check = CheckDroneBuilds(f"{SERVER}:200", TOKEN, NAMESPACE, 0, 0)
     builds = check.get_builds_for_repo('docker', 'test-4')
-    assert builds == get_builds_json('docker', 'test-4')
+    assert builds == [Build.from_dict(build) for build in get_builds_json('docker', 'test-4')]
 
-@patch("requests.get", side_effect=mocked_requests_get)
+@patch("requests.adapters.HTTPAdapter.send", side_effect=mocked_adapter_send)
 def test_get_builds_for_repo_error(mock_get):
     check = CheckDroneBuilds(f"{SERVER}:401", TOKEN, NAMESPACE, 0, 0)
     check.nagios_exit = MagicMock()
@@ -419,27 +1228,583 @@ def test_get_builds_for_repo_error(mock_get):
         pass
     check.nagios_exit.assert_called_once_with("UNKNOWN", "Drone API /api/repos/docker/test-1/builds HTTP status code is 401")
 
-@patch("requests.get", side_effect=mocked_requests_get)
+@patch("requests.adapters.HTTPAdapter.send", side_effect=mocked_adapter_send)
 def test_get_builds_for_repo_error_malformed(mock_get) -> None:
     check = CheckDroneBuilds(f"{SERVER}:201", TOKEN, NAMESPACE, 0, 0)
     check.nagios_exit = MagicMock()
-    check.nagios_exit.side_effect = ValueError("STOP")  # just so it stops executing any other code, as it would in IRL
-    try:
+    with pytest.raises(RepoError, match="invalid JSON"):
         check.get_builds_for_repo("docker", "test-1")
-    except Exception:
-        pass
-    check.nagios_exit.assert_called_once_with("UNKNOWN", "Drone API did not respond with valid JSON for /api/repos/docker/test-1/builds (Returned code HTTP 200)")
+    check.nagios_exit.assert_not_called()
 
-@patch("requests.get", side_effect=mocked_requests_get)
+@patch("requests.adapters.HTTPAdapter.send", side_effect=mocked_adapter_send)
 def test_get_builds_for_repo_error_weird_json(mock_get) -> None:
     check = CheckDroneBuilds(f"{SERVER}:202", TOKEN, NAMESPACE, 0, 0)
     check.nagios_exit = MagicMock()
-    check.nagios_exit.side_effect = ValueError("STOP")  # just so it stops executing any other code, as it would in IRL
-    try:
+    with pytest.raises(RepoError, match="invalid JSON"):
         check.get_builds_for_repo("docker", "test-1")
-    except Exception:
-        pass
-    check.nagios_exit.assert_called_once_with("UNKNOWN", "Drone API did not respond with valid JSON for /api/repos/docker/test-1/builds (Returned code HTTP 200)")
+    check.nagios_exit.assert_not_called()
+
+def test_script_main_session_options():
+    test_args = ["check_drone_builds.py", "--server", SERVER, "--token", TOKEN, "--pool-size", "4", "--keepalive", "0", "--connect-timeout", "2.5", "--read-timeout", "5"]
+    with patch('sys.argv', test_args):
+        with patch("check_drone_builds.CheckDroneBuilds") as mock_main:
+            main()
+            mock_main.assert_called_with(SERVER, TOKEN, "", 9999999999, 9999999999, False, **check_options(pool_size=4, keepalive=0, connect_timeout=2.5, read_timeout=5))
+
+def test_session() -> None:
+    check = CheckDroneBuilds(SERVER, TOKEN, NAMESPACE, 0, 0, concurrency=20)
+    assert check.session.headers["Authorization"] == f"Bearer {TOKEN}"
+    assert check.session.headers["Connection"] == "keep-alive"
+    adapter = check.session.get_adapter(f"https://{SERVER}")
+    assert adapter._pool_maxsize == 20
+    assert adapter._pool_block
+    assert check.get_connection_stats() == (0, 0)
+
+    check = CheckDroneBuilds(SERVER, TOKEN, NAMESPACE, 0, 0, pool_size=3, keepalive=0)
+    assert check.session.headers["Connection"] == "close"
+    assert check.session.get_adapter(f"https://{SERVER}")._pool_maxsize == 3
+
+def test_session_reuses_connections(drone_server) -> None:
+    handler, server = drone_server
+    check = CheckDroneBuilds(server, TOKEN, "", 86400, 172800, True, concurrency=2)
+    check.nagios_exit = MagicMock()
+    check.get_current_time = MagicMock()
+    check.get_current_time.return_value = TIME
+    check.check_builds()
+
+    check.nagios_exit.assert_called_once_with("CRITICAL", "Failing build(s): docker/test-2 - last succeeded: Unknown, docker/test-3 - last succeeded: 140 days ago")
+    opened, reused = check.get_connection_stats()
+    assert opened <= 2
+    assert opened + reused == 5
+
+def test_session_keepalive_disabled(drone_server) -> None:
+    handler, server = drone_server
+    check = CheckDroneBuilds(server, TOKEN, "", 86400, 172800, True, keepalive=0)
+    check.nagios_exit = MagicMock()
+    check.get_current_time = MagicMock()
+    check.get_current_time.return_value = TIME
+    check.check_builds()
+    assert check.get_connection_stats() == (5, 0)
+
+def test_asyncio_reuses_connections(drone_server) -> None:
+    handler, server = drone_server
+    for chunked in [False, True]:
+        handler.chunked = chunked
+        check = CheckDroneBuilds(server, TOKEN, "", 86400, 172800, True, concurrency=1, engine="asyncio")
+        check.nagios_exit = MagicMock()
+        check.get_current_time = MagicMock()
+        check.get_current_time.return_value = TIME
+        check.check_builds()
+
+        check.nagios_exit.assert_called_once_with("CRITICAL", "Failing build(s): docker/test-2 - last succeeded: Unknown, docker/test-3 - last succeeded: 140 days ago")
+        # 1 connection for the repos (requests session) + 1 for the builds (asyncio), the asyncio one is reused 3 times
+        assert check.get_connection_stats() == (2, 3)
+
+def test_script_main_transport():
+    test_args = ["check_drone_builds.py", "--server", SERVER, "--token", TOKEN, "--transport", "stdlib"]
+    with patch('sys.argv', test_args):
+        with patch("check_drone_builds.CheckDroneBuilds") as mock_main:
+            main()
+            mock_main.assert_called_with(SERVER, TOKEN, "", 9999999999, 9999999999, False, **check_options(transport="stdlib"))
+
+def test_import_is_lazy() -> None:
+    code = "import sys, check_drone_builds; print(sorted({'requests', 'asyncio', 'ssl', 'http.server'} & set(sys.modules)))"
+    output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout
+    assert output.strip() == "[]"
+
+def test_check_builds_stdlib(drone_server) -> None:
+    handler, server = drone_server
+    for chunked, gzip_encoded in [(False, False), (True, False), (False, True), (True, True)]:
+        handler.chunked = chunked
+        handler.gzip = gzip_encoded
+        for stream in [False, True]:
+            check = run_check(server, transport="stdlib", concurrency=2, stream=stream)
+            check.nagios_exit.assert_called_once_with("CRITICAL", "Failing build(s): docker/test-2 - last succeeded: Unknown, docker/test-3 - last succeeded: 140 days ago")
+            opened, reused = check.get_connection_stats()
+            # a stream that stopped early (docker/test-1 and docker/test-3) closes its connection
+            assert opened <= (4 if stream else 2)
+            assert opened + reused == 5
+
+def test_check_builds_stdlib_matches_requests(drone_server) -> None:
+    handler, server = drone_server
+    for errors in [{}, {"repos/docker/test-2/builds": 401}, {"repos/docker/test-1/builds": 202}, {"user/repos": 500}]:
+        handler.errors = errors
+        results = []
+        for transport in ["requests", "stdlib"]:
+            check = CheckDroneBuilds(server, TOKEN, "", 300, 999999999, True, transport=transport)
+            check.nagios_exit = MagicMock()
+            check.nagios_exit.side_effect = ValueError("STOP")
+            check.get_current_time = MagicMock()
+            check.get_current_time.return_value = TIME
+            with pytest.raises(ValueError):
+                check.check_builds()
+            results.append(check.nagios_exit.call_args_list)
+        assert results[0] == results[1]
+
+def test_check_builds_stdlib_cache(drone_server, tmp_path) -> None:
+    handler, server = drone_server
+    handler.etags = True
+    check_builds_cache(server, tmp_path, transport="stdlib")
+    handler.codes.clear()
+    check_builds_cache(server, tmp_path, transport="stdlib")
+    assert handler.codes == [304] * 5
+
+def test_stdlib_keepalive_disabled(drone_server) -> None:
+    handler, server = drone_server
+    check = run_check(server, transport="stdlib", keepalive=0)
+    assert check.get_connection_stats() == (5, 0)
+
+def test_stdlib_reconnects(drone_server) -> None:
+    handler, server = drone_server
+    check = CheckDroneBuilds(server, TOKEN, "", 0, 0, transport="stdlib")
+    assert len(check.get_builds_for_repo("docker", "test-2")) == 18
+    # the server dropping the idle connection is not an error
+    for connections in check.session.idle_connections.values():
+        connections[0].sock.shutdown(socket.SHUT_RDWR)
+    assert len(check.get_builds_for_repo("docker", "test-2")) == 18
+    assert check.get_connection_stats() == (2, 0)
+
+def test_stdlib_reused_connection_deadline(drone_server) -> None:
+    handler, server = drone_server
+    check = CheckDroneBuilds(server, TOKEN, "", 0, 0, transport="stdlib")
+    assert len(check.get_builds_for_repo("docker", "test-2")) == 18
+    # the idle connection was opened without a deadline, its timeout must not outlast the one set now
+    handler.delays = {"repos/docker/test-2/builds": 2}
+    check.deadline = 0.3
+    check.deadline_time = time.perf_counter() + check.deadline
+    started = time.perf_counter()
+    with pytest.raises(OSError):
+        check.get_builds_for_repo("docker", "test-2")
+    assert time.perf_counter() - started < 1
+    assert check.get_connection_stats() == (1, 0)
+
+def test_script_main_deadline():
+    test_args = ["check_drone_builds.py", "--server", SERVER, "--token", TOKEN, "--deadline", "55"]
+    with patch('sys.argv', test_args):
+        with patch("check_drone_builds.CheckDroneBuilds") as mock_main:
+            main()
+            mock_main.assert_called_with(SERVER, TOKEN, "", 9999999999, 9999999999, False, **check_options(deadline=55))
+
+def test_check_builds_deadline(drone_server) -> None:
+    handler, server = drone_server
+    handler.delays = {"repos/docker/test-3/builds": 1}
+    for options in [{"concurrency": 4}, {"concurrency": 4, "engine": "asyncio"}, {"concurrency": 4, "transport": "stdlib"}]:
+        started = time.perf_counter()
+        check = run_check(server, deadline=0.5, **options)
+        assert time.perf_counter() - started < 1
+        check.nagios_exit.assert_called_once_with("CRITICAL", "Failing build(s): docker/test-2 - last succeeded: Unknown; Not checked before the deadline: docker/test-3")
+        assert check.perfdata["repos_unreached"] == "1"
+
+    # one by one, the repos after the slow one aren't reached either
+    check = run_check(server, deadline=0.5)
+    check.nagios_exit.assert_called_once_with("CRITICAL", "Failing build(s): docker/test-2 - last succeeded: Unknown; Not checked before the deadline: docker/test-3, docker/test-4")
+
+    handler.delays = {"repos/docker/test-1/builds": 1, "repos/docker/test-2/builds": 1, "repos/docker/test-3/builds": 1}
+    check = run_check(server, concurrency=4, deadline=0.5)
+    check.nagios_exit.assert_called_once_with("UNKNOWN", "Unknown build status: docker/test-4; Not checked before the deadline: docker/test-1, docker/test-2, docker/test-3")
+
+def test_check_builds_deadline_exceeded(drone_server) -> None:
+    handler, server = drone_server
+    handler.delays = {"user/repos": 1}
+    check = CheckDroneBuilds(server, TOKEN, "", 86400, 172800, deadline=0.3)
+    check.nagios_exit = MagicMock()
+    check.nagios_exit.side_effect = ValueError("STOP")
+    with pytest.raises(ValueError):
+        check.check_builds()
+    assert check.nagios_exit.call_args.args[0] == "CRITICAL"
+    assert check.nagios_exit.call_args.args[1].startswith("Error retrieving repos: ")
+
+    # nothing is requested once the deadline has passed
+    check = CheckDroneBuilds(server, TOKEN, "", 86400, 172800, deadline=0.3)
+    check.deadline_time = time.perf_counter()
+    assert check.get_last_successful_build("docker", "test-1", "docker/test-1") is None
+    assert check.unreached == {"docker/test-1"}
+    assert len(handler.paths) == 1
+
+def test_check_builds_deadline_order(drone_server, tmp_path) -> None:
+    handler, server = drone_server
+    state_file = tmp_path / "state.json"
+    # repos that never succeeded (or aren't known yet) go first, then those that succeeded longest ago
+    state_file.write_text(json.dumps({"repos": {
+        "docker/test-1": {"last_successful_build": TIME - 7200},
+        "docker/test-3": {"last_successful_build": TIME - 100000},
+    }}))
+    run_check(server, 3600, deadline=30, state_file=str(state_file))
+    assert [path.split("?")[0] for path in handler.paths[1:]] == [
+        "/api/repos/docker/test-2/builds", "/api/repos/docker/test-4/builds", "/api/repos/docker/test-3/builds", "/api/repos/docker/test-1/builds",
+    ]
+
+    # without a deadline they are fetched in the order of the repo list
+    handler.paths.clear()
+    run_check(server, 3600, state_file=str(state_file))
+    assert [path.split("?")[0] for path in handler.paths[1:]] == [
+        "/api/repos/docker/test-1/builds", "/api/repos/docker/test-2/builds", "/api/repos/docker/test-3/builds", "/api/repos/docker/test-4/builds",
+    ]
+
+def test_check_builds_passive_deadline(drone_server, icinga_api) -> None:
+    drone_handler, server = drone_server
+    drone_handler.delays = {"repos/docker/test-3/builds": 1}
+    handler, url = icinga_api
+    check = CheckDroneBuilds(server, TOKEN, "", 86400, 172800, concurrency=4, deadline=0.5)
+    check.nagios_exit = MagicMock()
+    check.nagios_exit.side_effect = ValueError("STOP")
+    check.get_current_time = MagicMock()
+    check.get_current_time.return_value = TIME
+    with pytest.raises(ValueError):
+        check.check_builds_passive("drone", "drone-builds-{namespace}-{name}", icinga_api=url, icinga_user="root", icinga_password="secret")
+    check.nagios_exit.assert_called_once_with("OK", "Submitted 4 passive check results: 1 OK, 0 WARNING, 1 CRITICAL, 2 UNKNOWN")
+    results = {result["service"]: result for result in handler.results}
+    assert results["drone!drone-builds-docker-test-3"]["plugin_output"] == "docker/test-3 - Not checked before the deadline"
+
+def test_script_main_shard():
+    test_args = ["check_drone_builds.py", "--server", SERVER, "--token", TOKEN, "--shard", "2/3"]
+    with patch('sys.argv', test_args):
+        with patch("check_drone_builds.CheckDroneBuilds") as mock_main:
+            main()
+            mock_main.assert_called_with(SERVER, TOKEN, "", 9999999999, 9999999999, False, **check_options(shard="2/3"))
+
+    for shard in ["0/3", "4/3", "1", "a/b"]:
+        with patch('sys.argv', test_args[:-1] + [shard]):
+            with pytest.raises(SystemExit) as system_exit:
+                main()
+        assert system_exit.value.args[0] == 2
+
+def test_get_shard() -> None:
+    slugs = [f"org-{index % 7}/repo-{index}" for index in range(3000)]
+    shards = {count: [get_shard(slug, count) for slug in slugs] for count in [1, 3, 4]}
+    assert set(shards[1]) == {1}
+    # balanced, and stable as it only depends on the slug
+    assert all(900 < shards[3].count(shard) < 1100 for shard in [1, 2, 3])
+    assert [get_shard(slug, 3) for slug in slugs[::-1]] == shards[3][::-1]
+    assert (get_shard("docker/test-1", 3), get_shard("docker/test-2", 3), get_shard("docker/test-3", 3)) == (3, 3, 1)
+    # adding a shard only moves repos to the new shard
+    moved = [new for old, new in zip(shards[3], shards[4]) if old != new]
+    assert set(moved) == {4} and 600 < len(moved) < 900
+
+def test_check_builds_shard(drone_server) -> None:
+    handler, server = drone_server
+    checked = []
+    for index in [1, 2, 3]:
+        check = CheckDroneBuilds(server, TOKEN, "", 86400, 172800, shard=f"{index}/3")
+        check.get_current_time = MagicMock(return_value=TIME)
+        active_repos, _ = check.collect_builds()
+        checked += [slug for _, _, slug in active_repos]
+    # every repo is checked by exactly one shard
+    assert sorted(checked) == ["docker/test-1", "docker/test-2", "docker/test-3", "docker/test-4"]
+
+    handler.paths.clear()
+    check = CheckDroneBuilds(server, TOKEN, "docker", 86400, 172800, shard="1/2")
+    check.nagios_exit = MagicMock()
+    check.get_current_time = MagicMock(return_value=TIME)
+    check.check_builds()
+    check.nagios_exit.assert_called_once_with("CRITICAL", "Shard 1/2: Failing build(s): docker/test-3 - last succeeded: 140 days ago")
+    assert sorted(path.split("?")[0] for path in handler.paths[1:]) == ["/api/repos/docker/test-1/builds", "/api/repos/docker/test-3/builds"]
+
+def test_check_snapshot_shard(tmp_path) -> None:
+    snapshot_file = tmp_path / "snapshot.json"
+    snapshot_file.write_text(json.dumps({"time": TIME - 60, "repos": {"docker/test-1": TIME - 100, "docker/test-3": TIME - 90000}}))
+    check = CheckDroneBuilds(SERVER, TOKEN, "", 86400, 172800, shard="1/2")
+    check.nagios_exit = MagicMock()
+    check.get_current_time = MagicMock(return_value=TIME)
+    check.check_snapshot(str(snapshot_file), 300)
+    check.nagios_exit.assert_called_once_with("WARNING", "Shard 1/2: Failing build(s): docker/test-3 - last succeeded: 1 day ago")
+
+def test_script_main_rules(tmp_path, capsys):
+    rules = [{"pattern": "nightly/*", "warning": 172800, "critical": 259200}, {"pattern": "docker/test-?", "critical": 3600}]
+    rules_file = tmp_path / "rules.json"
+    rules_file.write_text(json.dumps({"rules": rules}))
+    test_args = ["check_drone_builds.py", "--server", SERVER, "--token", TOKEN, "--rules", str(rules_file)]
+    with patch('sys.argv', test_args):
+        with patch("check_drone_builds.CheckDroneBuilds") as mock_main:
+            main()
+            mock_main.assert_called_with(SERVER, TOKEN, "", 9999999999, 9999999999, False, **check_options(rules=rules))
+
+    for content, error in [
+        ({"rules": {}}, "Rules must be a list"),
+        ({"rules": [{"pattern": "*", "warnign": 60}]}, "Unknown rule key(s): warnign"),
+        ({"rules": [{"pattern": "*", "critical": "1d"}]}, "The warning and critical of rule * must be a number of seconds"),
+    ]:
+        rules_file.write_text(json.dumps(content))
+        with patch('sys.argv', test_args):
+            with pytest.raises(SystemExit) as system_exit:
+                main()
+        assert capsys.readouterr().out == f"UNKNOWN - Error reading rules {rules_file}: {error}\n"
+        assert system_exit.value.args[0] == 3
+
+def test_threshold_rules() -> None:
+    rules = ThresholdRules([
+        {"pattern": "nightly/*", "warning": 172800, "critical": 259200},
+        {"pattern": "*/deploy-*", "critical": 3600},
+        {"pattern": "*", "warning": 60},
+    ], 86400, 172800)
+    # the first matching rule wins, its missing thresholds are those of the command line
+    assert rules.get("nightly/deploy-web") == (172800, 259200)
+    assert rules.get("docker/deploy-web") == (86400, 3600)
+    assert rules.get("docker/test-1") == (60, 172800)
+    assert rules.get("docker/test-1") == (60, 172800)
+    assert ThresholdRules([{"pattern": "docker/test-[12]", "warning": 60}], 86400, 172800).get("docker/test-3") == (86400, 172800)
+    assert ThresholdRules([], 86400, 172800).get("docker/test-1") == (86400, 172800)
+
+def test_check_builds_rules(drone_server, capsys) -> None:
+    handler, server = drone_server
+    output, perfdata = get_perfdata(server, capsys, perfdata_ages=True)
+    assert output == "CRITICAL - Failing build(s): docker/test-2 - last succeeded: Unknown, docker/test-3 - last succeeded: 140 days ago"
+
+    # one sweep, every repo with its own thresholds
+    rules = [{"pattern": "docker/test-3", "warning": 3600, "critical": 400 * 86400}, {"pattern": "docker/test-[12]", "warning": 3600}]
+    handler.paths.clear()
+    output, perfdata = get_perfdata(server, capsys, perfdata_ages=True, rules=rules)
+    assert output == "CRITICAL - Failing build(s): docker/test-2 - last succeeded: Unknown"
+    assert perfdata["'docker/test-1 age'"] == "86400s;3600;172800;0"
+    assert perfdata["'docker/test-3 age'"] == "12174622s;3600;34560000;0"
+    assert perfdata["'docker/test-4 age'"] == "U;86400;172800;0"
+    assert len(handler.paths) == 5
+
+def test_script_main_metrics_file():
+    test_args = ["check_drone_builds.py", "--server", SERVER, "--token", TOKEN, "--metrics-file", "/tmp/drone.prom"]
+    with patch('sys.argv', test_args):
+        with patch("check_drone_builds.CheckDroneBuilds") as mock_main:
+            main()
+            mock_main.assert_called_with(SERVER, TOKEN, "", 9999999999, 9999999999, False, **check_options(metrics_file="/tmp/drone.prom"))
+
+def test_format_metrics() -> None:
+    assert format_metrics([]) == "# EOF\n"
+    assert format_metrics([
+        ("drone_check_requests", {"server": 'drone "ci"\\\n'}, 5),
+        ("drone_repo_builds_scanned", {"slug": "docker/test-1"}, 25),
+    ]) == "\n".join([
+        "# HELP drone_repo_builds_scanned Number of builds of the repo the check looked through.",
+        "# TYPE drone_repo_builds_scanned gauge",
+        'drone_repo_builds_scanned{slug="docker/test-1"} 25',
+        "# HELP drone_check_requests Number of requests the check made to the Drone API.",
+        "# TYPE drone_check_requests gauge",
+        'drone_check_requests{server="drone \\"ci\\"\\\\\\n"} 5',
+        "# EOF",
+    ]) + "\n"
+
+def get_metrics(metrics_file: Path) -> dict:
+    return dict(line.rsplit(" ", 1) for line in metrics_file.read_text().splitlines() if not line.startswith("#"))
+
+def test_check_builds_metrics_file(drone_server, tmp_path) -> None:
+    handler, server = drone_server
+    metrics_file = tmp_path / "drone.prom"
+    for options in [{}, {"stream": True}, {"engine": "asyncio"}]:
+        check = CheckDroneBuilds(server, TOKEN, "docker", 86400, 172800, metrics_file=str(metrics_file), **options)
+        check.nagios_exit = MagicMock()
+        check.get_current_time = MagicMock(return_value=TIME)
+        check.check_builds()
+        check.nagios_exit.assert_called_once_with("CRITICAL", "Failing build(s): docker/test-2 - last succeeded: Unknown, docker/test-3 - last succeeded: 140 days ago")
+
+        metrics = get_metrics(metrics_file)
+        labels = f'server="{server}",namespace="docker",name="test-1",slug="docker/test-1"'
+        assert metrics[f"drone_repo_last_success_timestamp_seconds{{{labels}}}"] == "1749334777"
+        assert metrics[f'drone_repo_latest_build_status{{{labels},status="success"}}'] == "1"
+        assert metrics[f"drone_repo_check_status{{{labels}}}"] == "0"
+        assert int(metrics[f"drone_repo_builds_scanned{{{labels}}}"]) > 0
+        labels = f'server="{server}",namespace="docker",name="test-4",slug="docker/test-4"'
+        assert f"drone_repo_last_success_timestamp_seconds{{{labels}}}" not in metrics
+        assert metrics[f"drone_repo_builds_scanned{{{labels}}}"] == "0"
+        assert metrics[f"drone_repo_check_status{{{labels}}}"] == "3"
+        assert metrics[f'drone_check_requests{{server="{server}"}}'] == "5"
+        assert metrics[f'drone_check_timestamp_seconds{{server="{server}"}}'] == str(TIME)
+        assert metrics[f'drone_check_repos{{server="{server}",state="fetched"}}'] == "4"
+        assert float(metrics[f'drone_check_duration_seconds{{server="{server}"}}']) > 0
+        assert metrics_file.read_text().endswith("# EOF\n")
+
+    # repos that are OK without fetching their builds have the status of their latest build from the repo list
+    check = CheckDroneBuilds(server, TOKEN, "docker", 86400, 172800, latest=True, metrics_file=str(metrics_file))
+    check.get_all_repos = MagicMock(return_value=get_all_repos_latest_json())
+    check.nagios_exit = MagicMock()
+    check.get_current_time = MagicMock(return_value=TIME)
+    check.check_builds()
+    metrics = get_metrics(metrics_file)
+    labels = f'server="{server}",namespace="docker",name="test-1",slug="docker/test-1"'
+    assert metrics[f'drone_repo_latest_build_status{{{labels},status="success"}}'] == "1"
+    assert metrics[f"drone_repo_builds_scanned{{{labels}}}"] == "0"
+    assert metrics[f'drone_check_repos{{server="{server}",state="skipped"}}'] == "1"
+
+def test_check_builds_metrics_file_unwritable(drone_server, tmp_path) -> None:
+    handler, server = drone_server
+    check = CheckDroneBuilds(server, TOKEN, "docker", 86400, 172800, metrics_file=str(tmp_path / "missing" / "drone.prom"))
+    check.nagios_exit = MagicMock()
+    check.get_current_time = MagicMock(return_value=TIME)
+    check.check_builds()
+    assert check.nagios_exit.call_args.args[0] == "CRITICAL"
+
+def test_script_main_record_replay(capsys):
+    test_args = ["check_drone_builds.py", "--server", SERVER, "--token", TOKEN, "--record", "/tmp/recording"]
+    with patch('sys.argv', test_args):
+        with patch("check_drone_builds.CheckDroneBuilds") as mock_main:
+            main()
+            mock_main.assert_called_with(SERVER, TOKEN, "", 9999999999, 9999999999, False, **check_options(record_dir="/tmp/recording"))
+
+    # a replay doesn't need a server
+    with patch('sys.argv', ["check_drone_builds.py", "--replay", "/tmp/recording"]):
+        with patch("check_drone_builds.CheckDroneBuilds") as mock_main:
+            main()
+            mock_main.assert_called_with("localhost", "", "", 9999999999, 9999999999, False, **check_options(replay_dir="/tmp/recording"))
+
+    for args in [["--replay", "/tmp/recording"], ["--cache-dir", "/tmp/cache"]]:
+        with patch('sys.argv', test_args + args):
+            with pytest.raises(SystemExit) as system_exit:
+                main()
+        assert system_exit.value.args[0] == 2
+
+def test_check_builds_record_replay(drone_server, tmp_path) -> None:
+    handler, server = drone_server
+    handler.gzip = True
+    nagios_exit = run_check(server, record_dir=str(tmp_path)).nagios_exit
+    nagios_exit.assert_called_once_with("CRITICAL", "Failing build(s): docker/test-2 - last succeeded: Unknown, docker/test-3 - last succeeded: 140 days ago")
+    assert json.loads((tmp_path / "recording.json").read_text()) == {"time": TIME, "server": server}
+
+    recorded = {}
+    for path in tmp_path.glob("*.json.gz"):
+        response = json.loads(gzip.decompress(path.read_bytes()))
+        recorded[response["path"]] = response
+    assert sorted(recorded) == ["/api/repos/docker/test-1/builds?page=1&per_page=25", "/api/repos/docker/test-2/builds?page=1&per_page=25",
+                                "/api/repos/docker/test-3/builds?page=1&per_page=25", "/api/repos/docker/test-4/builds?page=1&per_page=25", "/api/user/repos?per_page=1000"]
+    response = recorded["/api/repos/docker/test-1/builds?page=1&per_page=25"]
+    assert response["status_code"] == 200
+    assert "Content-Encoding" not in response["headers"]
+    assert json.loads(response["body"]) == get_builds_json("docker", "test-1")
+    assert response["elapsed"] > 0
+    assert TOKEN not in json.dumps(recorded)
+
+    # no network at all, and at the time of the recording
+    assert CheckDroneBuilds("http://127.0.0.1:1", TOKEN, "", 0, 0, replay_dir=str(tmp_path)).get_current_time() == TIME
+    handler.paths.clear()
+    for options in [{}, {"transport": "stdlib"}, {"engine": "asyncio"}, {"stream": True}, {"engine": "asyncio", "stream": True}]:
+        nagios_exit = run_check("http://127.0.0.1:1", replay_dir=str(tmp_path), **options).nagios_exit
+        nagios_exit.assert_called_once_with("CRITICAL", "Failing build(s): docker/test-2 - last succeeded: Unknown, docker/test-3 - last succeeded: 140 days ago")
+    assert handler.paths == []
+
+def test_check_builds_record_async(drone_server, tmp_path) -> None:
+    handler, server = drone_server
+    run_check(server, record_dir=str(tmp_path), engine="asyncio", stream=True)
+    nagios_exit = run_check("http://127.0.0.1:1", replay_dir=str(tmp_path)).nagios_exit
+    nagios_exit.assert_called_once_with("CRITICAL", "Failing build(s): docker/test-2 - last succeeded: Unknown, docker/test-3 - last succeeded: 140 days ago")
+
+def test_check_builds_replay_missing(tmp_path) -> None:
+    check = CheckDroneBuilds(SERVER, TOKEN, "", 86400, 172800, replay_dir=str(tmp_path))
+    check.nagios_exit = MagicMock(side_effect=SystemExit(2))
+    with pytest.raises(SystemExit):
+        check.check_builds()
+    check.nagios_exit.assert_called_once_with("CRITICAL", "Error retrieving repos: No recorded response for /api/user/repos?per_page=1000")
+
+def test_script_main_retries():
+    test_args = ["check_drone_builds.py", "--server", SERVER, "--token", TOKEN, "--retries", "3", "--retry-backoff", "0.5"]
+    with patch('sys.argv', test_args):
+        with patch("check_drone_builds.CheckDroneBuilds") as mock_main:
+            main()
+            mock_main.assert_called_with(SERVER, TOKEN, "", 9999999999, 9999999999, False, **check_options(retries=3, retry_backoff=0.5))
+
+def test_get_builds_for_repo_error_transient(drone_server) -> None:
+    handler, server = drone_server
+    handler.errors = {"repos/docker/test-1/builds": 503}
+    check = CheckDroneBuilds(server, TOKEN, NAMESPACE, 0, 0)
+    check.nagios_exit = MagicMock()
+    with pytest.raises(TransientError, match="HTTP 503"):
+        check.get_builds_for_repo("docker", "test-1")
+    with pytest.raises(TransientError, match="HTTP 503"):
+        asyncio.run(check.get_builds_for_repo_async("docker", "test-1"))
+    check.nagios_exit.assert_not_called()
+
+def test_is_transient_error() -> None:
+    import ssl
+
+    for error in [TransientError("HTTP 503"), ConnectionResetError(), TimeoutError(), http.client.RemoteDisconnected(), asyncio.IncompleteReadError(b"", 10),
+                  requests.exceptions.ConnectionError(), requests.exceptions.ReadTimeout(), requests.exceptions.ChunkedEncodingError()]:
+        assert CheckDroneBuilds.is_transient_error(error)
+    for error in [ValueError("Expecting value"), MissingRecording("No recorded response for /api/user/repos?per_page=1000"),
+                  ssl.SSLCertVerificationError(), requests.exceptions.SSLError(), PermissionError(13, "Permission denied"),
+                  OSError(28, "No space left on device"), requests.exceptions.InvalidURL(), requests.exceptions.MissingSchema()]:
+        assert not CheckDroneBuilds.is_transient_error(error)
+
+def test_check_builds_replay_missing_builds(drone_server, tmp_path) -> None:
+    handler, server = drone_server
+    run_check(server, record_dir=str(tmp_path))
+    for path in tmp_path.glob("*.json.gz"):
+        if json.loads(gzip.decompress(path.read_bytes()))["path"].startswith("/api/repos/docker/test-1/"):
+            path.unlink()
+    # a missing recording doesn't get any better by retrying it
+    with patch("check_drone_builds.time.sleep") as sleep:
+        check = run_check("http://127.0.0.1:1", namespace="docker", replay_dir=str(tmp_path))
+    assert get_backoffs(sleep) == []
+    assert check.retried == 0
+    assert check.failed == {}
+    check.nagios_exit.assert_called_once_with("CRITICAL", "Failing build(s): docker/test-2 - last succeeded: Unknown, docker/test-3 - last succeeded: 140 days ago")
+
+def get_backoffs(sleep: MagicMock) -> list:
+    # the fake server sleeps as well
+    return [backoff.args[0] for backoff in sleep.call_args_list if backoff.args[0]]
+
+def test_check_builds_retries(drone_server) -> None:
+    handler, server = drone_server
+    for options in [{}, {"concurrency": 4}, {"engine": "asyncio"}, {"transport": "stdlib", "stream": True}]:
+        handler.errors = {"repos/docker/test-2/builds": 502}
+        handler.paths.clear()
+        with patch("check_drone_builds.time.sleep") as sleep:
+            check = run_check(server, namespace="docker", **options)
+        # the other repos are still checked, the failing one is tried again with a backoff
+        check.nagios_exit.assert_called_once_with("CRITICAL", "Failing build(s): docker/test-3 - last succeeded: 140 days ago; Error fetching builds: docker/test-2 (HTTP 502)")
+        assert get_backoffs(sleep) == [1, 2]
+        assert handler.paths.count("/api/repos/docker/test-2/builds?page=1&per_page=25") == 3
+        assert check.perfdata["repos_retried"] == "2"
+        assert check.perfdata["repos_failed"] == "1"
+
+    # a server error that goes away is as if it never happened
+    handler.errors = {"repos/docker/test-1/builds": 500, "repos/docker/test-3/builds": 429}
+    with patch("check_drone_builds.time.sleep", side_effect=lambda delay: delay and handler.errors.clear()) as sleep:
+        check = run_check(server, namespace="docker", retry_backoff=0.1)
+    check.nagios_exit.assert_called_once_with("CRITICAL", "Failing build(s): docker/test-2 - last succeeded: Unknown, docker/test-3 - last succeeded: 140 days ago")
+    assert get_backoffs(sleep) == [0.1]
+    assert check.perfdata["repos_retried"] == "2"
+    assert check.perfdata["repos_failed"] == "0"
+
+    # client errors are not retried, a repo that was deleted since the repos were listed is UNKNOWN, the others are checked as usual
+    handler.errors = {"repos/docker/test-2/builds": 404, "repos/docker/test-4/builds": 403}
+    for options in [{}, {"concurrency": 4}, {"engine": "asyncio"}, {"transport": "stdlib", "stream": True}]:
+        with patch("check_drone_builds.time.sleep") as sleep:
+            check = run_check(server, namespace="docker", **options)
+        check.nagios_exit.assert_called_once_with(
+            "CRITICAL", "Failing build(s): docker/test-3 - last succeeded: 140 days ago; Error fetching builds: docker/test-2 (HTTP 404), docker/test-4 (HTTP 403)"
+        )
+        assert get_backoffs(sleep) == []
+        assert check.retried == 0
+
+def test_check_builds_retries_timeout(drone_server) -> None:
+    handler, server = drone_server
+    handler.delays = {"repos/docker/test-1/builds": 0.5}
+    with patch("check_drone_builds.time.sleep", side_effect=lambda delay: delay < 0.5 and handler.delays.clear()):
+        check = run_check(server, namespace="docker", read_timeout=0.2)
+    check.nagios_exit.assert_called_once_with("CRITICAL", "Failing build(s): docker/test-2 - last succeeded: Unknown, docker/test-3 - last succeeded: 140 days ago")
+
+    handler.delays = {"repos/docker/test-1/builds": 0.5}
+    check = run_check(server, namespace="docker", engine="asyncio", read_timeout=0.2, retries=0)
+    check.nagios_exit.assert_called_once_with("CRITICAL", "Failing build(s): docker/test-2 - last succeeded: Unknown, docker/test-3 - last succeeded: 140 days ago; Error fetching builds: docker/test-1 (TimeoutError)")
+    assert "repos_retried" not in check.perfdata
+
+def test_check_builds_retries_deadline(drone_server) -> None:
+    handler, server = drone_server
+    # no time left to wait for the backoff
+    handler.errors = {"repos/docker/test-1/builds": 503}
+    with patch("check_drone_builds.time.sleep") as sleep:
+        check = run_check(server, namespace="docker", deadline=5, retry_backoff=10)
+    check.nagios_exit.assert_called_once_with("CRITICAL", "Failing build(s): docker/test-2 - last succeeded: Unknown, docker/test-3 - last succeeded: 140 days ago; Error fetching builds: docker/test-1 (HTTP 503)")
+    assert get_backoffs(sleep) == []
+
+def test_check_builds_passive_retries(drone_server, tmp_path) -> None:
+    handler, server = drone_server
+    handler.errors = {"repos/docker/test-1/builds": 503}
+    command_file = tmp_path / "icinga2.cmd"
+    check = CheckDroneBuilds(server, TOKEN, "docker", 86400, 172800, retries=0, metrics_file=str(tmp_path / "drone.prom"))
+    check.nagios_exit = MagicMock()
+    check.get_current_time = MagicMock(return_value=TIME)
+    check.check_builds_passive("drone", "drone-builds-{name}", command_file=str(command_file))
+    assert f"[{TIME}] PROCESS_SERVICE_CHECK_RESULT;drone;drone-builds-test-1;3;docker/test-1 - Error fetching builds: HTTP 503|age=U;86400;172800;0\n" in command_file.read_text()
+    metrics = get_metrics(tmp_path / "drone.prom")
+    assert metrics[f'drone_check_repos{{server="{server}",state="failed"}}'] == "1"
+    assert metrics[f'drone_check_repos{{server="{server}",state="fetched"}}'] == "3"
 
 def test_nagios_exit_ok(capsys) -> None:
     check = CheckDroneBuilds(SERVER, TOKEN, NAMESPACE, 2, 1)
@@ -489,6 +1854,466 @@ def test_nagios_exit_unknown(capsys) -> None:
     assert captured.out == "UNKNOWN - Test\n"
     assert system_exit.value.args[0] == 3
 
+def test_script_main_perfdata_ages():
+    test_args = ["check_drone_builds.py", "--server", SERVER, "--token", TOKEN, "--perfdata-ages"]
+    with patch('sys.argv', test_args):
+        with patch("check_drone_builds.CheckDroneBuilds") as mock_main:
+            main()
+            mock_main.assert_called_with(SERVER, TOKEN, "", 9999999999, 9999999999, False, **check_options(perfdata_ages=True))
+
+def get_perfdata(server: string, capsys, **options) -> tuple[string, dict]:
+    check = CheckDroneBuilds(server, TOKEN, "", 86400, 172800, **options)
+    check.get_current_time = MagicMock()
+    check.get_current_time.return_value = TIME
+    with pytest.raises(SystemExit):
+        check.check_builds()
+    output, _, perfdata = capsys.readouterr().out.strip().partition(" | ")
+    return output, dict(re.findall(r"('[^']+'|\S+)=(\S+)", perfdata))
+
+def test_perfdata(drone_server, capsys) -> None:
+    handler, server = drone_server
+    for options in [{}, {"engine": "asyncio", "stream": True}]:
+        handler.paths.clear()
+        output, perfdata = get_perfdata(server, capsys, **options)
+        assert output == "CRITICAL - Failing build(s): docker/test-2 - last succeeded: Unknown, docker/test-3 - last succeeded: 140 days ago"
+        assert list(perfdata) == ["time", "repos_time", "fetch_time", "fetch_p95", "requests", "bytes", "repos_checked", "repos_skipped"]
+        assert all(re.fullmatch(r"\d+\.\d{3}s", perfdata[label]) for label in ["time", "repos_time", "fetch_time", "fetch_p95"])
+        assert perfdata["requests"] == str(len(handler.paths))
+        assert int(perfdata["bytes"].removesuffix("B")) > 0
+        assert perfdata["repos_checked"] == "4"
+        assert perfdata["repos_skipped"] == "0"
+
+def test_perfdata_ages(drone_server, capsys, tmp_path) -> None:
+    handler, server = drone_server
+    state_file = tmp_path / "state.json"
+    state_file.write_text(json.dumps({"repos": {"docker/test-1": {"last_successful_build": TIME - 100}}}))
+    output, perfdata = get_perfdata(server, capsys, state_file=str(state_file), perfdata_ages=True)
+    assert perfdata["repos_skipped"] == "1"
+    assert perfdata["'docker/test-1 age'"] == "100s;86400;172800;0"
+    assert perfdata["'docker/test-2 age'"] == "U;86400;172800;0"
+    assert perfdata["'docker/test-3 age'"].endswith("s;86400;172800;0")
+
+def test_perfdata_p95() -> None:
+    check = CheckDroneBuilds(SERVER, TOKEN, NAMESPACE, 2, 1)
+    for seconds in range(1, 41):
+        check.record_request(seconds / 1000, 10)
+    check.record_request(None, 100)
+    check.add_perfdata([], [])
+    assert check.perfdata["fetch_p95"] == "0.038s"
+    assert check.perfdata["fetch_time"] == "0.820s"
+    assert check.perfdata["requests"] == "41"
+    assert check.perfdata["bytes"] == "500B"
+
+def test_script_main_snapshot():
+    test_args = ["check_drone_builds.py", "--server", SERVER, "--token", TOKEN, "--snapshot", "/tmp/snapshot.json", "--max-age", "120"]
+    with patch('sys.argv', test_args):
+        with patch("check_drone_builds.CheckDroneBuilds") as mock_main:
+            main()
+            mock_main.assert_called_with(SERVER, TOKEN, "", 9999999999, 9999999999, False, **check_options(max_age=120))
+            mock_main.return_value.check_snapshot.assert_called_once_with("/tmp/snapshot.json", 120)
+            mock_main.return_value.check_builds.assert_not_called()
+
+    # reading a snapshot doesn't need a server, nor its token
+    with patch('sys.argv', ["check_drone_builds.py", "--snapshot", "/tmp/snapshot.json"]):
+        with patch("check_drone_builds.CheckDroneBuilds") as mock_main:
+            main()
+            mock_main.assert_called_with("localhost", "", "", 9999999999, 9999999999, False, **check_options())
+            mock_main.return_value.check_snapshot.assert_called_once_with("/tmp/snapshot.json", 300)
+
+def test_script_main_collect():
+    test_args = ["check_drone_builds.py", "--server", SERVER, "--token", TOKEN, "--snapshot", "/tmp/snapshot.json", "--collect", "--interval", "30"]
+    with patch('sys.argv', test_args):
+        with patch("check_drone_builds.CheckDroneBuilds") as mock_main:
+            main()
+            mock_main.return_value.run_collector.assert_called_once_with("/tmp/snapshot.json", 30)
+            mock_main.return_value.check_builds.assert_not_called()
+
+    # the collector does poll the server
+    for args in [test_args[:5] + ["--collect"], ["check_drone_builds.py", "--snapshot", "/tmp/snapshot.json", "--collect"]]:
+        with patch('sys.argv', args):
+            with pytest.raises(SystemExit) as system_exit:
+                main()
+        assert system_exit.value.args[0] == 2
+
+def check_snapshot(snapshot_file: string, namespace: string = "", max_age: int = 300) -> MagicMock:
+    check = CheckDroneBuilds(SERVER, TOKEN, namespace, 86400, 172800)
+    check.nagios_exit = MagicMock()
+    check.nagios_exit.side_effect = ValueError("STOP") # just so it stops executing any other code, as it would in IRL
+    check.get_current_time = MagicMock()
+    check.get_current_time.return_value = TIME
+    with pytest.raises(ValueError):
+        check.check_snapshot(snapshot_file, max_age)
+    return check.nagios_exit
+
+def test_write_snapshot(drone_server, tmp_path) -> None:
+    handler, server = drone_server
+    snapshot_file = tmp_path / "snapshot.json"
+    check = CheckDroneBuilds(server, TOKEN, "", 86400, 172800)
+    check.get_current_time = MagicMock()
+    check.get_current_time.return_value = TIME
+    check.write_snapshot(str(snapshot_file))
+    snapshot = json.loads(snapshot_file.read_text())
+    assert snapshot["time"] == TIME
+    assert list(snapshot["repos"]) == ["docker/test-1", "docker/test-2", "docker/test-3", "docker/test-4"]
+    assert snapshot["repos"]["docker/test-2"] == 0
+    assert snapshot["repos"]["docker/test-4"] is None
+
+    check_snapshot(str(snapshot_file)).assert_called_once_with(
+        "CRITICAL", "Failing build(s): docker/test-2 - last succeeded: Unknown, docker/test-3 - last succeeded: 140 days ago"
+    )
+    check_snapshot(str(snapshot_file), namespace="random").assert_called_once_with("UNKNOWN", "No repos/builds found")
+
+def test_write_snapshot_error(drone_server, tmp_path) -> None:
+    handler, server = drone_server
+    handler.errors["user/repos"] = 500
+    snapshot_file = tmp_path / "snapshot.json"
+    check = CheckDroneBuilds(server, TOKEN, "", 86400, 172800)
+    check.write_snapshot(str(snapshot_file)) # the collector keeps running
+    assert json.loads(snapshot_file.read_text())["status"] == "UNKNOWN"
+    check_snapshot(str(snapshot_file), max_age=9999999999).assert_called_once_with("UNKNOWN", "Drone API /api/user/repos HTTP status code is 500")
+
+def test_check_snapshot(tmp_path) -> None:
+    snapshot_file = tmp_path / "snapshot.json"
+    snapshot_file.write_text(json.dumps({"time": TIME - 60, "repos": {"docker/test-1": TIME - 100, "random/test-5": TIME - 90000}}))
+    check_snapshot(str(snapshot_file), namespace="docker").assert_called_once_with("OK", "docker/test-1 - last succeeded: 1 minute ago")
+    check_snapshot(str(snapshot_file)).assert_called_once_with("WARNING", "Failing build(s): random/test-5 - last succeeded: 1 day ago")
+    check_snapshot(str(snapshot_file), max_age=30).assert_called_once_with("UNKNOWN", f"Snapshot {snapshot_file} is too old, last collected 1 minute ago")
+
+def test_check_snapshot_unreadable(tmp_path) -> None:
+    snapshot_file = tmp_path / "snapshot.json"
+    nagios_exit = check_snapshot(str(snapshot_file))
+    assert nagios_exit.call_args.args[0] == "UNKNOWN"
+    assert nagios_exit.call_args.args[1].startswith(f"Error reading snapshot {snapshot_file}")
+
+    snapshot_file.write_text(json.dumps({"repos": {}}))
+    check_snapshot(str(snapshot_file)).assert_called_once_with("UNKNOWN", f"Error reading snapshot {snapshot_file}: 'time'")
+
+def test_run_collector(tmp_path) -> None:
+    check = CheckDroneBuilds(SERVER, TOKEN, "", 86400, 172800)
+    check.write_snapshot = MagicMock()
+    with patch("check_drone_builds.time.sleep", side_effect=[None, KeyboardInterrupt]) as sleep:
+        with pytest.raises(KeyboardInterrupt):
+            check.run_collector(str(tmp_path / "snapshot.json"), 30)
+    assert check.write_snapshot.call_count == 2
+    assert 29 < sleep.call_args.args[0] <= 30
+
+def test_script_main_listen():
+    test_args = ["check_drone_builds.py", "--server", SERVER, "--token", TOKEN, "--state-file", "/tmp/state.json", "--listen", "127.0.0.1:8080", "--webhook-secret", "secret"]
+    with patch('sys.argv', test_args):
+        with patch("check_drone_builds.CheckDroneBuilds") as mock_main:
+            main()
+            mock_main.return_value.run_listener.assert_called_once_with("127.0.0.1:8080", "secret", 10)
+            mock_main.return_value.check_builds.assert_not_called()
+
+    for args in [test_args[:5] + test_args[7:], test_args[:9]]: # without --state-file, without --webhook-secret
+        with patch('sys.argv', args):
+            with pytest.raises(SystemExit) as system_exit:
+                main()
+        assert system_exit.value.args[0] == 2
+
+def test_script_main_webhooks():
+    test_args = ["check_drone_builds.py", "--server", SERVER, "--token", TOKEN, "--state-file", "/tmp/state.json", "--webhooks"]
+    with patch('sys.argv', test_args):
+        with patch("check_drone_builds.CheckDroneBuilds") as mock_main:
+            main()
+            mock_main.assert_called_with(SERVER, TOKEN, "", 9999999999, 9999999999, False, **check_options(state_file="/tmp/state.json", webhooks=True))
+
+def post_webhook(url: string, body: bytes, secret: string = "secret", digest: bytes | None = None) -> int:
+    # signed the way Drone signs its webhooks
+    headers = {
+        "Date": formatdate(usegmt=True),
+        "Digest": f"SHA-256={base64.b64encode(hashlib.sha256(digest or body).digest()).decode()}",
+        "Content-Type": "application/json",
+    }
+    signed = "\n".join(["(request-target): post /hook", f"date: {headers['Date']}", f"digest: {headers['Digest']}"])
+    signature = base64.b64encode(hmac.new(secret.encode(), signed.encode(), hashlib.sha256).digest()).decode()
+    headers["Signature"] = f'keyId="hmac-key",algorithm="hmac-sha256",signature="{signature}",headers="(request-target) date digest"'
+    return requests.post(f"{url}/hook", data=body, headers=headers).status_code
+
+def get_webhook(name: string) -> bytes:
+    with open(os.path.join(os.path.dirname(__file__), "Webhooks", f"{name}.json"), "rb") as f:
+        return f.read()
+
+@pytest.fixture
+def webhook_listener(tmp_path):
+    check = CheckDroneBuilds(SERVER, TOKEN, "", 86400, 172800, state_file=str(tmp_path / "state.json"))
+    check.get_current_time = MagicMock()
+    check.get_current_time.return_value = TIME
+    server = check.create_listener("127.0.0.1:0", "secret")
+    threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.01}, daemon=True).start()
+    yield check, f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+
+def test_webhook_listener(webhook_listener) -> None:
+    check, url = webhook_listener
+    assert post_webhook(url, get_webhook("build-success")) == 204
+    assert post_webhook(url, get_webhook("build-failure")) == 204
+    assert post_webhook(url, get_webhook("user-created")) == 204
+    assert check.webhook_builds == {"docker/test-2": 1749421077}
+
+    check.flush_webhook_builds()
+    with open(check.state_file) as f:
+        assert json.load(f) == {"repos": {"docker/test-2": {"last_successful_build": 1749421077}}, "listener": TIME}
+
+def test_webhook_listener_filters(webhook_listener) -> None:
+    check, url = webhook_listener
+    check.events = ["cron"]
+    assert post_webhook(url, get_webhook("build-success")) == 204
+    assert check.webhook_builds == {}
+    check.events = ["push"]
+    assert post_webhook(url, get_webhook("build-success")) == 204
+    assert check.webhook_builds == {"docker/test-2": 1749421077}
+
+def test_webhook_listener_signature(webhook_listener) -> None:
+    check, url = webhook_listener
+    body = get_webhook("build-success")
+    assert post_webhook(url, body, secret="wrong") == 401
+    assert post_webhook(url, body.replace(b"1749421077", b"1749421099"), digest=body) == 401
+    assert requests.post(f"{url}/hook", data=body).status_code == 401
+    assert post_webhook(url, b"{not json") == 400
+    assert post_webhook(url, b'{"event": "build"}') == 400
+    assert check.webhook_builds == {}
+
+def test_webhook_listener_body_too_large(webhook_listener) -> None:
+    check, url = webhook_listener
+    # rejected before the body is read, the client doesn't have to send it
+    connection = http.client.HTTPConnection(url.removeprefix("http://"), timeout=5)
+    connection.putrequest("POST", "/hook")
+    connection.putheader("Content-Length", str(1024 * 1024 * 1024))
+    connection.endheaders()
+    assert connection.getresponse().status == 413
+    connection.close()
+    assert check.webhook_builds == {}
+
+def test_check_builds_webhooks(drone_server, tmp_path) -> None:
+    handler, server = drone_server
+    state_file = tmp_path / "state.json"
+    # docker/test-3 last succeeded long ago, but the listener would have heard of anything newer
+    state = {"repos": {"docker/test-2": {"last_successful_build": TIME - 100}, "docker/test-3": {"last_successful_build": 1737260000}}, "listener": TIME - 10}
+    state_file.write_text(json.dumps(state))
+    nagios_exit = run_check(server, state_file=str(state_file), webhooks=True).nagios_exit
+    nagios_exit.assert_called_once_with("CRITICAL", "Failing build(s): docker/test-3 - last succeeded: 140 days ago")
+    assert [path.split("?")[0] for path in handler.paths] == ["/api/user/repos", "/api/repos/docker/test-1/builds", "/api/repos/docker/test-4/builds"]
+
+    # the listener stopped writing the state, so it can't be trusted anymore
+    state["listener"] = TIME - 600
+    state_file.write_text(json.dumps(state))
+    handler.paths.clear()
+    nagios_exit = run_check(server, state_file=str(state_file), webhooks=True).nagios_exit
+    nagios_exit.assert_called_once_with("CRITICAL", "Failing build(s): docker/test-3 - last succeeded: 140 days ago")
+    assert "/api/repos/docker/test-3/builds" in [path.split("?")[0] for path in handler.paths]
+    with open(state_file) as f:
+        assert json.load(f)["listener"] == TIME - 600
+
+def test_script_main_passive():
+    test_args = ["check_drone_builds.py", "--server", SERVER, "--token", TOKEN, "--passive-host", "drone", "--icinga-api", "https://icinga:5665", "--icinga-user", "root", "--icinga-password", "secret"]
+    with patch('sys.argv', test_args):
+        with patch("check_drone_builds.CheckDroneBuilds") as mock_main:
+            main()
+            mock_main.return_value.check_builds_passive.assert_called_once_with(
+                "drone", "drone-builds-{namespace}-{name}", icinga_api="https://icinga:5665", icinga_user="root", icinga_password="secret",
+                icinga_ca=None, command_file=None,
+            )
+            mock_main.return_value.check_builds.assert_not_called()
+
+    for args in [test_args[:7], test_args[:5] + ["--command-file", "/tmp/icinga2.cmd"]]:
+        with patch('sys.argv', args):
+            with pytest.raises(SystemExit) as system_exit:
+                main()
+        assert system_exit.value.args[0] == 2
+
+class FakeIcingaHandler(BaseHTTPRequestHandler):
+    # accepts process-check-result actions for the services listed in services
+    protocol_version = "HTTP/1.1"
+    services = []
+    results = []
+
+    def do_POST(self) -> None:
+        result = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        code = 200
+        if self.headers.get("Authorization") != f"Basic {base64.b64encode(b'root:secret').decode()}":
+            code = 401
+        elif self.path != "/v1/actions/process-check-result" or result["service"] not in self.services:
+            code = 404
+        else:
+            self.results.append(result)
+        content = json.dumps({"results": [{"code": code}]}).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format: string, *args) -> None:
+        pass
+
+@pytest.fixture
+def icinga_api():
+    handler = type("Handler", (FakeIcingaHandler,), {"services": [f"drone!drone-builds-docker-test-{i}" for i in range(1, 5)], "results": []})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.01}, daemon=True)
+    thread.start()
+    yield handler, f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+
+def check_builds_passive(server: string, **options) -> MagicMock:
+    check = CheckDroneBuilds(server, TOKEN, "", 86400, 172800, concurrency=4)
+    check.nagios_exit = MagicMock()
+    check.nagios_exit.side_effect = ValueError("STOP") # just so it stops executing any other code, as it would in IRL
+    check.get_current_time = MagicMock()
+    check.get_current_time.return_value = TIME
+    with pytest.raises(ValueError):
+        check.check_builds_passive("drone", "drone-builds-{namespace}-{name}", **options)
+    return check.nagios_exit
+
+def test_check_builds_passive_icinga_api(drone_server, icinga_api) -> None:
+    _, server = drone_server
+    handler, url = icinga_api
+    nagios_exit = check_builds_passive(server, icinga_api=url, icinga_user="root", icinga_password="secret")
+    nagios_exit.assert_called_once_with("OK", "Submitted 4 passive check results: 1 OK, 0 WARNING, 2 CRITICAL, 1 UNKNOWN")
+    results = {result["service"]: result for result in handler.results}
+    assert results["drone!drone-builds-docker-test-1"] == {
+        "type": "Service",
+        "service": "drone!drone-builds-docker-test-1",
+        "exit_status": 0,
+        "plugin_output": "docker/test-1 - last succeeded: 1 day ago",
+        "performance_data": [f"age={TIME - get_builds_json('docker', 'test-1')[0]['finished']}s;86400;172800;0"],
+    }
+    assert results["drone!drone-builds-docker-test-2"]["exit_status"] == 2
+    assert results["drone!drone-builds-docker-test-2"]["plugin_output"] == "docker/test-2 - last succeeded: Unknown"
+    assert results["drone!drone-builds-docker-test-4"]["exit_status"] == 3
+    assert results["drone!drone-builds-docker-test-4"]["performance_data"] == ["age=U;86400;172800;0"]
+
+def test_check_builds_passive_icinga_api_errors(drone_server, icinga_api) -> None:
+    _, server = drone_server
+    handler, url = icinga_api
+    handler.services.remove("drone!drone-builds-docker-test-3")
+    nagios_exit = check_builds_passive(server, icinga_api=url, icinga_user="root", icinga_password="secret")
+    nagios_exit.assert_called_once_with("UNKNOWN", "Error submitting 1 of 4 passive check results: drone-builds-docker-test-3 (HTTP 404)")
+    assert len(handler.results) == 3
+
+    nagios_exit = check_builds_passive(server, icinga_api=url, icinga_user="root", icinga_password="wrong")
+    assert nagios_exit.call_args.args[1].startswith("Error submitting 4 of 4 passive check results: drone-builds-docker-test-1 (HTTP 401)")
+
+    nagios_exit = check_builds_passive(server, icinga_api="http://127.0.0.1:1", icinga_user="root", icinga_password="secret")
+    assert nagios_exit.call_args.args[1].startswith("Error submitting passive check results: ")
+
+def test_check_builds_passive_command_file(drone_server, tmp_path) -> None:
+    _, server = drone_server
+    command_file = tmp_path / "icinga2.cmd"
+    command_file.write_text("[1] SCHEDULE_FORCED_HOST_CHECK;drone;1\n") # written by someone else
+    nagios_exit = check_builds_passive(server, command_file=str(command_file))
+    nagios_exit.assert_called_once_with("OK", "Submitted 4 passive check results: 1 OK, 0 WARNING, 2 CRITICAL, 1 UNKNOWN")
+    assert command_file.read_text().splitlines() == [
+        "[1] SCHEDULE_FORCED_HOST_CHECK;drone;1",
+        f"[{TIME}] PROCESS_SERVICE_CHECK_RESULT;drone;drone-builds-docker-test-1;0;docker/test-1 - last succeeded: 1 day ago|age={TIME - get_builds_json('docker', 'test-1')[0]['finished']}s;86400;172800;0",
+        f"[{TIME}] PROCESS_SERVICE_CHECK_RESULT;drone;drone-builds-docker-test-2;2;docker/test-2 - last succeeded: Unknown|age=U;86400;172800;0",
+        f"[{TIME}] PROCESS_SERVICE_CHECK_RESULT;drone;drone-builds-docker-test-3;2;docker/test-3 - last succeeded: 140 days ago|age=12174622s;86400;172800;0",
+        f"[{TIME}] PROCESS_SERVICE_CHECK_RESULT;drone;drone-builds-docker-test-4;3;docker/test-4 - Unknown build status|age=U;86400;172800;0",
+    ]
+
+def test_submit_command_file_chunks() -> None:
+    check = CheckDroneBuilds(SERVER, TOKEN, "", 86400, 172800)
+    check.get_current_time = MagicMock(return_value=TIME)
+    results = [(f"drone-builds-docker-test-{i}", "OK", f"docker/test-{i} - last succeeded: 1 day ago", "age=86400s;86400;172800;0") for i in range(5)]
+    with patch("select.PIPE_BUF", 300), patch("check_drone_builds.open", create=True) as mock_open:
+        f = mock_open.return_value.__enter__.return_value
+        f.write.side_effect = len
+        check.submit_command_file(results, "drone", "/var/run/icinga2/cmd/icinga2.cmd")
+    # whole lines, no more than PIPE_BUF bytes per write
+    chunks = [c.args[0] for c in f.write.call_args_list]
+    assert [chunk.count(b"\n") for chunk in chunks] == [2, 2, 1]
+    assert all(len(chunk) <= 300 and chunk.endswith(b"\n") for chunk in chunks)
+    assert b"".join(chunks).decode().splitlines()[4] == (
+        f"[{TIME}] PROCESS_SERVICE_CHECK_RESULT;drone;drone-builds-docker-test-4;0;docker/test-4 - last succeeded: 1 day ago|age=86400s;86400;172800;0"
+    )
+
+def test_script_main_config(tmp_path):
+    config_file = tmp_path / "config.json"
+    config_file.write_text(json.dumps({"servers": [
+        {"server": SERVER, "token": TOKEN},
+        {"name": "other", "server": "drone.example.com", "token": "other", "namespace": "docker", "critical": 3600, "timeout": 10, "read_timeout": 5},
+    ]}))
+    test_args = ["check_drone_builds.py", "--config", str(config_file), "--warning", "600", "--concurrency", "4"]
+    with patch('sys.argv', test_args):
+        with patch("check_drone_builds.CheckDroneBuilds") as mock_main:
+            with patch("check_drone_builds.check_servers", side_effect=SystemExit(0)) as mock_check_servers:
+                with pytest.raises(SystemExit):
+                    main()
+    assert mock_main.call_args_list == [
+        call(SERVER, TOKEN, "", 600, 9999999999, False, **check_options(concurrency=4)),
+        call("drone.example.com", "other", "docker", 600, 3600, False, **check_options(concurrency=4, read_timeout=5)),
+    ]
+    mock_check_servers.assert_called_once_with({SERVER: mock_main.return_value, "other": mock_main.return_value}, {SERVER: 50, "other": 10})
+
+def test_script_main_config_invalid(tmp_path, capsys):
+    config_file = tmp_path / "config.json"
+    for config, error in [
+        ({"servers": []}, "Config does not contain a list of servers"),
+        ({"servers": [{"server": SERVER}]}, "Every server in the config needs a server and a token"),
+        ({"servers": [{"server": SERVER, "token": TOKEN, "tokne": TOKEN}]}, "Unknown server config key(s): tokne"),
+        ({"servers": [{"server": SERVER, "token": TOKEN}, {"server": SERVER, "token": "other"}]}, "Every server in the config needs a unique name"),
+        ({"servers": [{"server": SERVER, "token": TOKEN, "shard": "3/2"}]}, "Invalid shard 3/2, expected INDEX/COUNT with 1 <= INDEX <= COUNT"),
+        ({"servers": [{"server": SERVER, "token": TOKEN, "rules": [{"warning": 60}]}]}, "Every rule needs a pattern"),
+    ]:
+        config_file.write_text(json.dumps(config))
+        with patch('sys.argv', ["check_drone_builds.py", "--config", str(config_file)]):
+            with pytest.raises(SystemExit) as system_exit:
+                main()
+        assert capsys.readouterr().out == f"UNKNOWN - Error reading config {config_file}: {error}\n"
+        assert system_exit.value.args[0] == 3
+
+    with patch('sys.argv', ["check_drone_builds.py"]):
+        with pytest.raises(SystemExit) as system_exit:
+            main()
+    assert system_exit.value.args[0] == 2
+
+def test_check_servers(drone_server, capsys) -> None:
+    handler, server = drone_server
+    checks = {
+        "docker": CheckDroneBuilds(server, TOKEN, "docker", 86400, 172800),
+        "random": CheckDroneBuilds(server, TOKEN, "random", 86400, 172800),
+        "broken": CheckDroneBuilds("http://127.0.0.1:1", TOKEN, "", 86400, 172800),
+        "slow": CheckDroneBuilds(server, TOKEN, "", 86400, 172800),
+    }
+    for check in checks.values():
+        check.get_current_time = MagicMock()
+        check.get_current_time.return_value = TIME
+    checks["slow"].get_all_repos = MagicMock(side_effect=lambda: time.sleep(5))
+
+    started = time.monotonic()
+    with pytest.raises(SystemExit):
+        with patch("check_drone_builds.os._exit", side_effect=SystemExit) as os_exit:
+            check_servers(checks, {"docker": 10, "random": 10, "broken": 10, "slow": 0.5})
+    assert time.monotonic() - started < 3
+    # the slow server is still running
+    os_exit.assert_called_once_with(2)
+    output, _, perfdata = capsys.readouterr().out.strip().rpartition(" | ")
+    assert output.splitlines()[0] == "CRITICAL - 4 Drone servers: 2 CRITICAL, 2 UNKNOWN"
+    assert output.splitlines()[1] == "docker: CRITICAL - Failing build(s): docker/test-2 - last succeeded: Unknown, docker/test-3 - last succeeded: 140 days ago"
+    assert output.splitlines()[2] == "random: UNKNOWN - No repos/builds found"
+    assert output.splitlines()[3].startswith("broken: CRITICAL - Error retrieving repos: ")
+    assert output.splitlines()[4] == "slow: UNKNOWN - Timed out after 0.5 seconds"
+    assert "'docker requests'=5 " in perfdata
+    assert "'random repos_checked'=0 " in perfdata
+    assert float(re.search(r"'docker time'=(\S+)s", perfdata).group(1)) < 0.5
+
+def test_script_main_config_timeout_exits(drone_server, tmp_path) -> None:
+    # the thread pools of a server that timed out don't keep the process from exiting
+    handler, server = drone_server
+    handler.delays = {"repos/docker/test-1/builds": 4}
+    for options in [["--concurrency", "2"], ["--engine", "asyncio"]]:
+        config_file = tmp_path / "config.json"
+        config_file.write_text(json.dumps({"servers": [{"server": server, "token": TOKEN, "timeout": 1}]}))
+        started = time.monotonic()
+        process = subprocess.run([sys.executable, "check_drone_builds.py", "--config", str(config_file)] + options, capture_output=True, text=True, timeout=30)
+        assert time.monotonic() - started < 3.5
+        assert process.returncode == 3
+        assert process.stdout.startswith("UNKNOWN - 1 Drone servers: 1 UNKNOWN\n")
+        assert "Timed out after 1 seconds" in process.stdout
+
 def test_time_ago() -> None:
     check = CheckDroneBuilds(SERVER, TOKEN, NAMESPACE, 2, 1)
     check.get_current_time = MagicMock()